@@ -15,14 +15,61 @@ step 4 :
 import pandas as pd
 from typing import Optional, List, Dict, Union
 from pathlib import Path
-import numpy as np
+from storage import save_df
+from merge import merge_on_keys
+from country import add_country_code
+from cache import cached_stage
+from instrument import traced
 
 PathLike = Union[Path, str]
 
 
+# marker after the date in the UN sheet --> type of the action, no marker is a ratification (or signature)
+TREATY_ACTIONS: Dict[str, str] = {'': 'Ratification',
+                                  'A': 'Acceptance',
+                                  'AA': 'Approval',
+                                  'c': 'Formal confirmation',
+                                  'a': 'Accession',
+                                  'd': 'Succession'}
+_MONTH_NAMES = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October',
+                'November', 'December']
+_MONTHS: Dict[str, str] = {name: f'{i:02d}' for i, month in enumerate(_MONTH_NAMES, start=1)
+                           for name in (month[:3], month)}
+_MONTHS['Sept'] = '09'
+# '29 06 2004', ' 5 6 2006 a', '3 Jun 2004', '29 June 2004', '29/06/2004', '29.06.2004', '2507 2006' (separator
+# missing) or a cell Excel already read as a date. day first, as pd.to_datetime(dayfirst=True) of the old parser
+_DATE_PATTERN = (r'^(?:(?P<day>\d{1,2})[\s/.-]*(?P<month>\d{1,2}|[A-Za-z]{3,9})[\s/.,-]*(?P<year>\d{4})'
+                 r'|(?P<iso_year>\d{4})-(?P<iso_month>\d{2})-(?P<iso_day>\d{2})[\d: ]*)'
+                 r'\s*(?P<marker>AA|A|a|c|d)?$')
+
+
+def parse_treaty_date(s: pd.Series) -> pd.DataFrame:
+    """
+    parse a date column of the UN treaty sheet in one pass: the markers (A, AA, c, a, d) are stripped and the dates are
+    parsed with the explicit format '%d %m %Y'. day, month (number, abbreviated or full name) and year may be
+    separated by spaces, '/', '.' or '-'; cells not matching it (or an unknown month name) are NaT
+
+    :param s: Signature or Ratification column
+    :return: df, 'date': datetime64, 'type': categorical of TREATY_ACTIONS values (NaN if no date)
+    """
+    text = s.astype(str).str.replace('\xa0', ' ').str.strip()  # non-breaking spaces around some dates
+    parts = text.str.extract(_DATE_PATTERN)
+    day = parts['day'].fillna(parts['iso_day'])
+    month = parts['month'].str.title().replace(_MONTHS).fillna(parts['iso_month'])
+    year = parts['year'].fillna(parts['iso_year'])
+    date = pd.to_datetime(day + ' ' + month + ' ' + year, format='%d %m %Y', errors='coerce')
+
+    action = parts['marker'].fillna('').map(TREATY_ACTIONS).where(date.notna())
+    action = pd.Categorical(action, categories=list(TREATY_ACTIONS.values()))
+    return pd.DataFrame({'date': date, 'type': action}, index=s.index)
+
+
+@traced
+@cached_stage(save_index=True)
 def format_date(df: pd.DataFrame,
                 rename_mapping: Dict[str, str] = None,
                 formatted_date: Optional[List[str]] = None,
+                action_column: Optional[str] = 'Ratification',
                 save_path: Optional[Path] = None) -> pd.DataFrame:
     """
     :param df: Signatures and Ratifications- UN Treaty Section_08 Feb_2023 data
@@ -30,22 +77,33 @@ def format_date(df: pd.DataFrame,
     'Participant': 'Country Name',
     "Ratification, Acceptance(A), Approval(AA), Formal confirmation(c), Accession(a), Succession(d)": 'Ratification'
     }
-    :param formatted_date: ['Signature', 'Ratification']
+    :param formatted_date: ['Signature', 'Ratification'], the dates are replaced by the year (Int64, <NA> if no date)
+    :param action_column: one of formatted_date, its marker is kept in '{action_column} Type'
+    (Ratification, Acceptance, Approval, Formal confirmation, Accession or Succession)
     :param save_path: save as WHOFCTC_Parties_date_formatted.xlsx
-    :return: df
+    :return: df, with the 'ISO3' code of 'Country Name' (categorical)
     """
     if rename_mapping is not None:
         df = df.rename(columns=rename_mapping)
+    else:
+        df = df.copy()
+    if 'Country Name' in df.columns:
+        df['Country Name'] = df['Country Name'].astype('category')  # a dimension, as in schema.py
+        df = add_country_code(df)
     if formatted_date is not None:
         for col in formatted_date:
-            df[col] = pd.to_datetime(df[col], dayfirst=True, errors='coerce').dt.year.astype(str).fillna("Nan")
+            parsed = parse_treaty_date(df[col])
+            df[col] = parsed['date'].dt.year.astype('Int64')
+            if col == action_column:
+                df[f'{col} Type'] = parsed['type']
 
-    df.fillna(value='Nan', inplace=True)
     if save_path is not None:
-        df.to_excel(save_path)
+        save_df(df, save_path, index=True)
     return df
 
 
+@traced
+@cached_stage
 def final_selected(df: pd.DataFrame,
                    column_drop: Optional[List[str]] = None,
                    save_path: Optional[Path] = None,
@@ -69,29 +127,30 @@ def final_selected(df: pd.DataFrame,
             raise ValueError(f'{e} not in the dataframe, should be one of the {df.columns.tolist()}')  # If
             # typed wrong, show the list which should be dropped.
     if save_path is not None:
-        df.to_excel(save_path, index=False)
+        save_df(df, save_path)
 
     return df
 
 
+@traced
+@cached_stage
 def merge_fctc_df(df1: pd.DataFrame, df2: pd.DataFrame, drop_na: bool = False,
                   merge_output: PathLike = None) -> pd.DataFrame:
     """
     :param df1: cvd_tobacco_nomissingdata.xlsx
     :param df2: WHOFCTC_Parties_date_formatted.xlsx
-    :param drop_na: drop na
+    :param drop_na: drop the rows with any missing value
     :param merge_output: output path
-    :return:df
+    :return:df, number of matched/unmatched countries in df.attrs['merge_report']
     """
-
-    signed_df = pd.merge(df1, df2, on=['Country Name'], how='outer')
-    signed_df.fillna(value='NaN', inplace=True)
+    # on the ISO3 code if both df have it (see country.py), otherwise on the names
+    key = 'ISO3' if 'ISO3' in df1.columns and 'ISO3' in df2.columns else 'Country Name'
+    signed_df = merge_on_keys(df1, df2, keys=[key], how='outer')  # missing values stay NaN
     if drop_na:
-        signed_df.replace("NaN", np.nan, inplace=True)
         signed_df = signed_df.dropna(axis=0)
 
     if merge_output is not None:
-        signed_df.to_excel('WHOFCTC_Parties_signed_date.xlsx', index=False)
+        save_df(signed_df, merge_output)
 
     return signed_df
 
@@ -0,0 +1,277 @@
+"""
+benchmark of the preprocessing and analysis functions on synthetic data
+
+- synthetic_mortality / synthetic_tobacco / synthetic_treaty: seeded generators with the schemas of
+  WHOMortalityDatabase_Deaths.csv, the GHO tobacco csv and the UN treaty sheet (as loaded by schema.py and
+  pd.read_excel), at any number of rows. The years are extended when the rows do not fit into 2000-2020, so the
+  aggregated tables (and the functions downstream of them) grow with the size too. The treaty sheet has one row per
+  country whatever the size
+- run_benchmark: wall time (best of `repeat`) and peak memory (tracemalloc, separate run) of every function at each
+  size, the stage cache is bypassed
+- compare_baseline: regression flag against a stored baseline (json)
+
+usage:
+    python benchmark.py --sizes 1000 10000 100000 --baseline benchmark_baseline.json [--update-baseline]
+"""
+import argparse
+import inspect
+import json
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Optional, List, Union, Dict, Callable, Any, Sequence, Tuple
+import numpy as np
+import pandas as pd
+from country import COUNTRY_CODES, add_country_code
+from schema import MORTALITY_SCHEMA, TOBACCO_SCHEMA
+from utility import (select_df, preprocess_cvd, create_age_grouping, age_standardized_rate, tobacco_layout_modified,
+                     merge_df, TOBACCO_INDICATORS, TOBACCO_SEX_LABELS)
+from WHOFCTC_parties_date import format_date, merge_fctc_df, TREATY_ACTIONS
+from statistical_analysis import evaluate_correlation
+from storage import save_df
+
+PathLike = Union[Path, str]
+
+__all__ = ['DEFAULT_SIZES', 'synthetic_mortality', 'synthetic_tobacco', 'synthetic_treaty', 'run_benchmark',
+           'compare_baseline', 'main']
+
+DEFAULT_SIZES = (10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7)
+FIRST_YEAR = 2000
+MIN_YEARS = 21  # 2000-2020
+
+COUNTRIES: Tuple[str, ...] = tuple(COUNTRY_CODES)
+REGIONS = (('AF', 'Africa'), ('AS', 'Asia'), ('CSA', 'Central and South America'), ('EU', 'Europe'),
+           ('NAC', 'North America and the Caribbean'), ('OA', 'Oceania'))
+AGE_GROUPS = (('Age00', '[0]'), ('Age01_04', '[1-4]'), ('Age05_09', '[5-9]'), ('Age10_14', '[10-14]'),
+              ('Age15_19', '[15-19]'), ('Age20_24', '[20-24]'), ('Age25_29', '[25-29]'), ('Age30_34', '[30-34]'),
+              ('Age35_39', '[35-39]'), ('Age40_44', '[40-44]'), ('Age45_49', '[45-49]'), ('Age50_54', '[50-54]'),
+              ('Age55_59', '[55-59]'), ('Age60_64', '[60-64]'), ('Age65_69', '[65-69]'), ('Age70_74', '[70-74]'),
+              ('Age75_79', '[75-79]'), ('Age80_84', '[80-84]'), ('Age85_over', '[85+]'), ('Age_all', '[All]'),
+              ('Age_unknown', '[Unknown]'))
+MORTALITY_SEXES = ('All', 'Female', 'Male')
+
+MORTALITY_KWARGS = {'column_drop': ['Age group code', 'Unnamed: 12',
+                                    'Age-standardized death rate per 100 000 standard population'],
+                    'drop_na': ['Number', 'Percentage of cause-specific deaths out of total deaths',
+                                'Death rate per 100 000 population']}
+TREATY_RENAME = {'Participant': 'Country Name',
+                 'Ratification, Acceptance(A), Approval(AA), Formal confirmation(c), Accession(a), Succession(d)':
+                     'Ratification'}
+
+
+def _sample_cells(n_rows: int, dims: Sequence[int], rng: np.random.Generator) -> Tuple[np.ndarray, ...]:
+    """n_rows distinct cells of a grid (with repeats only if n_rows is larger than the grid), in grid order"""
+    total = int(np.prod(dims))
+    flat = np.sort(rng.choice(total, size=n_rows, replace=n_rows > total))
+    return np.unravel_index(flat, dims)
+
+
+def _n_years(n_rows: int, cells_per_year: int) -> int:
+    return max(MIN_YEARS, -(-n_rows // cells_per_year))
+
+
+def synthetic_mortality(n_rows: int, seed: int = 0) -> pd.DataFrame:
+    """
+    :param n_rows: number of rows
+    :param seed: seed of the random generator
+    :return: df like read_mortality('WHOMortalityDatabase_Deaths.csv')
+    """
+    rng = np.random.default_rng(seed)
+    n_years = _n_years(n_rows, len(COUNTRIES) * len(MORTALITY_SEXES) * len(AGE_GROUPS))
+    country, year, sex, age = _sample_cells(n_rows, (len(COUNTRIES), n_years, len(MORTALITY_SEXES), len(AGE_GROUPS)),
+                                            rng)
+    region = np.arange(len(COUNTRIES)) % len(REGIONS)  # a fixed region per country
+
+    number = rng.poisson(80, n_rows).astype('float64')
+    percentage = rng.uniform(1, 60, n_rows)
+    death_rate = rng.gamma(2, 50, n_rows)
+    missing = rng.random(n_rows) < 0.02  # some rows without numbers, as in the real data
+    number[missing] = np.nan
+
+    df = pd.DataFrame({
+        'Region Code': np.take([r[0] for r in REGIONS], region[country]),
+        'Region Name': np.take([r[1] for r in REGIONS], region[country]),
+        'Country Code': np.take([COUNTRY_CODES[c] for c in COUNTRIES], country),
+        'Country Name': np.take(COUNTRIES, country),
+        'Year': FIRST_YEAR + year,
+        'Sex': np.take(MORTALITY_SEXES, sex),
+        'Age group code': np.take([a[0] for a in AGE_GROUPS], age),
+        'Age Group': np.take([a[1] for a in AGE_GROUPS], age),
+        'Number': number,
+        'Percentage of cause-specific deaths out of total deaths': percentage,
+        'Age-standardized death rate per 100 000 standard population': np.nan,
+        'Death rate per 100 000 population': death_rate,
+        'Unnamed: 12': np.nan,
+    })
+    return add_country_code(df.astype(MORTALITY_SCHEMA))
+
+
+def synthetic_tobacco(n_rows: int, seed: int = 0) -> pd.DataFrame:
+    """
+    :param n_rows: number of rows
+    :param seed: seed of the random generator
+    :return: df like read_tobacco of the GHO prevalence of tobacco use csv
+    """
+    rng = np.random.default_rng(seed + 1)
+    n_years = _n_years(n_rows, len(COUNTRIES) * len(TOBACCO_INDICATORS) * len(TOBACCO_SEX_LABELS))
+    country, year, indicator, sex = _sample_cells(
+        n_rows, (len(COUNTRIES), n_years, len(TOBACCO_INDICATORS), len(TOBACCO_SEX_LABELS)), rng)
+    df = pd.DataFrame({
+        'Location': np.take(COUNTRIES, country),
+        'Period': FIRST_YEAR + year,
+        'Indicator': np.take(TOBACCO_INDICATORS, indicator),
+        'Dim1': np.take(list(TOBACCO_SEX_LABELS), sex),
+        'First Tooltip': np.round(rng.uniform(2, 60, n_rows), 1),
+    })
+    return add_country_code(df.astype(TOBACCO_SCHEMA), 'Location')
+
+
+def synthetic_treaty(seed: int = 0) -> pd.DataFrame:
+    """
+    :param seed: seed of the random generator
+    :return: df like pd.read_excel('Signatures and Ratifications- UN Treaty Section_08 Feb_2023.xlsx'), one row per
+    country, dates as 'dd mm yyyy' strings with markers, some missing
+    """
+    rng = np.random.default_rng(seed + 2)
+    n = len(COUNTRIES)
+
+    def dates(first_year: int, n_years: int, missing: float) -> pd.Series:
+        day, month = rng.integers(1, 29, n), rng.integers(1, 13, n)
+        year = first_year + rng.integers(0, n_years, n)
+        text = pd.Series([f'{d:02d} {m:02d} {y}' for d, m, y in zip(day, month, year)], dtype=object)
+        return text.where(rng.random(n) >= missing)
+
+    ratification = dates(2004, 15, 0.05)
+    markers = rng.choice(list(TREATY_ACTIONS), n, p=[0.7, 0.05, 0.05, 0.02, 0.15, 0.03])
+    ratification = (ratification + ' ' + markers).str.strip()
+    return pd.DataFrame({'Participant': COUNTRIES,
+                         'Signature': dates(2003, 2, 0.2),
+                         list(TREATY_RENAME)[1]: ratification})
+
+
+def _functions(n_rows: int, seed: int) -> Dict[str, Tuple[Callable, Callable[[Dict[str, Any]], tuple], Dict]]:
+    """{name: (function, inputs(outputs so far) --> args, kwargs)} in the order of the pipeline"""
+    return {
+        'select_df': (select_df, lambda out: (synthetic_mortality(n_rows, seed),), MORTALITY_KWARGS),
+        # preprocess_cvd writes a column into its input: a copy per run
+        'preprocess_cvd': (preprocess_cvd, lambda out: (out['select_df'].copy(),), {'drop_na': True}),
+        'create_age_grouping': (create_age_grouping, lambda out: (out['preprocess_cvd'],), {}),
+        'age_standardized_rate': (age_standardized_rate, lambda out: (out['preprocess_cvd'],), {}),
+        'tobacco_layout_modified': (tobacco_layout_modified, lambda out: (synthetic_tobacco(n_rows, seed),), {}),
+        'merge_df': (merge_df, lambda out: (out['create_age_grouping'], out['tobacco_layout_modified']),
+                     {'column_name': ['ISO3', 'Year']}),
+        'format_date': (format_date, lambda out: (synthetic_treaty(seed),),
+                        {'rename_mapping': TREATY_RENAME, 'formatted_date': ['Signature', 'Ratification']}),
+        'merge_fctc_df': (merge_fctc_df, lambda out: (out['merge_df'], out['format_date']), {}),
+        'evaluate_correlation': (evaluate_correlation, lambda out: (out['merge_fctc_df'],), {}),
+    }
+
+
+def _measure(func: Callable, args: tuple, kwargs: Dict, repeat: int) -> Tuple[Any, float, float]:
+    """(result, best wall time in s, peak memory in MB)"""
+    func = inspect.unwrap(func)  # bypass the stage cache (and the instrumentation)
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        seconds.append(time.perf_counter() - start)
+    # tracemalloc slows down the allocations: peak memory in a separate run
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, min(seconds), peak / 1024 ** 2
+
+
+def run_benchmark(sizes: Sequence[int] = DEFAULT_SIZES,
+                  functions: Optional[List[str]] = None,
+                  repeat: int = 3,
+                  seed: int = 0,
+                  verbose: bool = False) -> pd.DataFrame:
+    """
+    :param sizes: number of rows of the synthetic mortality and tobacco data
+    :param functions: names of the functions to be reported, default all (the ones upstream of them run anyway)
+    :param repeat: wall time is the best of `repeat` runs
+    :param seed: seed of the synthetic data
+    :param verbose: print each result
+    :return: df, columns: function, rows, input rows, seconds, peak memory (MB)
+    """
+    records = []
+    for n_rows in sizes:
+        outputs: Dict[str, Any] = {}
+        for name, (func, inputs, kwargs) in _functions(n_rows, seed).items():
+            args = inputs(outputs)
+            if functions is None or name in functions:
+                result, seconds, peak = _measure(func, args, kwargs, repeat)
+                record = {'function': name, 'rows': n_rows, 'input rows': len(args[0]), 'seconds': seconds,
+                          'peak memory (MB)': peak}
+                records.append(record)
+                if verbose:
+                    print(record)
+            else:
+                result = inspect.unwrap(func)(*args, **kwargs)
+            outputs[name] = result
+    return pd.DataFrame.from_records(records, columns=['function', 'rows', 'input rows', 'seconds',
+                                                      'peak memory (MB)'])
+
+
+def compare_baseline(result: pd.DataFrame,
+                     baseline: PathLike,
+                     tolerance: float = 1.5,
+                     min_seconds: float = 0.05,
+                     update: bool = False) -> pd.DataFrame:
+    """
+    :param result: output of run_benchmark
+    :param baseline: json file of a previous run_benchmark (written if `update` or if it does not exist)
+    :param tolerance: regression if the time or peak memory is larger than tolerance * baseline
+    :param min_seconds: times below this (in both runs) are noise, not compared
+    :param update: write `result` as the new baseline
+    :return: result with 'baseline seconds', 'baseline peak memory (MB)' and 'regression' columns
+    """
+    baseline = Path(baseline)
+    keys = ['function', 'rows']
+    if baseline.exists():
+        previous = pd.DataFrame.from_records(json.loads(baseline.read_text()))
+        previous = previous[keys + ['seconds', 'peak memory (MB)']].rename(
+            columns={'seconds': 'baseline seconds', 'peak memory (MB)': 'baseline peak memory (MB)'})
+    else:
+        previous = pd.DataFrame(columns=keys + ['baseline seconds', 'baseline peak memory (MB)'])
+    compared = result.merge(previous.astype({'rows': 'int64'}), on=keys, how='left')
+
+    slower = ((compared['seconds'] > tolerance * compared['baseline seconds'])
+              & (compared['seconds'] > min_seconds))
+    larger = compared['peak memory (MB)'] > tolerance * compared['baseline peak memory (MB)']
+    compared['regression'] = slower | larger
+
+    if update or not baseline.exists():
+        baseline.write_text(json.dumps(result.to_dict(orient='records'), indent=2))
+    return compared
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description='benchmark the fctc_eval functions on synthetic data')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES), help='rows of the input data')
+    parser.add_argument('--function', action='append', help='function to be reported (repeatable), default all')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', type=Path, help='json baseline, regressions against it are flagged')
+    parser.add_argument('--update-baseline', action='store_true', help='write this run as the baseline')
+    parser.add_argument('--tolerance', type=float, default=1.5)
+    parser.add_argument('--output', type=Path, help='save the result, e.g. benchmark.csv')
+    args = parser.parse_args(argv)
+
+    result = run_benchmark(args.sizes, args.function, repeat=args.repeat, seed=args.seed, verbose=True)
+    if args.baseline is not None:
+        result = compare_baseline(result, args.baseline, tolerance=args.tolerance, update=args.update_baseline)
+    if args.output is not None:
+        save_df(result, args.output)
+    print(result.to_string(float_format='{:.4f}'.format))
+    if 'regression' in result and result['regression'].any():
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
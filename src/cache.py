@@ -0,0 +1,213 @@
+"""
+content-addressed cache of the pipeline stages
+
+A stage decorated by `cached_stage` is looked up on disk by a hash of
+- the function: module, name and the source code of its module and of the modules of this directory it uses, so
+  editing the function or one of its helpers (e.g. storage.save_df of utility.select_df) invalidates its results
+- the data of every DataFrame/Series argument, and the size/mtime of every file argument
+- the other arguments
+
+so rerunning the analysis after changing one parameter only recomputes the stages whose inputs changed.
+The cache is off by default: enable it with enable_cache() or the environment variable FCTC_CACHE_DIR.
+Least recently used results are evicted when the cache is larger than `max_bytes`.
+"""
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import sys
+import threading
+from pathlib import Path
+from typing import Optional, Union, Callable, Any, Dict
+import pandas as pd
+from storage import save_df
+
+PathLike = Union[Path, str]
+
+__all__ = ['cached_stage', 'enable_cache', 'disable_cache', 'clear_cache', 'fingerprint', 'code_source']
+
+# arguments that only tell where to write the result; not part of the key, the file is (re)written on a cache hit
+SAVE_ARGUMENTS = ('save_path', 'output_path', 'all_df_out', 'merge_output')
+
+_cache_dir: Optional[Path] = Path(os.environ['FCTC_CACHE_DIR']) if os.environ.get('FCTC_CACHE_DIR') else None
+_max_bytes: int = int(os.environ.get('FCTC_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+_local = threading.local()  # a stage called inside another cached stage (e.g. select_df in stream_age_grouping) is
+# covered by the outer result and is not cached by itself
+
+
+def enable_cache(cache_dir: PathLike, max_bytes: int = 2 * 1024 ** 3) -> None:
+    """
+    :param cache_dir: directory of the cached results
+    :param max_bytes: size limit of the cache directory
+    """
+    global _cache_dir, _max_bytes
+    _cache_dir = Path(cache_dir)
+    _max_bytes = max_bytes
+
+
+def disable_cache() -> None:
+    global _cache_dir
+    _cache_dir = None
+
+
+def clear_cache(func: Optional[Callable] = None) -> None:
+    """
+    invalidate cached results
+
+    :param func: stage whose results are removed, None means all stages
+    """
+    if _cache_dir is None or not _cache_dir.exists():
+        return
+    stage_dirs = [_cache_dir / _stage_name(func)] if func is not None else _cache_dir.iterdir()
+    for stage_dir in stage_dirs:
+        if stage_dir.is_dir():
+            for file in stage_dir.glob('*.pkl'):
+                file.unlink()
+
+
+def _stage_name(func: Callable) -> str:
+    func = getattr(func, '__wrapped__', func)
+    return f'{func.__module__}.{func.__qualname__}'
+
+
+def code_source(func: Callable) -> str:
+    """
+    source code of the module of `func` and of the modules in the same directory it uses, directly or through another
+    one of them (not only the source of `func`: a change of a helper must change the fingerprint too)
+
+    :param func: function, the decorators are unwrapped
+    :return: source code, the module name if it is not available
+    """
+    func = inspect.unwrap(func)
+    module = sys.modules.get(func.__module__)
+    if module is None or getattr(module, '__file__', None) is None:
+        return f'{func.__module__}.{func.__qualname__}'
+    directory = Path(module.__file__).resolve().parent
+    sources: Dict[str, str] = {}
+    pending = [module]
+    while pending:
+        module = pending.pop()
+        if module.__name__ in sources:
+            continue
+        try:
+            sources[module.__name__] = inspect.getsource(module)
+        except (OSError, TypeError):
+            sources[module.__name__] = module.__name__
+        for value in list(vars(module).values()):
+            used = value if inspect.ismodule(value) else sys.modules.get(getattr(value, '__module__', None) or '')
+            file = getattr(used, '__file__', None)
+            if file is not None and used.__name__ not in sources and Path(file).resolve().parent == directory:
+                pending.append(used)
+    return ''.join(sources[name] for name in sorted(sources))
+
+
+def _is_file(value: PathLike) -> bool:
+    try:
+        return Path(value).is_file()
+    except (OSError, ValueError):  # e.g. a long string that is not a path
+        return False
+
+
+def _fingerprint(value: Any, h: 'hashlib._Hash') -> None:
+    """update hash `h` by the content of an argument"""
+    if isinstance(value, pd.DataFrame):
+        h.update(repr((list(value.columns), [str(t) for t in value.dtypes])).encode())
+        h.update(pd.util.hash_pandas_object(value, index=True).values.tobytes())
+    elif isinstance(value, pd.Series):
+        h.update(repr((value.name, str(value.dtype))).encode())
+        h.update(pd.util.hash_pandas_object(value, index=True).values.tobytes())
+    elif isinstance(value, (str, Path)) and _is_file(value):
+        stat = Path(value).stat()  # hashing a raw file of several GB would cost as much as reading it
+        h.update(repr((str(Path(value).resolve()), stat.st_size, stat.st_mtime_ns)).encode())
+    elif isinstance(value, dict):
+        for k in sorted(value, key=repr):
+            h.update(repr(k).encode())
+            _fingerprint(value[k], h)
+    elif isinstance(value, (list, tuple)):
+        h.update(type(value).__name__.encode())
+        for it in value:
+            _fingerprint(it, h)
+    else:
+        h.update(repr(value).encode())
+    h.update(b'\0')
+
+
+def fingerprint(*values: Any) -> str:
+    """
+    content hash of the values (DataFrame, Series, file path or anything with a stable repr)
+
+    :param values: values
+    :return: hex digest
+    """
+    h = hashlib.sha256()
+    for value in values:
+        _fingerprint(value, h)
+    return h.hexdigest()
+
+
+def _evict(cache_dir: Path, max_bytes: int) -> None:
+    """remove the least recently used results until the cache is smaller than max_bytes"""
+    files = [(f.stat().st_mtime, f.stat().st_size, f) for f in cache_dir.glob('*/*.pkl')]
+    total = sum(size for _, size, _ in files)
+    for _, size, f in sorted(files):
+        if total <= max_bytes:
+            break
+        f.unlink(missing_ok=True)
+        total -= size
+
+
+def cached_stage(func: Optional[Callable] = None, *, save_index: bool = False) -> Callable:
+    """
+    decorator of a pipeline stage, see module docstring
+
+    :param func: stage
+    :param save_index: index argument of save_df when the result is written on a cache hit
+    """
+    if func is None:
+        return functools.partial(cached_stage, save_index=save_index)
+
+    signature = inspect.signature(func)
+    stage = _stage_name(func)
+    source: Optional[str] = None  # code_source on the first call: the modules are not completely imported yet here
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        nonlocal source
+        if _cache_dir is None or getattr(_local, 'running', False):
+            return func(*args, **kwargs)
+
+        if source is None:
+            source = code_source(func)
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        h = hashlib.sha256(stage.encode() + source.encode())
+        for name, value in bound.arguments.items():
+            if name not in SAVE_ARGUMENTS:
+                h.update(name.encode())
+                _fingerprint(value, h)
+        file = _cache_dir / stage / f'{h.hexdigest()}.pkl'
+
+        if file.exists():
+            with open(file, 'rb') as f:
+                result = pickle.load(f)
+            os.utime(file)  # mark as recently used
+            for name in SAVE_ARGUMENTS:
+                if bound.arguments.get(name) is not None:
+                    save_df(result, bound.arguments[name], index=save_index)
+            return result
+
+        _local.running = True
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            _local.running = False
+        file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = file.with_suffix('.tmp')
+        with open(tmp, 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        tmp.replace(file)
+        _evict(_cache_dir, _max_bytes)
+        return result
+
+    return wrapper
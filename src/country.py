@@ -0,0 +1,169 @@
+"""
+country name resolver
+
+The WHO mortality database, the GHO tobacco data and the UN treaty sheet spell some countries differently
+(e.g. 'Czechia' / 'Czech Republic', "Democratic People's Republic of Korea" / 'North Korea'), and an outer merge on the
+names silently splits them into two countries. Every spelling is resolved to the ISO3 code here:
+
+- COUNTRY_CODES: name --> ISO3 (the names of who_member_states.WHO_MEMBER_STATES and a few territories of the WHO
+  mortality database), COUNTRY_ALIASES: other spellings --> ISO3
+- both are normalized (case, accents, apostrophes, spaces) into one dict, built once at import
+- resolve_country maps the unique names only (the categories), the rows are mapped by their category codes, and the
+  result is a categorical with the same categories (COUNTRY_DTYPE) in every source, so joins on it compare small ints
+"""
+import unicodedata
+from typing import Dict, List
+import numpy as np
+import pandas as pd
+
+__all__ = ['COUNTRY_CODES', 'COUNTRY_ALIASES', 'COUNTRY_DTYPE', 'resolve_country', 'country_name',
+           'unresolved_countries', 'add_country_code']
+
+COUNTRY_CODES: Dict[str, str] = {
+    'Afghanistan': 'AFG', 'Albania': 'ALB', 'Algeria': 'DZA', 'Andorra': 'AND', 'Argentina': 'ARG',
+    'Armenia': 'ARM', 'Australia': 'AUS', 'Austria': 'AUT', 'Azerbaijan': 'AZE', 'Bahamas': 'BHS',
+    'Bahrain': 'BHR', 'Bangladesh': 'BGD', 'Barbados': 'BRB', 'Belarus': 'BLR', 'Belgium': 'BEL',
+    'Belize': 'BLZ', 'Benin': 'BEN', 'Bolivia': 'BOL', 'Bosnia and Herzegovina': 'BIH', 'Botswana': 'BWA',
+    'Brazil': 'BRA', 'Brunei': 'BRN', 'Bulgaria': 'BGR', 'Burkina Faso': 'BFA', 'Burundi': 'BDI',
+    'Cambodia': 'KHM', 'Cameroon': 'CMR', 'Canada': 'CAN', 'Chad': 'TCD', 'Chile': 'CHL',
+    'China': 'CHN', 'Colombia': 'COL', 'Comoros': 'COM', 'Congo': 'COG', 'Costa Rica': 'CRI',
+    "Cote d'Ivoire": 'CIV', 'Croatia': 'HRV', 'Cuba': 'CUB', 'Cyprus': 'CYP', 'Czechia': 'CZE',
+    'North Korea': 'PRK', 'Democratic Republic of the Congo': 'COD', 'Denmark': 'DNK', 'Dominican Republic': 'DOM',
+    'Ecuador': 'ECU', 'Egypt': 'EGY', 'El Salvador': 'SLV', 'Eritrea': 'ERI', 'Estonia': 'EST',
+    'Eswatini': 'SWZ', 'Ethiopia': 'ETH', 'Fiji': 'FJI', 'Finland': 'FIN', 'France': 'FRA',
+    'Gambia': 'GMB', 'Georgia': 'GEO', 'Germany': 'DEU', 'Ghana': 'GHA', 'Greece': 'GRC',
+    'Guatemala': 'GTM', 'Guinea-Bissau': 'GNB', 'Guyana': 'GUY', 'Haiti': 'HTI', 'Hungary': 'HUN',
+    'Iceland': 'ISL', 'India': 'IND', 'Indonesia': 'IDN', 'Iran': 'IRN', 'Iraq': 'IRQ',
+    'Ireland': 'IRL', 'Israel': 'ISR', 'Italy': 'ITA', 'Jamaica': 'JAM', 'Japan': 'JPN',
+    'Jordan': 'JOR', 'Kazakhstan': 'KAZ', 'Kenya': 'KEN', 'Kiribati': 'KIR', 'Kuwait': 'KWT',
+    'Kyrgyzstan': 'KGZ', 'Laos': 'LAO', 'Latvia': 'LVA', 'Lebanon': 'LBN', 'Lesotho': 'LSO',
+    'Liberia': 'LBR', 'Lithuania': 'LTU', 'Luxembourg': 'LUX', 'Madagascar': 'MDG', 'Malawi': 'MWI',
+    'Malaysia': 'MYS', 'Maldives': 'MDV', 'Mali': 'MLI', 'Malta': 'MLT', 'Marshall Islands': 'MHL',
+    'Mauritania': 'MRT', 'Mauritius': 'MUS', 'Mexico': 'MEX', 'Mongolia': 'MNG', 'Montenegro': 'MNE',
+    'Morocco': 'MAR', 'Mozambique': 'MOZ', 'Myanmar': 'MMR', 'Namibia': 'NAM', 'Nauru': 'NRU',
+    'Nepal': 'NPL', 'Netherlands': 'NLD', 'New Zealand': 'NZL', 'Niger': 'NER', 'Nigeria': 'NGA',
+    'Norway': 'NOR', 'Oman': 'OMN', 'Pakistan': 'PAK', 'Palau': 'PLW', 'Panama': 'PAN',
+    'Papua New Guinea': 'PNG', 'Paraguay': 'PRY', 'Peru': 'PER', 'Philippines': 'PHL', 'Poland': 'POL',
+    'Portugal': 'PRT', 'Qatar': 'QAT', 'South Korea': 'KOR', 'Romania': 'ROU', 'Russia': 'RUS',
+    'Rwanda': 'RWA', 'Samoa': 'WSM', 'Sao Tome and Principe': 'STP', 'Saudi Arabia': 'SAU', 'Senegal': 'SEN',
+    'Serbia': 'SRB', 'Seychelles': 'SYC', 'Sierra Leone': 'SLE', 'Singapore': 'SGP', 'Slovakia': 'SVK',
+    'Slovenia': 'SVN', 'Solomon Islands': 'SLB', 'South Africa': 'ZAF', 'Spain': 'ESP', 'Sri Lanka': 'LKA',
+    'Sweden': 'SWE', 'Switzerland': 'CHE', 'Thailand': 'THA', 'Timor': 'TLS', 'Togo': 'TGO',
+    'Tonga': 'TON', 'Tunisia': 'TUN', 'Turkey': 'TUR', 'Turkmenistan': 'TKM', 'Tuvalu': 'TUV',
+    'Uganda': 'UGA', 'Ukraine': 'UKR', 'United Kingdom': 'GBR', 'United Republic of Tanzania': 'TZA',
+    'United States': 'USA', 'Uruguay': 'URY', 'Uzbekistan': 'UZB', 'Vanuatu': 'VUT', 'Vietnam': 'VNM',
+    'Yemen': 'YEM', 'Zambia': 'ZMB', 'Zimbabwe': 'ZWE', 'Angola': 'AGO', 'Antigua and Barbuda': 'ATG',
+    'Bhutan': 'BTN', 'Cabo Verde': 'CPV', 'Central African Republic': 'CAF', 'Cook Islands': 'COK',
+    'Djibouti': 'DJI', 'Dominica': 'DMA', 'Equatorial Guinea': 'GNQ', 'Gabon': 'GAB', 'Grenada': 'GRD',
+    'Guinea': 'GIN', 'Honduras': 'HND', 'Libya': 'LBY', 'Micronesia (Federated States of)': 'FSM', 'Monaco': 'MCO',
+    'Nicaragua': 'NIC', 'Niue': 'NIU', 'North Macedonia': 'MKD', 'Republic of Moldova': 'MDA',
+    'Saint Kitts and Nevis': 'KNA', 'Saint Lucia': 'LCA', 'Saint Vincent and the Grenadines': 'VCT',
+    'San Marino': 'SMR', 'Somalia': 'SOM', 'South Sudan': 'SSD', 'Sudan': 'SDN', 'Suriname': 'SUR',
+    'Syrian Arab Republic': 'SYR', 'Tajikistan': 'TJK', 'Trinidad and Tobago': 'TTO', 'United Arab Emirates': 'ARE',
+    'Venezuela (Bolivarian Republic of)': 'VEN',
+    # not WHO member states, but in the WHO mortality database
+    'French Guiana': 'GUF', 'Guadeloupe': 'GLP', 'Martinique': 'MTQ', 'Mayotte': 'MYT', 'Reunion': 'REU',
+    'Puerto Rico': 'PRI', 'Virgin Islands (USA)': 'VIR', 'Hong Kong SAR': 'HKG', 'Macao SAR': 'MAC',
+    'Occupied Palestinian Territory': 'PSE',
+}
+
+# other spellings in the WHO, GHO and UN data (the WHO/UN official names) and common short names
+COUNTRY_ALIASES: Dict[str, str] = {
+    'Bolivia (Plurinational State of)': 'BOL', 'Plurinational State of Bolivia': 'BOL',
+    'Brunei Darussalam': 'BRN',
+    'Cape Verde': 'CPV',
+    'Czech Republic': 'CZE',
+    "Democratic People's Republic of Korea": 'PRK', 'Korea, Dem. People\'s Rep.': 'PRK', 'DPR Korea': 'PRK',
+    'Republic of Korea': 'KOR', 'Korea, Rep.': 'KOR', 'Korea': 'KOR',
+    'DR Congo': 'COD', 'Congo, Dem. Rep.': 'COD', 'Republic of the Congo': 'COG', 'Congo, Rep.': 'COG',
+    "Côte d’Ivoire": 'CIV', 'Ivory Coast': 'CIV',
+    'Egypt, Arab Rep.': 'EGY',
+    'Swaziland': 'SWZ',
+    'Gambia, The': 'GMB',
+    'Iran (Islamic Republic of)': 'IRN', 'Iran, Islamic Rep.': 'IRN',
+    "Lao People's Democratic Republic": 'LAO', 'Lao PDR': 'LAO',
+    'Kyrgyz Republic': 'KGZ',
+    'Micronesia': 'FSM', 'Micronesia, Fed. Sts.': 'FSM',
+    'Republic of North Macedonia': 'MKD', 'The former Yugoslav Republic of Macedonia': 'MKD', 'Macedonia': 'MKD',
+    'Moldova': 'MDA',
+    'Netherlands (Kingdom of the)': 'NLD',
+    'Russian Federation': 'RUS',
+    'St. Kitts and Nevis': 'KNA', 'St. Lucia': 'LCA', 'St. Vincent and the Grenadines': 'VCT',
+    'Slovak Republic': 'SVK',
+    'Syria': 'SYR',
+    'Tanzania': 'TZA',
+    'Timor-Leste': 'TLS', 'East Timor': 'TLS',
+    'Türkiye': 'TUR',
+    'United Kingdom of Great Britain and Northern Ireland': 'GBR', 'UK': 'GBR',
+    'United States of America': 'USA', 'USA': 'USA',
+    'Venezuela': 'VEN', 'Venezuela, RB': 'VEN',
+    'Viet Nam': 'VNM',
+    'Yemen, Rep.': 'YEM',
+    'Réunion': 'REU',
+    'China, Hong Kong SAR': 'HKG', 'Hong Kong': 'HKG', 'China, Macao SAR': 'MAC', 'Macao': 'MAC',
+    'Palestine': 'PSE', 'State of Palestine': 'PSE',
+}
+
+# one categorical dtype for every source, so the codes of the same country are the same int everywhere
+COUNTRY_DTYPE = pd.CategoricalDtype(sorted(set(COUNTRY_CODES.values()) | set(COUNTRY_ALIASES.values())))
+
+# ISO3 --> name shown in the output (the first name of COUNTRY_CODES)
+_NAMES: Dict[str, str] = {}
+for _name, _code in COUNTRY_CODES.items():
+    _NAMES.setdefault(_code, _name)
+
+
+def _normalize(name: str) -> str:
+    """'Côte d’Ivoire' --> "cote d'ivoire" """
+    name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode()  # drop accents, \xa0 --> space
+    name = name.replace('’', "'").replace('`', "'")
+    return ' '.join(name.casefold().split())
+
+
+_INDEX: Dict[str, str] = {_normalize(name): code for name, code in {**COUNTRY_CODES, **COUNTRY_ALIASES}.items()}
+_INDEX.update({code.casefold(): code for code in COUNTRY_DTYPE.categories})  # a code resolves to itself
+
+
+def resolve_country(names: pd.Series) -> pd.Series:
+    """
+    ISO3 code of each country name, NaN if the name is unknown (see unresolved_countries)
+
+    :param names: e.g. df['Country Name'], categorical or str
+    :return: categorical series of COUNTRY_DTYPE, same index as names
+    """
+    categorical = names.astype('category')
+    categories = categorical.cat.categories
+    # only the unique names are looked up, then the rows are mapped by their category codes
+    codes = [_INDEX.get(_normalize(str(name))) for name in categories]
+    new_codes = np.append(COUNTRY_DTYPE.categories.get_indexer(pd.Index(codes, dtype=object)), -1)
+    row_codes = new_codes[categorical.cat.codes.to_numpy()]  # code -1 (NaN) --> the last one, -1
+    return pd.Series(pd.Categorical.from_codes(row_codes, dtype=COUNTRY_DTYPE), index=names.index, name=names.name)
+
+
+def country_name(codes: pd.Series) -> pd.Series:
+    """
+    :param codes: ISO3 codes, e.g. df['ISO3']
+    :return: name of the country in COUNTRY_CODES (str), NaN if the code is unknown
+    """
+    return codes.map(_NAMES).astype(object)
+
+
+def unresolved_countries(names: pd.Series) -> List[str]:
+    """
+    :param names: e.g. df['Country Name']
+    :return: the names which resolve_country can not map, add them to COUNTRY_ALIASES
+    """
+    unique = pd.Series(names.dropna().unique())
+    return sorted(unique[resolve_country(unique).isna()].astype(str))
+
+
+def add_country_code(df: pd.DataFrame, column: str = 'Country Name', code_column: str = 'ISO3') -> pd.DataFrame:
+    """
+    :param df: df
+    :param column: country name column
+    :param code_column: name of the new column, inserted after `column`
+    :return: copy of df with the ISO3 code column
+    """
+    df = df.drop(columns=code_column, errors='ignore')
+    df.insert(df.columns.get_loc(column) + 1, code_column, resolve_country(df[column]))
+    return df
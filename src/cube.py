@@ -0,0 +1,144 @@
+"""
+pre-aggregated cube of the merged panel (merge_df + merge_fctc_df output) for the dashboard and the notebooks
+
+the wide {Sex}_{indicator} columns of the panel are stacked into one fact table and the usual slices are computed once:
+
+- fact: one row per (ISO3, Year, Sex, Indicator) with a value, the missing values are left out
+- dim_country: ISO3, Country Name, WHO region, Signature, Ratification (the cohort) and Ratification Type
+- dim_indicator: Indicator, source, additive (its sum over countries means something, e.g. number of deaths)
+- rollup_region / rollup_cohort / rollup_sex: mean, sum and n (countries) by WHO region, by ratification cohort
+  (year of Ratification, <NA> if not ratified) or by sex, and year, sex, indicator
+- before_after: mean of the years before and after the ratification of each country, sex and indicator (the year of
+  ratification itself is neither, as in evaluate_correlation), change = after - before;
+  before_after_region: mean of them over the countries of a WHO region, n is the number of countries with both
+
+export_cube writes one columnar file per table (parquet, categoricals as dictionaries), load_cube reads them back.
+
+usage:
+    python pipeline.py --work-dir output --cube output/cube
+"""
+import re
+from pathlib import Path
+from typing import Union, Dict, List, Optional, Sequence
+import numpy as np
+import pandas as pd
+from storage import save_df, load_df
+from cache import cached_stage
+from instrument import traced
+from utility import MORTALITY_MEASURE_LABELS, MORTALITY_SEX_VALUES
+
+PathLike = Union[Path, str]
+
+__all__ = ['CUBE_TABLES', 'build_cube', 'export_cube', 'load_cube']
+
+CUBE_TABLES = ('fact', 'dim_country', 'dim_indicator', 'rollup_region', 'rollup_cohort', 'rollup_sex',
+               'before_after', 'before_after_region')
+
+COUNTRY_ATTRIBUTES = ['Country Name', 'Region Code', 'Region Name', 'Signature', 'Ratification', 'Ratification Type']
+ADDITIVE_INDICATORS = ('Number_of_Cause_Specific_Deaths', 'Total_Number_of_Deaths')
+
+
+def _stack(df: pd.DataFrame) -> pd.DataFrame:
+    """{Sex}_{indicator} columns --> (ISO3, Year, Sex, Indicator, value) rows, NaN values left out"""
+    pattern = re.compile(rf'^({"|".join(MORTALITY_SEX_VALUES)})_(.+)$')
+    measures = [(col,) + pattern.match(col).groups() for col in df.columns if pattern.match(col)]
+    indicators = list(dict.fromkeys(indicator for _, _, indicator in measures))
+
+    values = df[[col for col, _, _ in measures]].to_numpy(dtype=np.float64, na_value=np.nan)
+    values[(df['ISO3'].isna() | df['Year'].isna()).to_numpy()] = np.nan  # unresolved country name or no year
+    row, measure = np.nonzero(~np.isnan(values))
+    return pd.DataFrame({
+        'ISO3': pd.Categorical(df['ISO3'].take(row), dtype=df['ISO3'].dtype),
+        'Year': df['Year'].take(row).to_numpy(dtype=np.int16),
+        'Sex': pd.Categorical(np.array([sex for _, sex, _ in measures], dtype=object)[measure],
+                              categories=list(MORTALITY_SEX_VALUES)),
+        'Indicator': pd.Categorical(np.array([indicator for _, _, indicator in measures], dtype=object)[measure],
+                                    categories=indicators),
+        'value': values[row, measure],
+    })
+
+
+def _rollup(fact: pd.DataFrame, keys: List[str]) -> pd.DataFrame:
+    rollup = fact.groupby(keys, observed=True, dropna=False, sort=True)['value'].agg(['mean', 'sum', 'count'])
+    return rollup.rename(columns={'count': 'n'}).reset_index()
+
+
+@traced
+@cached_stage
+def build_cube(df: pd.DataFrame) -> Dict[str, pd.DataFrame]:
+    """
+    :param df: output of merge_fctc_df, needs 'ISO3', 'Year', COUNTRY_ATTRIBUTES and the {Sex}_{indicator} columns
+    :return: {table name: df}, see module docstring and CUBE_TABLES
+    """
+    fact = _stack(df).sort_values(['ISO3', 'Year', 'Sex', 'Indicator'], kind='stable').reset_index(drop=True)
+
+    dim_country = df.dropna(subset=['ISO3'])[['ISO3'] + COUNTRY_ATTRIBUTES]
+    dim_country = dim_country.groupby('ISO3', observed=True, sort=True).first().reset_index()  # first non-missing
+    dim_country.insert(dim_country.columns.get_loc('Ratification') + 1, 'Ratification Cohort',
+                       dim_country['Ratification'].astype('Int16'))
+    dim_indicator = pd.DataFrame({'Indicator': fact['Indicator'].cat.categories})
+    dim_indicator['source'] = np.where(dim_indicator['Indicator'].isin(list(MORTALITY_MEASURE_LABELS.values())),
+                                       'WHO Mortality Database', 'WHO Global Health Observatory')
+    dim_indicator['additive'] = dim_indicator['Indicator'].isin(ADDITIVE_INDICATORS)
+
+    # the country attributes on the fact rows, by the position of the ISO3 in dim_country
+    position = pd.Index(dim_country['ISO3']).get_indexer(fact['ISO3'])
+    attributes = dim_country[['Region Code', 'Region Name', 'Ratification Cohort']].take(position)
+    wide_fact = pd.concat([fact, attributes.reset_index(drop=True)], axis=1)
+
+    ratified = wide_fact['Ratification Cohort'].astype('float64')
+    period = pd.Series(np.select([wide_fact['Year'] < ratified, wide_fact['Year'] > ratified], ['before', 'after'],
+                                 default=''), index=wide_fact.index)
+    periods = wide_fact[period != ''].assign(Period=period[period != ''])
+    means = periods.groupby(['ISO3', 'Sex', 'Indicator', 'Period'], observed=True)['value'].agg(['mean', 'count'])
+    before_after = means.unstack('Period').reindex(columns=pd.MultiIndex.from_product([['mean', 'count'],
+                                                                                       ['before', 'after']]))
+    before_after.columns = ['mean_before', 'mean_after', 'n_before', 'n_after']
+    before_after[['n_before', 'n_after']] = before_after[['n_before', 'n_after']].fillna(0).astype('int64')
+    before_after['change'] = before_after['mean_after'] - before_after['mean_before']
+    before_after = before_after.reset_index()
+
+    region = dim_country.set_index('ISO3')[['Region Code', 'Region Name']].reindex(before_after['ISO3'])
+    before_after_region = (pd.concat([before_after, region.reset_index(drop=True)], axis=1)
+                           .groupby(['Region Code', 'Region Name', 'Sex', 'Indicator'], observed=True, dropna=False)
+                           .agg(mean_before=('mean_before', 'mean'), mean_after=('mean_after', 'mean'),
+                                change=('change', 'mean'), n=('change', 'count'))
+                           .reset_index())
+
+    return {
+        'fact': fact,
+        'dim_country': dim_country,
+        'dim_indicator': dim_indicator,
+        'rollup_region': _rollup(wide_fact, ['Region Code', 'Region Name', 'Year', 'Sex', 'Indicator']),
+        'rollup_cohort': _rollup(wide_fact, ['Ratification Cohort', 'Year', 'Sex', 'Indicator']),
+        'rollup_sex': _rollup(wide_fact, ['Sex', 'Year', 'Indicator']),
+        'before_after': before_after,
+        'before_after_region': before_after_region,
+    }
+
+
+def export_cube(cube: Dict[str, pd.DataFrame], directory: PathLike, suffix: str = '.parquet') -> List[Path]:
+    """
+    :param cube: output of build_cube
+    :param directory: one file per table is written into it, e.g. cube/rollup_region.parquet
+    :param suffix: columnar file type, '.parquet', '.feather' or '.arrow' (see storage.py)
+    :return: written files
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for name, table in cube.items():
+        paths.append(directory / f'{name}{suffix}')
+        save_df(table, paths[-1])
+    return paths
+
+
+def load_cube(directory: PathLike, tables: Optional[Sequence[str]] = None,
+              suffix: str = '.parquet') -> Dict[str, pd.DataFrame]:
+    """
+    :param directory: directory of export_cube
+    :param tables: tables to be read, default all CUBE_TABLES
+    :param suffix: the one of export_cube
+    :return: {table name: df}
+    """
+    return {name: load_df(Path(directory) / f'{name}{suffix}') for name in (tables or CUBE_TABLES)}
@@ -0,0 +1,87 @@
+"""
+diff of two releases of a raw table and patching of the tables aggregated from it
+
+- diff_release: rows added, removed or modified between the snapshot and the new release, matched by key
+  (e.g. Country Name, Year, Sex, Age Group); NaN equals NaN
+- affected_keys: the (country, year) pairs touched by the diff, only their aggregates have to be recomputed
+- patch_rows: replace the rows of the affected keys in a stored table by the recomputed ones
+"""
+from typing import Optional, List, Sequence
+import numpy as np
+import pandas as pd
+from merge import union_categories, align_missing_dtypes
+
+__all__ = ['MORTALITY_RELEASE_KEYS', 'TOBACCO_RELEASE_KEYS', 'diff_release', 'affected_keys', 'select_keys',
+           'patch_rows']
+
+MORTALITY_RELEASE_KEYS = ['Country Name', 'Year', 'Sex', 'Age Group']
+TOBACCO_RELEASE_KEYS = ['Location', 'Period', 'Indicator', 'Dim1']
+
+
+def _categorical_columns(df1: pd.DataFrame, df2: pd.DataFrame) -> List[str]:
+    return [col for col in df1.columns if col in df2.columns
+            and (isinstance(df1[col].dtype, pd.CategoricalDtype) or isinstance(df2[col].dtype, pd.CategoricalDtype))]
+
+
+def diff_release(old: pd.DataFrame, new: pd.DataFrame, keys: Sequence[str]) -> pd.DataFrame:
+    """
+    :param old: snapshot of the raw table (e.g. read_mortality output of the previous release)
+    :param new: new release of the same table
+    :param keys: columns identifying a row, e.g. MORTALITY_RELEASE_KEYS
+    :return: df, keys and 'change' ('added', 'removed' or 'modified') of each changed row
+    """
+    keys = list(keys)
+    values = [col for col in old.columns if col in new.columns and col not in keys]
+    old, new = union_categories(old[keys + values], new[keys + values], _categorical_columns(old, new))
+    # a key repeated in a release is matched by its occurrence
+    old = old.assign(_occurrence=old.groupby(keys, observed=True, dropna=False).cumcount())
+    new = new.assign(_occurrence=new.groupby(keys, observed=True, dropna=False).cumcount())
+
+    both = old.merge(new, on=keys + ['_occurrence'], how='outer', suffixes=(' (old)', ' (new)'), indicator=True)
+    equal = np.ones(len(both), dtype=bool)
+    for col in values:
+        a, b = both[f'{col} (old)'], both[f'{col} (new)']
+        equal &= ((a == b).fillna(False) | (a.isna() & b.isna())).to_numpy(dtype=bool)
+
+    change = np.select([both['_merge'] == 'right_only', both['_merge'] == 'left_only', ~equal],
+                       ['added', 'removed', 'modified'], default='')
+    changed = both.loc[change != '', keys].assign(change=change[change != ''])
+    return changed.reset_index(drop=True)
+
+
+def affected_keys(diff: pd.DataFrame, keys: Sequence[str]) -> pd.MultiIndex:
+    """
+    :param diff: output of diff_release
+    :param keys: key of the aggregated table, e.g. ['Country Name', 'Year']
+    :return: unique keys touched by the diff
+    """
+    return pd.MultiIndex.from_frame(diff[list(keys)].astype(object)).unique()
+
+
+def select_keys(df: pd.DataFrame, keys: Sequence[str], affected: pd.MultiIndex) -> pd.Series:
+    """
+    :return: bool mask of the rows of df whose keys are in `affected`
+    """
+    return pd.Series(pd.MultiIndex.from_frame(df[list(keys)].astype(object)).isin(affected), index=df.index)
+
+
+def patch_rows(old: pd.DataFrame, recomputed: pd.DataFrame, keys: Sequence[str],
+               affected: pd.MultiIndex, sort_by: Optional[Sequence[str]] = None) -> pd.DataFrame:
+    """
+    :param old: stored table, e.g. create_age_grouping output of the previous release
+    :param recomputed: the same table computed from the rows of the affected keys only
+    :param keys: columns of `affected`, e.g. ['Country Name', 'Year']
+    :param affected: output of affected_keys, the rows of these keys in `old` are replaced (or removed)
+    :param sort_by: order of the result, default keys
+    :return: df
+    """
+    kept = old[~select_keys(old, keys, affected)]
+    kept, recomputed = union_categories(kept, recomputed, _categorical_columns(kept, recomputed))
+    if len(kept) and len(recomputed):
+        kept = align_missing_dtypes(kept, recomputed)
+        patched = pd.concat([kept, align_missing_dtypes(recomputed, kept)], ignore_index=True)
+    else:  # concat of an empty df is deprecated
+        patched = recomputed if len(recomputed) else kept
+    # missing keys first, as in the sorted join of merge.merge_on_keys
+    patched = patched.sort_values(list(sort_by or keys), kind='stable', na_position='first')
+    return patched.reset_index(drop=True)
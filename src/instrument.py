@@ -0,0 +1,158 @@
+"""
+opt-in instrumentation of the preprocessing, analysis and plot functions
+
+Every call of a function decorated by `traced` is recorded while tracing is on:
+- wall time and CPU time (of the calling thread)
+- peak allocation during the call (tracemalloc, process wide: stages running concurrently in the pipeline overlap)
+- rows and memory usage of the DataFrame arguments and of the DataFrame result
+- nested calls (e.g. select_df in stream_age_grouping) are recorded with their depth
+
+Tracing is off by default, then the decorator only checks one flag. Enable it with enable_trace(), the environment
+variable FCTC_TRACE=trace.json (or .csv, written at exit) or `python pipeline.py --trace trace.json`.
+FCTC_PROFILE=stages.prof (or --profile) also dumps the cProfile stats of the traced calls, e.g. for snakeviz.
+"""
+import atexit
+import cProfile
+import functools
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Optional, Union, Callable, Any, Dict, List
+import pandas as pd
+from storage import save_df
+
+PathLike = Union[Path, str]
+
+__all__ = ['traced', 'enable_trace', 'disable_trace', 'trace_records', 'write_trace']
+
+_enabled: bool = False
+_profile: bool = False
+_records: List[Dict[str, Any]] = []
+_profiles: List[cProfile.Profile] = []
+_lock = threading.Lock()
+_local = threading.local()  # stack of the running traced calls of the thread
+_origin = time.perf_counter()
+
+
+def enable_trace(profile: bool = False) -> None:
+    """
+    :param profile: also run cProfile in the outermost traced calls, see write_trace
+    """
+    global _enabled, _profile
+    _enabled, _profile = True, profile
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable_trace() -> None:
+    global _enabled
+    _enabled = False
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def trace_records() -> pd.DataFrame:
+    """
+    :return: df, one row per traced call in the order they finished
+    """
+    with _lock:
+        return pd.DataFrame.from_records(list(_records))
+
+
+def write_trace(path: PathLike, profile_path: Optional[PathLike] = None) -> None:
+    """
+    :param path: .json (list of records) or any save_df format, e.g. .csv
+    :param profile_path: cProfile stats of the traced calls (pstats format)
+    """
+    path = Path(path)
+    if path.suffix.lower() == '.json':
+        with _lock:
+            path.write_text(json.dumps(_records, indent=2, default=str))
+    else:
+        save_df(trace_records(), path)
+    if profile_path is not None:
+        with _lock:
+            profiles = list(_profiles)
+        if profiles:
+            stats = pstats.Stats(profiles[0])
+            for profile in profiles[1:]:
+                stats.add(profile)
+            stats.dump_stats(profile_path)
+
+
+def _frame_stats(values) -> Dict[str, float]:
+    frames = [value for value in values if isinstance(value, (pd.DataFrame, pd.Series))]
+    return {'rows': sum(len(frame) for frame in frames),
+            'memory (MB)': sum(float(frame.memory_usage(deep=True).sum()) for frame in frames) / 1024 ** 2}
+
+
+def traced(func: Callable) -> Callable:
+    """
+    decorator, see module docstring
+    """
+    name = f'{func.__module__}.{func.__qualname__}'
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return func(*args, **kwargs)
+
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        inputs = _frame_stats(list(args) + list(kwargs.values()))
+
+        # tracemalloc has one peak: the peak of the caller so far is kept before it is reset for this call
+        current, peak = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (0, 0)
+        if stack:
+            stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        frame = {'start': current, 'peak': current}
+        stack.append(frame)
+
+        profile = cProfile.Profile() if _profile and len(stack) == 1 else None
+        start, cpu_start = time.perf_counter(), time.thread_time()
+        try:
+            if profile is not None:
+                profile.enable()
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                if profile is not None:
+                    profile.disable()
+        finally:
+            wall, cpu = time.perf_counter() - start, time.thread_time() - cpu_start
+            stack.pop()
+            peak = max(frame['peak'], tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else 0)
+            if stack:
+                stack[-1]['peak'] = max(stack[-1]['peak'], peak)  # the caller's peak includes this call
+
+        outputs = _frame_stats(result if isinstance(result, tuple) else (result,))
+        record = {'function': name,
+                  'depth': len(stack),
+                  'thread': threading.current_thread().name,
+                  'start (s)': start - _origin,
+                  'wall time (s)': wall,
+                  'cpu time (s)': cpu,
+                  'peak allocation (MB)': (peak - frame['start']) / 1024 ** 2,
+                  'input rows': inputs['rows'],
+                  'input memory (MB)': inputs['memory (MB)'],
+                  'output rows': outputs['rows'],
+                  'output memory (MB)': outputs['memory (MB)']}
+        with _lock:
+            _records.append(record)
+            if profile is not None:
+                _profiles.append(profile)
+        return result
+
+    return wrapper
+
+
+if os.environ.get('FCTC_TRACE') or os.environ.get('FCTC_PROFILE'):
+    enable_trace(profile=bool(os.environ.get('FCTC_PROFILE')))
+    atexit.register(write_trace, os.environ.get('FCTC_TRACE') or 'trace.json', os.environ.get('FCTC_PROFILE') or None)
@@ -0,0 +1,111 @@
+"""
+fast path loading of the raw sources
+
+- the mortality csv, the tobacco csv and the UN treaty xlsx are read concurrently in a thread pool (load_raw), the
+  csv tokenizer releases the GIL so the files are parsed while the others are read
+- explicit dtypes (schema.py) and column projection: only the columns kept by select_df / tobacco_layout_modified
+  are parsed, no type inference
+- the xlsx is read by calamine (Rust reader, pandas >= 2.2 with python-calamine installed), openpyxl otherwise
+- load_causes: the WHO Mortality Database exports one csv per cause of death, they are read at the same time into one
+  df with a 'Cause' column, which preprocess_cvd / create_age_grouping aggregate in one pass
+"""
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Union, Dict, List, Optional, Sequence
+import pandas as pd
+from schema import MORTALITY_SCHEMA, TOBACCO_SCHEMA, read_mortality, read_tobacco
+
+PathLike = Union[Path, str]
+
+__all__ = ['MORTALITY_COLUMNS', 'TOBACCO_COLUMNS', 'TREATY_COLUMNS', 'xlsx_engine', 'read_treaty', 'load_raw',
+           'load_causes']
+
+# columns dropped by select_df in the pipeline: 'Age group code', 'Unnamed: 12' and the age-standardized death rate
+# (empty in the WHO Mortality Database export)
+MORTALITY_COLUMNS: List[str] = [col for col in MORTALITY_SCHEMA
+                                if col not in ('Age group code',
+                                               'Age-standardized death rate per 100 000 standard population')]
+TOBACCO_COLUMNS: List[str] = list(TOBACCO_SCHEMA)
+TREATY_COLUMNS: List[str] = [
+    'Participant', 'Signature',
+    'Ratification, Acceptance(A), Approval(AA), Formal confirmation(c), Accession(a), Succession(d)']
+
+
+def xlsx_engine() -> Optional[str]:
+    """
+    :return: 'calamine' if pandas and python-calamine support it, None (pandas default, openpyxl) otherwise
+    """
+    major, minor = (int(part) for part in pd.__version__.split('.')[:2])
+    if (major, minor) >= (2, 2) and importlib.util.find_spec('python_calamine') is not None:
+        return 'calamine'
+    return None
+
+
+def read_treaty(file: PathLike, engine: Optional[str] = None, **kwargs) -> pd.DataFrame:
+    """
+    :param file: UN Signatures and Ratifications xlsx
+    :param engine: excel engine, default xlsx_engine()
+    :param kwargs: passed to pd.read_excel, e.g. usecols=TREATY_COLUMNS
+    :return: df, the dates as str ('29 06 2004 a') or datetime (date cells), both parsed by format_date
+    """
+    engine = engine or xlsx_engine()
+    if engine == 'calamine':
+        try:
+            return pd.read_excel(file, engine=engine, **kwargs)
+        except (ImportError, ValueError):  # python-calamine too old or missing in this environment
+            engine = None
+    return pd.read_excel(file, engine=engine, **kwargs)
+
+
+def load_raw(mortality: PathLike, tobacco: PathLike, treaty: PathLike, workers: int = 3) -> Dict[str, pd.DataFrame]:
+    """
+    read the three raw sources at the same time
+
+    :param mortality: WHO Mortality Database csv
+    :param tobacco: GHO prevalence of tobacco use csv
+    :param treaty: UN Signatures and Ratifications xlsx
+    :param workers: number of threads
+    :return: {'mortality_raw': df, 'tobacco_raw': df, 'treaty_raw': df}, the raw stages of pipeline.build_stages
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            'mortality_raw': pool.submit(read_mortality, mortality, usecols=MORTALITY_COLUMNS),
+            'tobacco_raw': pool.submit(read_tobacco, tobacco, usecols=TOBACCO_COLUMNS),
+            'treaty_raw': pool.submit(read_treaty, treaty, usecols=TREATY_COLUMNS),
+        }
+        return {name: future.result() for name, future in futures.items()}
+
+
+def _concat_categorical(frames: Sequence[pd.DataFrame]) -> pd.DataFrame:
+    """concat the df, the categorical columns stay categorical with the union of the categories (not object)"""
+    frames = list(frames)
+    for col in frames[0].columns:
+        if not all(isinstance(frame[col].dtype, pd.CategoricalDtype) for frame in frames):
+            continue
+        categories = frames[0][col].cat.categories
+        for frame in frames[1:]:
+            categories = categories.union(frame[col].cat.categories)
+        dtype = pd.CategoricalDtype(categories)
+        frames = [frame.assign(**{col: frame[col].astype(dtype)}) for frame in frames]
+    return pd.concat(frames, ignore_index=True)
+
+
+def load_causes(files: Dict[str, PathLike], workers: int = 4) -> pd.DataFrame:
+    """
+    read the mortality csv of several causes of death at the same time
+
+    :param files: {cause: WHO Mortality Database csv of the cause}, e.g. {'Ischaemic heart disease': ..., 'Stroke': ...}
+    :param workers: number of threads
+    :return: df like read_mortality with a categorical 'Cause' column after 'Year'
+    """
+    causes = pd.CategoricalDtype(list(files))
+
+    def read(cause: str, file: PathLike) -> pd.DataFrame:
+        df = read_mortality(file, usecols=MORTALITY_COLUMNS)
+        df.insert(df.columns.get_loc('Year') + 1, 'Cause', pd.Categorical([cause] * len(df), dtype=causes))
+        return df
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        frames = list(pool.map(read, files, files.values()))
+    return _concat_categorical(frames)
@@ -0,0 +1,106 @@
+"""
+merge layer of merge_df and merge_fctc_df
+
+- the two df are joined on a sorted index of the keys (e.g. Country Name, Year) instead of hashing the key columns
+- missing values stay real missing values: int columns become nullable Int (Int64, Int16...) instead of float,
+  float columns keep NaN, nothing is filled with a 'NaN' string (which turns a whole column into object)
+- the number of matched/unmatched keys is reported in df.attrs['merge_report']
+- a row with a missing key (e.g. the NaN ISO3 of a country name resolve_country does not know) never matches: it is
+  kept as a left-only or right-only row, and counted as one
+- a column in both df which is not a key (e.g. 'Country Name' when joining on 'ISO3') is kept once: the left value,
+  or the right one where the left is missing
+"""
+from typing import List, Tuple, Dict
+import numpy as np
+import pandas as pd
+
+__all__ = ['merge_on_keys', 'union_categories', 'align_missing_dtypes']
+
+
+def union_categories(df1: pd.DataFrame, df2: pd.DataFrame,
+                     columns: List[str]) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    give the key columns of both df the same categories, so merging them keeps the categorical dtype.
+    a key column that is categorical in one df only is made categorical in the other one too
+
+    :param df1: df
+    :param df2: df
+    :param columns: merge keys
+    :return: df1, df2
+    """
+    for col in columns:
+        dtype1, dtype2 = df1[col].dtype, df2[col].dtype
+        is_cat1, is_cat2 = isinstance(dtype1, pd.CategoricalDtype), isinstance(dtype2, pd.CategoricalDtype)
+        if not (is_cat1 or is_cat2) or dtype1 == dtype2:
+            continue
+        categories1 = dtype1.categories if is_cat1 else pd.Index(df1[col].dropna().unique())
+        categories2 = dtype2.categories if is_cat2 else pd.Index(df2[col].dropna().unique())
+        categories = categories1.union(categories2)
+        df1 = df1.assign(**{col: pd.Categorical(df1[col], categories=categories)})
+        df2 = df2.assign(**{col: pd.Categorical(df2[col], categories=categories)})
+    return df1, df2
+
+
+def _nullable_int(df: pd.DataFrame, keys: List[str]) -> pd.DataFrame:
+    """int columns (not the keys) --> nullable Int, so missing values after an outer join do not turn them into float"""
+    int_columns = {col: df[col].dtype.name.capitalize() for col in df.columns  # e.g. int16 --> Int16
+                   if col not in keys and isinstance(df[col].dtype, np.dtype) and df[col].dtype.kind in 'iu'}
+    if not int_columns:
+        return df
+    return df.astype(int_columns)
+
+
+def align_missing_dtypes(df: pd.DataFrame, like: pd.DataFrame) -> pd.DataFrame:
+    """
+    the all-NA columns of df get the dtype of the same column of `like` where it can hold NA, so concatenating them
+    does not depend on the deprecated exclusion of all-NA columns from the result dtype
+
+    :param df: df, e.g. the unmatched rows of one side reindexed to the merged columns
+    :param like: df with the wanted dtypes
+    :return: df
+    """
+    missing = {col: dtype for col, dtype in like.dtypes.items() if col in df.columns and dtype != df[col].dtype
+               and df[col].isna().all() and not (isinstance(dtype, np.dtype) and dtype.kind in 'biu')}
+    return df.astype(missing) if missing else df
+
+
+def merge_on_keys(left: pd.DataFrame, right: pd.DataFrame, keys: List[str], how: str = 'outer') -> pd.DataFrame:
+    """
+    join left and right on the sorted index of `keys`, see module docstring
+
+    :param left: df
+    :param right: df, the keys are unique in right if they are not unique in left
+    :param keys: e.g. ['Country Name', 'Year']
+    :param how: 'outer', 'inner', 'left' or 'right'
+    :return: df with the keys as the first columns, sorted by the keys (missing keys first).
+    df.attrs['merge_report']: {'matched': keys in both, 'left_only': ..., 'right_only': ...}, a row with a missing key
+    counts as one left_only/right_only key
+    """
+    overlap = [col for col in left.columns if col in right.columns and col not in keys]
+    left, right = union_categories(left, right, keys + overlap)
+    left, right = _nullable_int(left, keys), _nullable_int(right, keys)
+    # NaN keys would match each other in the join, e.g. an unresolved territory and 'European Union'
+    left_missing, right_missing = left[keys].isna().any(axis=1), right[keys].isna().any(axis=1)
+    left_unmatched, right_unmatched = left[left_missing], right[right_missing]
+    left = left[~left_missing].set_index(keys).sort_index()
+    right = right[~right_missing].set_index(keys).sort_index()
+
+    left_keys, right_keys = left.index.unique(), right.index.unique()
+    report: Dict[str, int] = {'matched': len(left_keys.intersection(right_keys)),
+                              'left_only': len(left_keys.difference(right_keys)) + len(left_unmatched),
+                              'right_only': len(right_keys.difference(left_keys)) + len(right_unmatched)}
+
+    merged = left.join(right, how=how, sort=True, rsuffix=' (right)')
+    for col in overlap:
+        merged[col] = merged[col].fillna(merged.pop(f'{col} (right)'))
+    merged = merged.reset_index()
+
+    sides = ((left_unmatched, 'left'), (right_unmatched, 'right'))
+    unmatched = [align_missing_dtypes(df.reindex(columns=merged.columns), merged)
+                 for df, side in sides if len(df) and how in ('outer', side)]
+    if unmatched:
+        frames = [frame for frame in [merged] + unmatched if len(frame)]  # concat of an empty df is deprecated
+        merged = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+        merged = merged.sort_values(keys, kind='stable', na_position='first').reset_index(drop=True)
+    merged.attrs['merge_report'] = report
+    return merged
@@ -0,0 +1,407 @@
+"""
+pipeline runner
+
+The steps in the docstrings of utility.py, WHOFCTC_parties_date.py and preprocess_plot.py declared as a DAG:
+
+    mortality_raw --> mortality_selected --> mortality_preprocessed --> cvd ---\\
+                                                                   \\--> asr
+    tobacco_raw --> tobacco ------------------------------------------------- all_df --\\
+    treaty_raw --> treaty -------------------------------------------------------------- fctc --> ratified --> correlation
+                                                                                          \\--> its
+
+- independent branches (mortality, tobacco, treaty) run concurrently in a thread pool
+- the output of each stage is kept in `work_dir` together with a fingerprint of its code, arguments, raw files and
+  upstream fingerprints; a rerun only executes the stages whose fingerprint changed and the ones downstream of them
+- wall time of each stage is reported at the end, --trace/--profile record each function call (see instrument.py)
+- --cube: the fctc panel is exported as a pre-aggregated cube for the dashboard (fact, dimension and rollup tables,
+  see cube.py)
+- --incremental: a new mortality/tobacco release is diffed against the stored raw snapshot, only the aggregates of the
+  changed (country, year) are recomputed and patched into cvd/asr/tobacco/all_df/fctc and the per-country statistics,
+  see run_incremental
+
+usage:
+    python pipeline.py --work-dir output --target ratified --export output/19_ratified_country.xlsx
+"""
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, Future, FIRST_COMPLETED, wait
+from pathlib import Path
+from typing import Optional, List, Union, Dict, Tuple, Callable, Any, NamedTuple
+import pandas as pd
+from utility import (select_df, preprocess_cvd, create_age_grouping, age_standardized_rate, tobacco_layout_modified,
+                     merge_df)
+from WHOFCTC_parties_date import format_date, merge_fctc_df
+from preprocess_plot import select_ratified_country
+from statistical_analysis import evaluate_correlation, segmented_regression
+from storage import save_df, load_df, export_panel
+from schema import read_mortality, read_tobacco
+from loader import MORTALITY_COLUMNS, TOBACCO_COLUMNS, TREATY_COLUMNS, read_treaty
+from cache import fingerprint, code_source
+from country import resolve_country
+from delta import (MORTALITY_RELEASE_KEYS, TOBACCO_RELEASE_KEYS, diff_release, affected_keys, select_keys,
+                   patch_rows)
+from instrument import enable_trace, write_trace
+from cube import build_cube, export_cube
+
+PathLike = Union[Path, str]
+
+__all__ = ['Stage', 'build_stages', 'run_pipeline', 'run_incremental', 'main']
+
+TEST_FILE = Path(__file__).resolve().parents[1] / 'test_file'
+STATE_FILE = 'pipeline_state.json'
+
+
+class Stage(NamedTuple):
+    """
+    func(*[output of inputs], **kwargs)
+    """
+    func: Callable
+    inputs: Tuple[str, ...] = ()
+    kwargs: Dict[str, Any] = {}
+
+
+def build_stages(mortality: PathLike = TEST_FILE / 'WHOMortalityDatabase_Deaths.csv',
+                 tobacco: PathLike = TEST_FILE / 'Estimate of current tobacco smoking prevalence(%)(age-standardized '
+                                                 'rate)_17 Jan 2022.csv',
+                 treaty: PathLike = TEST_FILE / 'Signatures and Ratifications- UN Treaty Section_08 Feb_2023.xlsx',
+                 year: int = 2000) -> Dict[str, Stage]:
+    """
+    :param mortality: WHO Mortality Database csv
+    :param tobacco: GHO prevalence of tobacco use csv
+    :param treaty: UN Signatures and Ratifications xlsx
+    :param year: pick up the data that larger than which year
+    :return: {stage name: Stage}
+    """
+    return {
+        # the raw stages are read at the same time, projected to the columns used downstream (see loader.py)
+        'mortality_raw': Stage(read_mortality, kwargs={'file': str(mortality), 'usecols': MORTALITY_COLUMNS}),
+        'mortality_selected': Stage(select_df, ('mortality_raw',), {
+            'year': year,
+            'drop_na': ['Number', 'Percentage of cause-specific deaths out of total deaths',
+                        'Death rate per 100 000 population']}),
+        'mortality_preprocessed': Stage(preprocess_cvd, ('mortality_selected',), {'drop_na': True}),
+        'cvd': Stage(create_age_grouping, ('mortality_preprocessed',)),
+        'asr': Stage(age_standardized_rate, ('mortality_preprocessed',)),
+
+        'tobacco_raw': Stage(read_tobacco, kwargs={'file': str(tobacco), 'usecols': TOBACCO_COLUMNS}),
+        'tobacco': Stage(tobacco_layout_modified, ('tobacco_raw',)),
+
+        'all_df': Stage(merge_df, ('cvd', 'tobacco'), {'column_name': ['ISO3', 'Year']}),
+
+        'treaty_raw': Stage(read_treaty, kwargs={'file': str(treaty), 'usecols': TREATY_COLUMNS}),
+        'treaty': Stage(format_date, ('treaty_raw',), {
+            'rename_mapping': {
+                'Participant': 'Country Name',
+                'Ratification, Acceptance(A), Approval(AA), Formal confirmation(c), Accession(a), Succession(d)':
+                    'Ratification'},
+            'formatted_date': ['Signature', 'Ratification']}),
+
+        'fctc': Stage(merge_fctc_df, ('all_df', 'treaty'), {'drop_na': True}),
+        'ratified': Stage(select_ratified_country, ('fctc',)),
+        'correlation': Stage(evaluate_correlation, ('ratified',)),
+        'its': Stage(segmented_regression, ('fctc',)),
+    }
+
+
+def _topological_order(stages: Dict[str, Stage]) -> List[str]:
+    order: List[str] = []
+    visiting = set()
+
+    def visit(name: str):
+        if name in order:
+            return
+        if name in visiting:
+            raise ValueError(f'cycle in the pipeline at {name!r}')
+        if name not in stages:
+            raise ValueError(f'{name!r} is not a stage, should be one of the {list(stages)}')
+        visiting.add(name)
+        for dep in stages[name].inputs:
+            visit(dep)
+        visiting.discard(name)
+        order.append(name)
+
+    for name in stages:
+        visit(name)
+    return order
+
+
+def _stage_fingerprints(stages: Dict[str, Stage], order: List[str],
+                        given: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    """
+    fingerprint of each stage: code (cache.code_source, with the helper modules), arguments (raw files by size/mtime)
+    and the fingerprints of its inputs. the fingerprints in `given` are taken as they are
+    """
+    fingerprints: Dict[str, str] = dict(given or {})
+    for name in order:
+        if name in fingerprints:
+            continue
+        stage = stages[name]
+        fingerprints[name] = fingerprint(code_source(stage.func), stage.kwargs,
+                                         [fingerprints[dep] for dep in stage.inputs])
+    return fingerprints
+
+
+def run_pipeline(stages: Dict[str, Stage],
+                 work_dir: PathLike,
+                 targets: Optional[List[str]] = None,
+                 workers: int = 4,
+                 force: bool = False,
+                 suffix: str = '.pkl') -> Tuple[Dict[str, Any], pd.DataFrame]:
+    """
+    run the stages needed by `targets`, see module docstring
+
+    :param stages: output of build_stages
+    :param work_dir: directory of the stage outputs and pipeline_state.json
+    :param targets: stages to be produced, None means the final stages (the ones no other stage depends on)
+    :param workers: number of threads
+    :param force: rerun every stage
+    :param suffix: file type of the stage outputs, see storage.save_df
+    :return: ({target: output}, report of each stage: status and wall time)
+    """
+    work_dir = Path(work_dir)
+    work_dir.mkdir(parents=True, exist_ok=True)
+    state_file = work_dir / STATE_FILE
+    state: Dict[str, str] = json.loads(state_file.read_text()) if state_file.exists() else {}
+
+    if targets is None:
+        targets = [name for name in stages if not any(name in stage.inputs for stage in stages.values())]
+    order = _topological_order(_needed(stages, targets))
+    fingerprints = _stage_fingerprints(stages, order)
+
+    def output_file(name: str) -> Path:
+        return work_dir / f'{name}{suffix}'
+
+    # stage to be executed: fingerprint changed, or any input is executed
+    execute = set()
+    for name in order:
+        if (force or state.get(name) != fingerprints[name] or not output_file(name).exists()
+                or any(dep in execute for dep in stages[name].inputs)):
+            execute.add(name)
+    # up-to-date stage is only loaded if a stage to be executed or a target needs it
+    wanted = set(targets) | {dep for name in execute for dep in stages[name].inputs}
+
+    results: Dict[str, Any] = {}
+    report: Dict[str, Dict[str, Any]] = {}
+
+    def work(name: str) -> Any:
+        start = time.perf_counter()
+        if name in execute:
+            result = stages[name].func(*[results[dep] for dep in stages[name].inputs], **stages[name].kwargs)
+            save_df(result, output_file(name))
+            status = 'run'
+        else:
+            result = load_df(output_file(name))
+            status = 'loaded'
+        report[name] = {'status': status, 'wall time (s)': time.perf_counter() - start}
+        return result
+
+    pending = [name for name in order if name in execute or name in wanted]
+    for name in order:
+        if name not in pending:
+            report[name] = {'status': 'up to date', 'wall time (s)': 0.0}
+
+    running: Dict[Future, str] = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            # a stage to be loaded is ready at once, a stage to be executed when all its inputs are there
+            ready = [name for name in pending
+                     if name not in execute or all(dep in results for dep in stages[name].inputs)]
+            for name in ready:
+                pending.remove(name)
+                running[pool.submit(work, name)] = name
+            if not running:
+                raise RuntimeError(f'stages {pending} can not be scheduled')
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                results[name] = future.result()  # raise the error of the stage
+                state[name] = fingerprints[name]
+                state_file.write_text(json.dumps(state, indent=2))
+
+    report_df = pd.DataFrame.from_dict(report, orient='index').reindex(order)
+    report_df.index.name = 'stage'
+    return {name: results[name] for name in targets}, report_df
+
+
+def _needed(stages: Dict[str, Stage], targets: List[str]) -> Dict[str, Stage]:
+    """targets and everything upstream of them"""
+    needed: Dict[str, Stage] = {}
+    todo = list(targets)
+    while todo:
+        name = todo.pop()
+        if name not in stages:
+            raise ValueError(f'{name!r} is not a stage, should be one of the {list(stages)}')
+        if name not in needed:
+            needed[name] = stages[name]
+            todo.extend(stages[name].inputs)
+    return needed
+
+
+def _run_stage(stages: Dict[str, Stage], name: str, *inputs: Any) -> Any:
+    return stages[name].func(*inputs, **stages[name].kwargs)
+
+
+def _run_part(stages: Dict[str, Stage], name: str, stored: pd.DataFrame, *parts: pd.DataFrame) -> pd.DataFrame:
+    """
+    run a stage on the rows of the affected keys. no row left (a removed key, or a year select_df filters out) --> the
+    stage is not run, no row is recomputed and patch_rows only drops the keys
+
+    :param stored: stored output of the stage, gives the columns of the empty result
+    """
+    if all(part.empty for part in parts):
+        return stored.iloc[:0]
+    return _run_stage(stages, name, *parts)
+
+
+def run_incremental(stages: Dict[str, Stage],
+                    work_dir: PathLike,
+                    suffix: str = '.pkl') -> Tuple[Dict[str, Any], pd.DataFrame]:
+    """
+    update the outputs of a previous run_pipeline (all stages of build_stages) to a new mortality and/or tobacco
+    release: the raw tables are diffed by key against the snapshot in `work_dir`, and only the rows of the changed
+    (country, year) are recomputed. Falls back to run_pipeline if there is no complete previous run, or if anything
+    else than the raw mortality/tobacco files changed (code, parameters, treaty sheet)
+
+    :param stages: output of build_stages
+    :param work_dir: work_dir of the previous run_pipeline
+    :param suffix: file type of the stage outputs
+    :return: ({stage: output}, delta report: source, Country Name, Year, change, rows)
+    """
+    work_dir = Path(work_dir)
+    state_file = work_dir / STATE_FILE
+    state: Dict[str, str] = json.loads(state_file.read_text()) if state_file.exists() else {}
+    order = _topological_order(stages)
+    raw = ['mortality_raw', 'tobacco_raw']
+
+    def output_file(name: str) -> Path:
+        return work_dir / f'{name}{suffix}'
+
+    # same code and parameters as the snapshot if the fingerprints match when the raw files are taken as unchanged
+    unchanged_raw = _stage_fingerprints(stages, order, given={name: state.get(name, '') for name in raw})
+    if (any(not output_file(name).exists() for name in order)
+            or any(state.get(name) != unchanged_raw[name] for name in order if name not in raw)):
+        results, _ = run_pipeline(stages, work_dir, targets=order, suffix=suffix)
+        return results, pd.DataFrame(columns=['source', 'Country Name', 'Year', 'change', 'rows'])
+
+    results = {name: load_df(output_file(name)) for name in order if name not in raw}
+    reports = []
+
+    # mortality: (Country Name, Year) --> cvd, asr
+    mortality = _run_stage(stages, 'mortality_raw')
+    diff = diff_release(load_df(output_file('mortality_raw')), mortality, MORTALITY_RELEASE_KEYS)
+    cvd_keys = affected_keys(diff, ['Country Name', 'Year'])
+    reports.append(diff[['Country Name', 'Year', 'change']].assign(source='mortality'))
+    if len(cvd_keys):
+        part = mortality[select_keys(mortality, ['Country Name', 'Year'], cvd_keys)]
+        for name in ('mortality_selected', 'mortality_preprocessed'):
+            part = _run_part(stages, name, results[name], part)
+        for name in ('cvd', 'asr'):
+            results[name] = patch_rows(results[name], _run_part(stages, name, results[name], part),
+                                       ['Country Name', 'Year'], cvd_keys)
+
+    # tobacco: (Location, Period) --> tobacco
+    tobacco = _run_stage(stages, 'tobacco_raw')
+    diff = diff_release(load_df(output_file('tobacco_raw')), tobacco, TOBACCO_RELEASE_KEYS)
+    tobacco_keys = affected_keys(diff, ['Location', 'Period'])
+    diff = diff.rename(columns={'Location': 'Country Name', 'Period': 'Year'})
+    reports.append(diff[['Country Name', 'Year', 'change']].assign(source='tobacco'))
+    if len(tobacco_keys):
+        part = tobacco[select_keys(tobacco, ['Location', 'Period'], tobacco_keys)]
+        results['tobacco'] = patch_rows(results['tobacco'], _run_part(stages, 'tobacco', results['tobacco'], part),
+                                        ['Country Name', 'Year'], tobacco_keys)
+
+    # merged panel: (ISO3, Year) of both sources
+    changed = pd.concat([pd.DataFrame({'ISO3': resolve_country(pd.Series(keys.get_level_values(0))).astype(object),
+                                       'Year': keys.get_level_values(1).astype(int)})
+                         for keys in (cvd_keys, tobacco_keys) if len(keys)]  # concat of an empty df is deprecated
+                        or [pd.DataFrame({'ISO3': pd.Series(dtype=object), 'Year': pd.Series(dtype=int)})],
+                        ignore_index=True)
+    panel_keys = affected_keys(changed, ['ISO3', 'Year'])
+    if len(panel_keys):
+        keys = ['ISO3', 'Year']
+        part = _run_part(stages, 'all_df', results['all_df'],
+                         results['cvd'][select_keys(results['cvd'], keys, panel_keys)],
+                         results['tobacco'][select_keys(results['tobacco'], keys, panel_keys)])
+        results['all_df'] = patch_rows(results['all_df'], part, keys, panel_keys)
+
+        # fctc and the statistics are per country
+        countries = affected_keys(changed, ['ISO3'])
+        part = _run_part(stages, 'fctc', results['fctc'],
+                         results['all_df'][select_keys(results['all_df'], ['ISO3'], countries)],
+                         results['treaty'][select_keys(results['treaty'], ['ISO3'], countries)])
+        results['fctc'] = patch_rows(results['fctc'], part, ['ISO3'], countries)
+        results['ratified'] = _run_stage(stages, 'ratified', results['fctc'])  # a filter, cheap
+
+        names = affected_keys(results['fctc'][select_keys(results['fctc'], ['ISO3'], countries)], ['Country Name'])
+        for name, source, sort_by in (('correlation', 'ratified', ['Country Name']),
+                                      ('its', 'fctc', ['Country Name', 'Sex', 'Outcome'])):
+            part = _run_part(stages, name, results[name],
+                             results[source][select_keys(results[source], ['Country Name'], names)])
+            results[name] = patch_rows(results[name], part, ['Country Name'], names, sort_by=sort_by)
+
+    for name in raw:
+        save_df({'mortality_raw': mortality, 'tobacco_raw': tobacco}[name], output_file(name))
+    for name in results:
+        save_df(results[name], output_file(name))
+    state.update(_stage_fingerprints(stages, order))
+    state_file.write_text(json.dumps(state, indent=2))
+
+    report = pd.concat([report for report in reports if len(report)] or reports[:1], ignore_index=True)
+    report = (report.groupby(['source', 'Country Name', 'Year', 'change'], observed=True).size()
+              .rename('rows').reset_index())
+    return results, report
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description='run the fctc_eval pipeline')
+    parser.add_argument('--mortality', type=Path, default=TEST_FILE / 'WHOMortalityDatabase_Deaths.csv')
+    parser.add_argument('--tobacco', type=Path,
+                        default=TEST_FILE / 'Estimate of current tobacco smoking prevalence(%)(age-standardized '
+                                            'rate)_17 Jan 2022.csv')
+    parser.add_argument('--treaty', type=Path,
+                        default=TEST_FILE / 'Signatures and Ratifications- UN Treaty Section_08 Feb_2023.xlsx')
+    parser.add_argument('--year', type=int, default=2000, help='pick up the data that larger than which year')
+    parser.add_argument('--work-dir', type=Path, default=Path('pipeline_output'), help='stage outputs')
+    parser.add_argument('--target', action='append', help='stage to be produced (repeatable), default the final one')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--force', action='store_true', help='rerun every stage')
+    parser.add_argument('--incremental', action='store_true',
+                        help='patch the outputs in --work-dir with the changes of new mortality/tobacco releases')
+    parser.add_argument('--export', type=Path, help='export the last target, e.g. 19_ratified_country.xlsx')
+    parser.add_argument('--panel', type=Path,
+                        help='export the last target as memory-mappable Arrow file with .parquet/.csv companions, '
+                             'e.g. 19_ratified_country.arrow')
+    parser.add_argument('--cube', type=Path,
+                        help='export the fctc panel as pre-aggregated cube, one parquet file per table, '
+                             'e.g. output/cube')
+    parser.add_argument('--trace', type=Path, help='record each function call, e.g. trace.json or trace.csv')
+    parser.add_argument('--profile', type=Path, help='cProfile stats of the traced calls, e.g. pipeline.prof')
+    args = parser.parse_args(argv)
+
+    if args.trace is not None or args.profile is not None:
+        enable_trace(profile=args.profile is not None)
+    start = time.perf_counter()
+    stages = build_stages(args.mortality, args.tobacco, args.treaty, args.year)
+    if args.incremental:
+        results, report = run_incremental(stages, args.work_dir)  # report: the changed countries/years
+        save_df(report, args.work_dir / 'delta_report.csv')
+        results = {name: results[name] for name in args.target or ['asr', 'correlation', 'its']}
+    else:
+        results, report = run_pipeline(stages, args.work_dir, targets=args.target, workers=args.workers,
+                                       force=args.force)
+    if args.export is not None:
+        save_df(results[list(results)[-1]], args.export)
+    if args.panel is not None:
+        export_panel(results[list(results)[-1]], args.panel)
+    if args.cube is not None:
+        fctc = results['fctc'] if 'fctc' in results else load_df(args.work_dir / 'fctc.pkl')
+        export_cube(build_cube(fctc), args.cube)
+    print(report.to_string(float_format='{:.3f}'.format))
+    print(f'total wall time (s): {time.perf_counter() - start:.3f}')
+    if args.trace is not None or args.profile is not None:
+        write_trace(args.trace or args.work_dir / 'trace.json', args.profile)
+
+
+if __name__ == '__main__':
+    main()
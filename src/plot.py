@@ -2,14 +2,102 @@
 pipeline
 
 """
+import math
+import os
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, Future
+from itertools import repeat
 from pathlib import Path
-from typing import Union, Tuple, Optional, List
+from typing import Union, Tuple, Optional, List, Dict, Callable, Iterator, Iterable, Deque
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.figure import Figure
+import numpy as np
 import pandas as pd
+from instrument import traced
 
 PathLike = Union[Path, str]
 
 
+def _country_index(df: pd.DataFrame) -> Dict[str, pd.DataFrame]:
+    """
+    country --> its rows, built once by a stable sort and the offsets where the country changes, so a panel reads its
+    slice instead of comparing 'Country Name' over the whole df
+
+    :param df: df
+    :return: {country: rows of the country}, in the order of the sorted country names
+    """
+    names = df['Country Name'].astype(str).to_numpy()
+    order = np.argsort(names, kind='stable')
+    sorted_df = df.iloc[order]
+    sorted_names = names[order]
+    starts = np.flatnonzero(np.r_[True, sorted_names[1:] != sorted_names[:-1]]) if len(names) else np.array([], int)
+    ends = np.r_[starts[1:], len(names)]
+    return {sorted_names[start]: sorted_df.iloc[start:end] for start, end in zip(starts, ends)}
+
+
+def _year_axis(df: pd.DataFrame) -> Tuple[Tuple[int, int], np.ndarray]:
+    """x-axis shared by every panel: (min year, max year) and the ticks, computed once"""
+    return (df['Year'].min(), df['Year'].max()), df['Year'].unique()
+
+
+def _plot_country(ax, country: str, country_df: pd.DataFrame, column1: str, column2: str,
+                  year_range: Tuple[int, int], year_ticks: np.ndarray):
+    """
+    one panel of plot_line_chart: Male/Female lines of a country with the annotation of its ratification year
+
+    :param ax: Axes
+    :param country: country name
+    :param country_df: rows of the country
+    :param column1: Male column
+    :param column2: Female column
+    :param year_range: x-axis limits, the same in every panel (see _year_axis)
+    :param year_ticks: x-axis ticks (see _year_axis)
+    """
+    treaty_label = 'FCTC'
+
+    # Plot Male and Female CVD mortality rates
+    ax.plot(country_df['Year'], country_df[column1], color='tab:blue', label='Male')
+    ax.plot(country_df['Year'], country_df[column2], color='tab:red', label='Female')
+
+    # Set title and labels
+    ax.set(title=country, xlabel='Year', ylabel='Proportionate CVD mortality (%)')
+    ax.set_ylim([0, 80])
+    ax.set_xlim(list(year_range))
+    ax.set_xticks(year_ticks)
+    ax.grid(True)
+    ax.legend()
+
+    # Add vertical line and annotation for Ratification year
+    try:
+        treaty_year = country_df['Ratification'].values[0]
+        if not pd.isnull(treaty_year):
+            ax.axvline(x=treaty_year, ymin=0, ymax=0.9, color='black', linestyle='--')
+            ax.annotate(
+                treaty_label,
+                xy=(treaty_year, ax.get_ylim()[1]),
+                xytext=(2, -5),
+                textcoords='offset points',
+                ha='center',
+                va='top',
+                rotation=0
+            )
+            ax.annotate(
+                str(treaty_year),
+                xy=(treaty_year, ax.get_ylim()[1]),
+                xytext=(2, -15),
+                textcoords='offset points',
+                ha='center',
+                va='top',
+                rotation=0
+            )
+    except IndexError:
+        print(f"No Ratification year available for {country}")
+
+
+@traced
 def plot_line_chart(df, column1: str, column2: str,
                     save_path: PathLike = True, nrows=5, ncols=4, figsize=(20, 20), dpi=200):
     """
@@ -29,67 +117,20 @@ def plot_line_chart(df, column1: str, column2: str,
     # Filter DataFrame to exclude unwanted years
     df = df[(df['Year'] != 2018) & (df['Year'] != 2019)]
 
-    # Get sorted list of unique countries
-    countries = sorted(df['Country Name'].unique())
+    # rows of each country, in the order of the sorted country names
+    index = _country_index(df)
+    year_range, year_ticks = _year_axis(df)
 
     # Create subplots
     fig, axs = plt.subplots(nrows=nrows, ncols=ncols, figsize=figsize, dpi=dpi)
     axs = axs.flatten()  # Flatten the axes array for easy iteration
 
     # Iterate over countries and create plots
-    for i, country in enumerate(countries):
-        ax = axs[i]
-        treaty_label = 'FCTC'
-
-        # Plot Male and Female CVD mortality rates
-        ax.plot(
-            df.loc[df['Country Name'] == country, 'Year'],
-            df.loc[df['Country Name'] == country, column1],
-            color='tab:blue', label='Male'
-        )
-        ax.plot(
-            df.loc[df['Country Name'] == country, 'Year'],
-            df.loc[
-                df['Country Name'] == country, column2],
-            color='tab:red', label='Female'
-        )
-
-        # Set title and labels
-        ax.set(title=country, xlabel='Year', ylabel='Proportionate CVD mortality (%)')
-        ax.set_ylim([0, 80])
-        ax.set_xlim([min(df['Year']), max(df['Year'])])
-        ax.set_xticks(df['Year'].unique())
-        ax.grid(True)
-        ax.legend()
-
-        # Add vertical line and annotation for Ratification year
-        try:
-            treaty_year = df.loc[df['Country Name'] == country, 'Ratification'].values[0]
-            if not pd.isnull(treaty_year):
-                ax.axvline(x=treaty_year, ymin=0, ymax=0.9, color='black', linestyle='--')
-                ax.annotate(
-                    treaty_label,
-                    xy=(treaty_year, ax.get_ylim()[1]),
-                    xytext=(2, -5),
-                    textcoords='offset points',
-                    ha='center',
-                    va='top',
-                    rotation=0
-                )
-                ax.annotate(
-                    str(treaty_year),
-                    xy=(treaty_year, ax.get_ylim()[1]),
-                    xytext=(2, -15),
-                    textcoords='offset points',
-                    ha='center',
-                    va='top',
-                    rotation=0
-                )
-        except IndexError:
-            print(f"No Ratification year available for {country}")
+    for ax, (country, country_df) in zip(axs, index.items()):
+        _plot_country(ax, country, country_df, column1, column2, year_range, year_ticks)
 
     # Hide unused subplots
-    for j in range(len(countries), len(axs)):
+    for j in range(len(index), len(axs)):
         axs[j].axis('off')
 
     # Adjust layout and save the plot
@@ -100,6 +141,142 @@ def plot_line_chart(df, column1: str, column2: str,
     plt.close()
 
 
+def _render_line_chart_page(page: List[Tuple[str, pd.DataFrame]], column1: str, column2: str,
+                            year_axis: Tuple[Tuple[int, int], np.ndarray], ncols: int, panel_size: Tuple[float, float], dpi: int,
+                            save_path: Optional[Path]) -> Optional[Figure]:
+    """
+    worker of plot_line_chart_pages: render one page off-screen (Agg, no pyplot)
+
+    :param page: [(country, rows of the country)]
+    :param save_path: png path, None means return the figure (pickled back to the parent, which writes it as a vector
+    pdf page)
+    """
+    ncols = min(ncols, len(page))
+    nrows = math.ceil(len(page) / ncols)
+    fig = Figure(figsize=(panel_size[0] * ncols, panel_size[1] * nrows), dpi=dpi)
+    FigureCanvasAgg(fig)  # off-screen canvas, no pyplot
+    axs = np.atleast_1d(fig.subplots(nrows=nrows, ncols=ncols)).flatten()
+    for ax, (country, country_df) in zip(axs, page):
+        _plot_country(ax, country, country_df, column1, column2, *year_axis)
+    for ax in axs[len(page):]:
+        ax.axis('off')
+    fig.tight_layout()
+    if save_path is not None:
+        fig.savefig(save_path)  # tight_layout is done, bbox_inches='tight' would draw the page once more
+        return None
+    return fig
+
+
+@traced
+def plot_line_chart_pages(df: pd.DataFrame, column1: str, column2: str,
+                          output: PathLike,
+                          countries_per_page: int = 1,
+                          ncols: int = 4,
+                          panel_size: Tuple[float, float] = (5, 4),
+                          dpi: int = 100,
+                          workers: Optional[int] = None) -> List[Path]:
+    """
+    Same panels as plot_line_chart, but one figure per country (or per page of `countries_per_page` countries), so
+    it is not limited to nrows*ncols countries. The pages are rendered off-screen by a process pool, each worker only
+    gets the rows of the countries on its page. plt.show() is never called. The pages of a pdf are laid out by the
+    workers and drawn into the pdf by this process, so they stay vector graphics.
+
+    :param df: test file: 19_ratified_country.xlsx
+    :param column1: see plot_line_chart
+    :param column2: see plot_line_chart
+    :param output: directory for one png per page ({country}.png, or page_001.png, ... if countries_per_page > 1),
+    or a .pdf file for a multi-page pdf
+    :param countries_per_page: number of countries in a page
+    :param ncols: number of countries in a row of a page
+    :param panel_size: size of each country panel (inch)
+    :param dpi: dpi
+    :param workers: number of processes, default is the number of CPUs
+    :return: written files
+    """
+    output = Path(output)
+    df = df[(df['Year'] != 2018) & (df['Year'] != 2019)]
+    year_axis = _year_axis(df)
+    groups = list(_country_index(df).items())
+    pages = [groups[i:i + countries_per_page] for i in range(0, len(groups), countries_per_page)]
+
+    to_pdf = output.suffix.lower() == '.pdf'
+    if to_pdf:
+        output.parent.mkdir(parents=True, exist_ok=True)
+        save_paths = [None] * len(pages)
+    else:
+        output.mkdir(parents=True, exist_ok=True)
+        save_paths = [output / (f'{_file_name(page[0][0])}.png' if countries_per_page == 1 else f'page_{i + 1:03d}.png')
+                      for i, page in enumerate(pages)]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        figures = _bounded_map(pool, workers, _render_line_chart_page, pages, repeat(column1), repeat(column2),
+                               repeat(year_axis), repeat(ncols), repeat(panel_size), repeat(dpi), save_paths)
+        if not to_pdf:
+            list(figures)  # raise the error of the workers
+            return save_paths
+        _write_pdf(figures, output)
+    return [output]
+
+
+def _bounded_map(pool: ProcessPoolExecutor, workers: Optional[int], func: Callable, *iterables) -> Iterator:
+    """
+    like pool.map, but at most 2 tasks per worker are submitted ahead, so rendered pages that are not written yet
+    do not pile up in memory
+    """
+    window = 2 * (workers or os.cpu_count() or 1)
+    pending: Deque[Future] = deque()
+    for args in zip(*iterables):
+        pending.append(pool.submit(func, *args))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _write_pdf(figures: Iterable[Figure], output: Path):
+    """write the figures to a multi-page pdf (vector pages), in order, as soon as each one is rendered"""
+    with PdfPages(output) as pdf:
+        for fig in figures:
+            pdf.savefig(fig)
+
+
+def _file_name(country: str) -> str:
+    return re.sub(r'[^\w\-]+', '_', country).strip('_')
+
+
+def _plot_relationship(fig, country: str, country_df: pd.DataFrame,
+                       variable_1: str, variable_2: str, variable_3: str, variable_4: str):
+    """
+    male (top) and female (bottom) Prevalence of Tobacco Use & CVD Mortality of a country, see relationship_cvd_tobacco
+
+    :param fig: Figure
+    :param country: country name
+    :param country_df: rows of the country
+    """
+    years = country_df['Year'].astype(str)  # categorical x-axis, the caller's df is not modified
+    # create 2 subplots
+    ax1, ax2 = fig.subplots(2, 1)
+    # plot variable_1 and variable_2 on the first subplot for males data
+    ax1.plot(years, country_df[variable_1], color='b')
+    ax1.plot(years, country_df[variable_2], color='r')
+    ax1.set_xlabel('Year')
+    ax1.set_ylabel('Prevalence of Tobacco Use & CVD Mortality', color='k')
+    ax1.tick_params(axis='y', labelcolor='k')
+    ax1.legend(['Prevalence of Tobacco Use in Males (%)', 'CVD Mortality in Males (%)'], loc='upper left')
+    # plot variable_3 and variable_4 on the second subplot for females data
+    ax2.plot(years, country_df[variable_3], color='g')
+    ax2.plot(years, country_df[variable_4], color='m')
+    ax2.set_xlabel('Year')
+    ax2.set_ylabel('Prevalence of Tobacco Use & CVD Mortality', color='k')
+    ax2.tick_params(axis='y', labelcolor='k')
+    ax2.legend(['Prevalence of Tobacco Use in Females (%)', 'CVD Mortality in Females (%)'], loc='upper left')
+    ax2.set_xticks(years)
+    # set titles and axis labels for the figure
+    fig.suptitle(f'{country}')
+    fig.tight_layout()
+
+
+@traced
 def relationship_cvd_tobacco(df: pd.DataFrame,
                              select_country: Optional[List[str]] = None,
                              variable_1: Optional[str] = None,
@@ -109,6 +286,7 @@ def relationship_cvd_tobacco(df: pd.DataFrame,
                              save_path: PathLike = True):
     """
     Data visualisation between CVD Mortality and Prevalence of Tobacco Use in both Males and Females in each country
+    (one figure per country, the last one is saved; use relationship_cvd_tobacco_report to save every country)
     :param df:test file: 19_ratified_country.xlsx
     :param select_country: either run all countries or specify the country name.
      for example, ['Netherlands'] or df['Country Name'].unique()
@@ -118,35 +296,88 @@ def relationship_cvd_tobacco(df: pd.DataFrame,
     :param variable_4:'Female_Total_Percentage_of_Cause_Specific_Deaths_Out_Of_Total_Deaths'
     :param save_path: output path
     """
-    # convert 'Year' column to string type
-    df['Year'] = df['Year'].astype(str)
     # filter by selected countries
     if select_country is not None:
+        index = _country_index(df)
+        figures = []
         for country in select_country:
-            country_df = df[df['Country Name'] == country]
-            # create a new figure with 2 subplots
-            fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(8, 8))
-            # plot variable_1 and variable_2 on the first subplot for males data
-            ax1.plot(country_df['Year'], country_df[variable_1], color='b')
-            ax1.plot(country_df['Year'], country_df[variable_2], color='r')
-            ax1.set_xlabel('Year')
-            ax1.set_ylabel('Prevalence of Tobacco Use & CVD Mortality', color='k')
-            ax1.tick_params(axis='y', labelcolor='k')
-            ax1.legend(['Prevalence of Tobacco Use in Males (%)', 'CVD Mortality in Males (%)'], loc='upper left')
-            # plot variable_3 and variable_4 on the second subplot for females data
-            ax2.plot(country_df['Year'], country_df[variable_3], color='g')
-            ax2.plot(country_df['Year'], country_df[variable_4], color='m')
-            ax2.set_xlabel('Year')
-            ax2.set_ylabel('Prevalence of Tobacco Use & CVD Mortality', color='k')
-            ax2.tick_params(axis='y', labelcolor='k')
-            ax2.legend(['Prevalence of Tobacco Use in Females (%)', 'CVD Mortality in Females (%)'], loc='upper left')
-            # set titles and axis labels for the figure
-            plt.suptitle(f'{country}')
-            plt.xticks(country_df['Year'])
-
-        # Adjust layout and save the plot
-        plt.tight_layout()
-        if save_path:
-            plt.savefig(save_path, bbox_inches='tight')
+            # create a new figure for each country
+            fig = plt.figure(figsize=(8, 8))
+            _plot_relationship(fig, country, index.get(country, df.iloc[:0]),
+                               variable_1, variable_2, variable_3, variable_4)
+            figures.append(fig)
+
+        # save the plot
+        if save_path and figures:
+            figures[-1].savefig(save_path, bbox_inches='tight')
         plt.show()
-        plt.close()
+        for fig in figures:  # close every figure, not only the last one
+            plt.close(fig)
+
+
+def _render_relationship(country: str, country_df: pd.DataFrame, variables: Tuple[str, str, str, str],
+                         dpi: int, save_path: Optional[Path]) -> Optional[Figure]:
+    """
+    worker of relationship_cvd_tobacco_report: render one country off-screen (Agg, no pyplot)
+
+    :param save_path: png path, None means return the figure (pickled back to the parent, which writes it as a vector
+    pdf page)
+    """
+    fig = Figure(figsize=(8, 8), dpi=dpi)
+    FigureCanvasAgg(fig)  # off-screen canvas, no pyplot
+    _plot_relationship(fig, country, country_df, *variables)
+    if save_path is not None:
+        fig.savefig(save_path)
+        return None
+    return fig
+
+
+@traced
+def relationship_cvd_tobacco_report(df: pd.DataFrame,
+                                    output: PathLike,
+                                    select_country: Optional[List[str]] = None,
+                                    variable_1: str = 'Male_Estimate_of_Current_Tobacco_Use_Prevalence_age_standardized_rate',
+                                    variable_2: str = 'Male_Total_Percentage_of_Cause_Specific_Deaths_Out_Of_Total_Deaths',
+                                    variable_3: str = 'Female_Estimate_of_Current_Tobacco_Use_Prevalence_age_standardized_rate',
+                                    variable_4: str = 'Female_Total_Percentage_of_Cause_Specific_Deaths_Out_Of_Total_Deaths',
+                                    dpi: int = 100,
+                                    workers: Optional[int] = None) -> List[Path]:
+    """
+    Batch version of relationship_cvd_tobacco: every selected country is rendered off-screen by a process pool and
+    written as soon as it is done, one page of a pdf or one png per country. Only a few figures exist at once, so the
+    memory does not grow with the number of countries. The pdf pages are drawn by this process from the figures of
+    the workers, so they stay vector graphics.
+
+    :param df: test file: 19_ratified_country.xlsx
+    :param output: directory for {country}.png, or a .pdf file for a multi-page pdf
+    :param select_country: countries, None means every country in df
+    :param variable_1: see relationship_cvd_tobacco
+    :param variable_2: see relationship_cvd_tobacco
+    :param variable_3: see relationship_cvd_tobacco
+    :param variable_4: see relationship_cvd_tobacco
+    :param dpi: dpi
+    :param workers: number of processes, default is the number of CPUs
+    :return: written files
+    """
+    output = Path(output)
+    index = _country_index(df)
+    countries = list(index) if select_country is None else list(select_country)
+    slices = [index.get(country, df.iloc[:0]) for country in countries]
+    variables = (variable_1, variable_2, variable_3, variable_4)
+
+    to_pdf = output.suffix.lower() == '.pdf'
+    if to_pdf:
+        output.parent.mkdir(parents=True, exist_ok=True)
+        save_paths = [None] * len(countries)
+    else:
+        output.mkdir(parents=True, exist_ok=True)
+        save_paths = [output / f'{_file_name(country)}.png' for country in countries]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        figures = _bounded_map(pool, workers, _render_relationship, countries, slices, repeat(variables),
+                               repeat(dpi), save_paths)
+        if not to_pdf:
+            list(figures)  # raise the error of the workers
+            return save_paths
+        _write_pdf(figures, output)
+    return [output]
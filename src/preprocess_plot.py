@@ -6,6 +6,7 @@ from pathlib import Path
 from typing import Optional, List, Union
 import pandas as pd
 from selected_countries import selected_19_countries
+from storage import save_df
 
 PathLike = Union[Path, str]
 __all__ = ['consistent_year', 'select_ratified_country']
@@ -27,7 +28,7 @@ def consistent_year(df: pd.DataFrame,
         interval_df = interval_df[mask]  # select rows that are not excluded by the mask
     interval_df = interval_df.reset_index(drop=True)
     if save_path is not None:
-        interval_df.to_excel(save_path)
+        save_df(interval_df, save_path, index=True)
     return interval_df
 
 
@@ -45,5 +46,5 @@ def select_ratified_country(df: pd.DataFrame, output_path: PathLike = None) -> p
     selected_19_df = df[df.isin(selected_19_countries).any(axis=1)].dropna(how='all')
 
     if output_path is not None:
-        selected_19_df.to_excel(output_path, index=False)
+        save_df(selected_19_df, output_path)
     return selected_19_df
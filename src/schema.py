@@ -0,0 +1,71 @@
+"""
+typed loading schema of the raw sources
+
+dimensions are loaded as categoricals, Year as the smallest fitting int and measures as float32 where the precision
+allows, instead of object strings and float64 repeated in every row.
+'Number' and 'Percentage of cause-specific deaths out of total deaths' stay float64: 'Total Number of Deaths' is
+derived from them and truncated to int in preprocess_cvd, where float32 rounding would move it by one.
+The country names are resolved to the 'ISO3' code column at load time (see country.py), the merges join on it.
+"""
+from pathlib import Path
+from typing import Union, Dict, Iterator
+import pandas as pd
+from country import add_country_code
+
+PathLike = Union[Path, str]
+
+__all__ = ['MORTALITY_SCHEMA', 'TOBACCO_SCHEMA', 'read_mortality', 'read_tobacco']
+
+MORTALITY_SCHEMA: Dict[str, str] = {
+    'Region Code': 'category',
+    'Region Name': 'category',
+    'Country Code': 'category',
+    'Country Name': 'category',
+    'Year': 'int16',
+    'Sex': 'category',
+    'Age group code': 'category',
+    'Age Group': 'category',
+    'Number': 'float64',
+    'Percentage of cause-specific deaths out of total deaths': 'float64',
+    'Age-standardized death rate per 100 000 standard population': 'float32',
+    'Death rate per 100 000 population': 'float32',
+}
+
+TOBACCO_SCHEMA: Dict[str, str] = {
+    'Location': 'category',
+    'Period': 'int16',
+    'Indicator': 'category',
+    'Dim1': 'category',
+    'First Tooltip': 'float32',
+}
+
+
+def _with_code(df: pd.DataFrame, column: str) -> pd.DataFrame:
+    return add_country_code(df, column) if column in df.columns else df  # not if usecols leaves the names out
+
+
+def _chunks_with_code(reader, column: str) -> Iterator[pd.DataFrame]:
+    with reader:
+        for chunk in reader:
+            yield _with_code(chunk, column)
+
+
+def read_mortality(file: PathLike, **kwargs) -> pd.DataFrame:
+    """
+    :param file: WHOMortalityDatabase_Deaths.csv format file
+    :param kwargs: passed to pd.read_csv, e.g. usecols or chunksize
+    :return: df with 'ISO3' after 'Country Name' (or iterator of df chunks if chunksize is set)
+    """
+    df = pd.read_csv(file, dtype=MORTALITY_SCHEMA, **kwargs)
+    if kwargs.get('chunksize') is not None:
+        return _chunks_with_code(df, 'Country Name')
+    return _with_code(df, 'Country Name')
+
+
+def read_tobacco(file: PathLike, **kwargs) -> pd.DataFrame:
+    """
+    :param file: GHO prevalence of tobacco use csv
+    :param kwargs: passed to pd.read_csv
+    :return: df with 'ISO3' after 'Location'
+    """
+    return _with_code(pd.read_csv(file, dtype=TOBACCO_SCHEMA, **kwargs), 'Location')
@@ -0,0 +1,339 @@
+"""
+local query API over the processed panel (merge_fctc_df / select_ratified_country output, e.g. 19_ratified_country)
+
+the panel is loaded once and kept in memory as the fact table of cube.build_cube (one row per country, year, sex and
+indicator) together with its rollups and the evaluate_correlation statistics; every query is a filter of them.
+
+- GET /panel?country=Netherlands&country=FRA&year_from=2005&year_to=2015&sex=Female&indicator=...
+- GET /correlation?country=...
+- GET /rollup?table=region|cohort|sex&year_from=...&year_to=...&sex=...&indicator=...
+- GET /dimensions: the countries, years, sexes and indicators that can be queried
+- GET /metrics: per endpoint number of requests, errors, cache hits/misses and latency (mean, p50, p95, max in ms)
+
+country is a name (any spelling country.py resolves) or an ISO3 code, the parameters can be repeated.
+The JSON body of a query is kept in a bounded LRU cache keyed by the endpoint and the parameters (in any order);
+each response has the X-Cache (hit, miss or - if not cached) and X-Response-Time-ms headers.
+Only the standard library http.server is used, listening on localhost by default.
+
+usage:
+    python server.py output/19_ratified_country.arrow --port 8765
+"""
+import argparse
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from typing import Optional, List, Union, Dict, Tuple, Any, Hashable
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import pandas as pd
+from storage import load_df
+from country import add_country_code, resolve_country
+from cube import COUNTRY_ATTRIBUTES, build_cube
+from statistical_analysis import evaluate_correlation
+
+PathLike = Union[Path, str]
+
+__all__ = ['LRUCache', 'PanelService', 'load_panel', 'make_server', 'main']
+
+logger = logging.getLogger(__name__)
+
+# endpoint: query parameters it accepts
+ENDPOINTS: Dict[str, Tuple[str, ...]] = {
+    '/panel': ('country', 'year_from', 'year_to', 'sex', 'indicator'),
+    '/correlation': ('country',),
+    '/rollup': ('table', 'year_from', 'year_to', 'sex', 'indicator'),
+    '/dimensions': (),
+}
+
+
+class QueryError(ValueError):
+    """invalid query parameter, answered with 400"""
+
+
+class LRUCache:
+    """
+    bounded least recently used cache, thread safe. the hits/misses are counted by the caller (count), a lookup whose
+    value can not be computed is neither
+    """
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data: 'OrderedDict[Hashable, Any]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def count(self, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+def load_panel(path: PathLike) -> pd.DataFrame:
+    """
+    :param path: panel file, .xlsx (e.g. 19_ratified_country.xlsx) or an intermediate of storage.load_df
+    (.arrow, .parquet, .pkl ...)
+    :return: df with 'ISO3' and the country attributes of cube.build_cube (missing ones are <NA>)
+    """
+    path = Path(path)
+    df = pd.read_excel(path) if path.suffix.lower() == '.xlsx' else load_df(path)
+    df = df.drop(columns=[col for col in df.columns if str(col).startswith('Unnamed: ')])  # index of old exports
+    if 'ISO3' not in df.columns:
+        df = add_country_code(df)
+    for col in COUNTRY_ATTRIBUTES:
+        if col not in df.columns:
+            df[col] = pd.NA
+    return df
+
+
+def _records(df: pd.DataFrame) -> bytes:
+    # to_json: NaN --> null, numpy and categorical values are serialized
+    return f'{{"n": {len(df)}, "rows": {df.to_json(orient="records")}}}'.encode()
+
+
+class PanelService:
+    """
+    in-memory copy of the panel and the queries on it, see module docstring
+    """
+
+    def __init__(self, panel: pd.DataFrame, cache_size: int = 256, latency_window: int = 1000):
+        """
+        :param panel: output of load_panel
+        :param cache_size: number of query results kept in the LRU cache
+        :param latency_window: number of latest requests per endpoint the latency statistics are computed from
+        """
+        cube = build_cube(panel)
+        self.countries = cube['dim_country']
+        names = self.countries.set_index('ISO3')['Country Name']
+        self.fact = cube['fact'].assign(**{'Country Name': names.reindex(cube['fact']['ISO3']).to_numpy()})
+        self.rollups = {table: cube[f'rollup_{table}'] for table in ('region', 'cohort', 'sex')}
+        self.correlation = add_country_code(evaluate_correlation(panel))
+        self.cache = LRUCache(cache_size)
+
+        self._lock = threading.Lock()
+        self._latency: Dict[str, deque] = {}
+        self._counts: Dict[str, Dict[str, int]] = {}
+        self._latency_window = latency_window
+
+    # parameters
+
+    def _codes(self, values: List[str]) -> List[str]:
+        known = set(self.countries['ISO3'].astype(str))
+        codes = []
+        for value in values:
+            code = value.upper() if value.upper() in known else resolve_country(pd.Series([value])).iloc[0]
+            if pd.isna(code) or code not in known:
+                raise QueryError(f'unknown country {value!r}, see /dimensions')
+            codes.append(code)
+        return codes
+
+    @staticmethod
+    def _year(params: Dict[str, List[str]], name: str) -> Optional[int]:
+        if name not in params:
+            return None
+        try:
+            return int(params[name][-1])
+        except ValueError:
+            raise QueryError(f'{name} should be a year, not {params[name][-1]!r}') from None
+
+    @staticmethod
+    def _choices(params: Dict[str, List[str]], name: str, allowed: List[str]) -> Optional[List[str]]:
+        if name not in params:
+            return None
+        unknown = [value for value in params[name] if value not in allowed]
+        if unknown:
+            raise QueryError(f'unknown {name} {unknown}, should be one of the {allowed}')
+        return params[name]
+
+    def _filter(self, df: pd.DataFrame, params: Dict[str, List[str]]) -> pd.DataFrame:
+        """year range, sex and indicator filter of the fact table or a rollup"""
+        mask = np.ones(len(df), dtype=bool)
+        year_from, year_to = self._year(params, 'year_from'), self._year(params, 'year_to')
+        if year_from is not None:
+            mask &= (df['Year'] >= year_from).to_numpy()
+        if year_to is not None:
+            mask &= (df['Year'] <= year_to).to_numpy()
+        for name, column in (('sex', 'Sex'), ('indicator', 'Indicator')):
+            values = self._choices(params, name, list(self.fact[column].cat.categories))
+            if values is not None:
+                mask &= df[column].isin(values).to_numpy()
+        return df[mask]
+
+    # queries
+
+    def query(self, path: str, params: Dict[str, List[str]]) -> bytes:
+        """
+        :param path: endpoint, e.g. '/panel'
+        :param params: parse_qs output, e.g. {'country': ['Netherlands'], 'sex': ['Female']}
+        :return: JSON body {"n": number of rows, "rows": [...]}
+        """
+        unknown = [name for name in params if name not in ENDPOINTS[path]]
+        if unknown:
+            raise QueryError(f'unknown parameter {unknown} of {path}, should be one of the {list(ENDPOINTS[path])}')
+
+        if path == '/panel':
+            df = self._filter(self.fact, params)
+            if 'country' in params:
+                df = df[df['ISO3'].isin(self._codes(params['country']))]
+            return _records(df[['ISO3', 'Country Name', 'Year', 'Sex', 'Indicator', 'value']])
+        if path == '/correlation':
+            df = self.correlation
+            if 'country' in params:
+                df = df[df['ISO3'].isin(self._codes(params['country']))]
+            return _records(df)
+        if path == '/rollup':
+            table = self._choices(params, 'table', list(self.rollups)) or ['region']
+            return _records(self._filter(self.rollups[table[-1]], params))
+        # /dimensions
+        return json.dumps({
+            'countries': self.countries[['ISO3', 'Country Name']].astype(str).values.tolist(),
+            'years': sorted(int(year) for year in self.fact['Year'].unique()),
+            'sexes': list(self.fact['Sex'].cat.categories),
+            'indicators': list(self.fact['Indicator'].cat.categories),
+        }).encode()
+
+    def handle(self, path: str, params: Dict[str, List[str]]) -> Tuple[int, bytes, bool]:
+        """
+        answer a request from the LRU cache or by query: 400 for an invalid parameter, 500 (logged) for any other error
+        of the query
+
+        :return: (HTTP status, JSON body, cache hit)
+        """
+        if path not in ENDPOINTS:
+            return 404, json.dumps({'error': f'unknown endpoint {path!r}, should be one of the '
+                                             f'{list(ENDPOINTS) + ["/metrics"]}'}).encode(), False
+        key = (path, tuple(sorted((name, tuple(sorted(values))) for name, values in params.items())))
+        body = self.cache.get(key)
+        if body is not None:
+            self.cache.count(hit=True)
+            return 200, body, True
+        try:
+            body = self.query(path, params)
+        except QueryError as e:
+            return 400, json.dumps({'error': str(e)}).encode(), False
+        except Exception as e:  # e.g. a pandas error on an unusual panel: a JSON 500, not a dropped connection
+            logger.exception('%s %s failed', path, params)
+            return 500, json.dumps({'error': f'{type(e).__name__}: {e}'}).encode(), False
+        self.cache.count(hit=False)  # only a computed body is a miss
+        self.cache.put(key, body)
+        return 200, body, False
+
+    # metrics
+
+    def record(self, path: str, seconds: float, hit: bool, status: int) -> None:
+        """
+        :param path: endpoint
+        :param seconds: latency of the request
+        :param hit: answered from the cache
+        :param status: HTTP status
+        """
+        with self._lock:
+            counts = self._counts.setdefault(path, {'requests': 0, 'errors': 0, 'cache_hits': 0, 'cache_misses': 0})
+            counts['requests'] += 1
+            counts['errors'] += status >= 400
+            if path in ENDPOINTS and status < 400:
+                counts['cache_hits' if hit else 'cache_misses'] += 1
+            self._latency.setdefault(path, deque(maxlen=self._latency_window)).append(seconds * 1000)
+
+    def metrics(self) -> Dict[str, Any]:
+        """
+        :return: {'endpoints': {endpoint: counts and latency (ms)}, 'cache': size, hits, misses, hit rate}
+        """
+        with self._lock:
+            endpoints = {}
+            for path, counts in self._counts.items():
+                latency = np.array(self._latency[path])
+                endpoints[path] = {**counts,
+                                   'latency_ms': {'mean': float(latency.mean()),
+                                                  'p50': float(np.percentile(latency, 50)),
+                                                  'p95': float(np.percentile(latency, 95)),
+                                                  'max': float(latency.max())}}
+        lookups = self.cache.hits + self.cache.misses
+        return {'endpoints': endpoints,
+                'cache': {'size': len(self.cache), 'maxsize': self.cache.maxsize, 'hits': self.cache.hits,
+                          'misses': self.cache.misses, 'hit_rate': self.cache.hits / lookups if lookups else None}}
+
+
+def make_server(service: PanelService, host: str = '127.0.0.1', port: int = 8765,
+                quiet: bool = False) -> ThreadingHTTPServer:
+    """
+    :param service: PanelService
+    :param host: interface, localhost by default
+    :param port: port, 0 picks a free one (server.server_address)
+    :param quiet: do not log the requests to stderr
+    :return: server, run it with serve_forever()
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            start = time.perf_counter()
+            url = urlparse(self.path)
+            if url.path == '/metrics':
+                status, body, hit = 200, json.dumps(service.metrics()).encode(), False
+            else:
+                status, body, hit = service.handle(url.path, parse_qs(url.query))
+            seconds = time.perf_counter() - start
+            service.record(url.path, seconds, hit, status)
+            cache = ('hit' if hit else 'miss') if url.path in ENDPOINTS and status < 400 else '-'
+
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('X-Cache', cache)
+            self.send_header('X-Response-Time-ms', f'{seconds * 1000:.3f}')
+            self.end_headers()
+            self.wfile.write(body)
+            if not quiet:
+                self.log_message('"%s" %s %.3f ms cache %s', self.requestline, status, seconds * 1000, cache)
+
+        def log_request(self, code='-', size='-'):
+            pass  # logged with the latency in do_GET
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description='local query API over the processed fctc panel')
+    parser.add_argument('panel', type=Path, help='e.g. 19_ratified_country.xlsx or pipeline_output/fctc.pkl')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--cache-size', type=int, default=256, help='number of query results in the LRU cache')
+    parser.add_argument('--quiet', action='store_true', help='do not log the requests')
+    args = parser.parse_args(argv)
+
+    server = make_server(PanelService(load_panel(args.panel), cache_size=args.cache_size), args.host, args.port,
+                         args.quiet)
+    print(f'serving {args.panel} on http://{args.host}:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""
+map-reduce of the mortality preprocessing across processes
+
+select_df --> preprocess_cvd --> create_age_grouping only aggregates within a country, so the raw mortality df can be
+split into shards of whole countries that run the chain independently in a process pool:
+
+- shard by 'region' (Region Code, at most one shard per WHO region) or by 'country' (hash of the country name,
+  `n_shards` balanced shards, the one to use on many cores)
+- the shard results are concatenated in shard order and sorted by the keys, so the result does not depend on which
+  process finishes first; a country in two shard results raises an error, verify=True also compares with the serial
+  chain
+
+usage:
+    python shard.py WHOMortalityDatabase_Deaths.csv --workers 32 --output cvd.parquet
+"""
+import argparse
+import inspect
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional, List, Union, Dict, Tuple, Any
+import numpy as np
+import pandas as pd
+from utility import select_df, preprocess_cvd, create_age_grouping
+from loader import MORTALITY_COLUMNS
+from schema import read_mortality
+from storage import save_df
+
+PathLike = Union[Path, str]
+
+__all__ = ['shard_mortality', 'sharded_age_grouping']
+
+SHARD_BY = ('region', 'country')
+
+# keyword arguments of the chain as in pipeline.build_stages
+SELECT_KWARGS = {'year': 2000,
+                 'drop_na': ['Number', 'Percentage of cause-specific deaths out of total deaths',
+                             'Death rate per 100 000 population']}
+
+
+def shard_mortality(df: pd.DataFrame, by: str = 'country', n_shards: int = 4) -> List[pd.DataFrame]:
+    """
+    split df into shards of whole countries
+
+    :param df: mortality df, e.g. read_mortality output
+    :param by: 'region' (one shard per Region Code) or 'country' (country name hash modulo `n_shards`)
+    :param n_shards: number of shards of by='country'
+    :return: non-empty shards
+    """
+    if by == 'region':
+        shard_id = df['Region Code'].astype(object).fillna('').to_numpy()
+    elif by == 'country':
+        # hash_array has a fixed key: the same country goes to the same shard in every run
+        names = df['Country Name'].astype(object).fillna('').to_numpy()
+        shard_id = pd.util.hash_array(names) % np.uint64(n_shards)
+    else:
+        raise ValueError(f'{by!r} should be one of the {SHARD_BY}')
+    return [shard for _, shard in df.groupby(shard_id, sort=True)]
+
+
+def _age_grouping_chain(shard: pd.DataFrame, select_kwargs: Dict[str, Any], drop_age: bool,
+                        age_bands: Optional[Dict[str, Tuple[int, Optional[int]]]]) -> Optional[pd.DataFrame]:
+    # the undecorated functions: a shard is neither cached nor traced by itself
+    shard = inspect.unwrap(select_df)(shard, **select_kwargs)
+    shard = inspect.unwrap(preprocess_cvd)(shard, drop_na=True if drop_age else None)
+    if shard.empty:
+        return None  # e.g. only years before select_kwargs['year']
+    return inspect.unwrap(create_age_grouping)(shard, age_bands=age_bands)
+
+
+def sharded_age_grouping(data: Union[pd.DataFrame, PathLike],
+                         by: str = 'country',
+                         workers: Optional[int] = None,
+                         n_shards: Optional[int] = None,
+                         select_kwargs: Optional[Dict[str, Any]] = None,
+                         drop_age: bool = True,
+                         age_bands: Optional[Dict[str, Tuple[int, Optional[int]]]] = None,
+                         verify: bool = False,
+                         save_path: Optional[Path] = None) -> pd.DataFrame:
+    """
+    select_df --> preprocess_cvd --> create_age_grouping of each shard in a process pool, see module docstring
+
+    :param data: mortality df or csv file (read by read_mortality)
+    :param by: 'region' or 'country', see shard_mortality
+    :param workers: number of processes, default the number of cores
+    :param n_shards: number of shards of by='country', default `workers`
+    :param select_kwargs: passed to select_df, default the ones of the pipeline (year 2000, drop na)
+    :param drop_age: drop age group <15 (drop_na in preprocess_cvd)
+    :param age_bands: see create_age_grouping
+    :param verify: run the serial chain too and raise if the result is not the same
+    :param save_path: save the result to excel
+    :return: same df as create_age_grouping
+    """
+    df = data if isinstance(data, pd.DataFrame) else read_mortality(data, usecols=MORTALITY_COLUMNS)
+    select_kwargs = SELECT_KWARGS if select_kwargs is None else select_kwargs
+    workers = workers or os.cpu_count() or 1
+    shards = shard_mortality(df, by, n_shards or workers)
+    if not shards:
+        raise ValueError('no mortality rows to be sharded')
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(shards))) as pool:
+        futures = [pool.submit(_age_grouping_chain, shard, select_kwargs, drop_age, age_bands) for shard in shards]
+        results = [future.result() for future in futures]  # shard order, not completion order
+    results = [result for result in results if result is not None]
+    if not results:
+        raise ValueError('no mortality rows left after select_df and preprocess_cvd')
+
+    keys = ['Country Name', 'Year'] + [col for col in ('Cause',) if col in df.columns]
+    new_df = pd.concat(results, ignore_index=True)
+    if new_df.duplicated(keys).any():
+        raise RuntimeError(f'{keys} in more than one shard, the shards are not made of whole countries')
+    new_df = new_df.sort_values(keys, kind='stable').reset_index(drop=True)
+
+    if verify:
+        try:
+            pd.testing.assert_frame_equal(new_df, _age_grouping_chain(df, select_kwargs, drop_age, age_bands))
+        except AssertionError as e:
+            raise RuntimeError(f'sharded result differs from the serial one: {e}') from None
+    if save_path:
+        save_df(new_df, save_path)
+    return new_df
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description='sharded mortality preprocessing (select_df --> create_age_grouping)')
+    parser.add_argument('mortality', type=Path, help='WHO Mortality Database csv')
+    parser.add_argument('--by', choices=SHARD_BY, default='country')
+    parser.add_argument('--workers', type=int, help='number of processes, default the number of cores')
+    parser.add_argument('--shards', type=int, help='number of shards of --by country, default --workers')
+    parser.add_argument('--year', type=int, default=2000, help='pick up the data that larger than which year')
+    parser.add_argument('--verify', action='store_true', help='compare with the serial run')
+    parser.add_argument('--output', type=Path, required=True, help='e.g. cvd.parquet or cvd.xlsx')
+    args = parser.parse_args(argv)
+
+    sharded_age_grouping(args.mortality, by=args.by, workers=args.workers, n_shards=args.shards,
+                         select_kwargs={**SELECT_KWARGS, 'year': args.year}, verify=args.verify,
+                         save_path=args.output)
+
+
+if __name__ == '__main__':
+    main()
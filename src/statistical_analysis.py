@@ -1,52 +1,206 @@
 import pandas as pd
-from scipy.stats import pearsonr
+import numpy as np
+from scipy import stats
 from pathlib import Path
-from typing import Union
+from typing import Optional, Union, List, Dict, Tuple
+from storage import save_df
+from cache import cached_stage
+from instrument import traced
 
 PathLike = Union[Path, str]
 
+__all__ = ['evaluate_correlation', 'segmented_regression', 'CORRELATION_PAIRS', 'ITS_COEFFICIENTS']
 
+# sex: (CVD mortality column, prevalence of tobacco use column)
+CORRELATION_PAIRS: Dict[str, Tuple[str, str]] = {
+    'Female': ('Female_Total_Percentage_of_Cause_Specific_Deaths_Out_Of_Total_Deaths',
+               'Female_Estimate_of_Current_Tobacco_Use_Prevalence_age_standardized_rate'),
+    'Male': ('Male_Total_Percentage_of_Cause_Specific_Deaths_Out_Of_Total_Deaths',
+             'Male_Estimate_of_Current_Tobacco_Use_Prevalence_age_standardized_rate'),
+}
+
+# y = intercept + trend * t + level_change * after + trend_change * t * after, t = Year - Ratification,
+# after = Year > Ratification (the year of ratification itself is the last year before, as in evaluate_correlation)
+ITS_COEFFICIENTS = ('intercept', 'trend', 'level_change', 'trend_change')
+
+
+def _grouped_pearson(x: pd.Series, y: pd.Series, by: List[pd.Series]) -> pd.DataFrame:
+    """
+    Pearson correlation of x and y in each group at once, from the centered sums of the groups
+    (same r and two-sided p-value as scipy.stats.pearsonr)
+
+    :param x: values without NaN
+    :param y: values without NaN, same index as x
+    :param by: group keys, same index as x
+    :return: df indexed by the group keys, columns: n, r, p
+    """
+    def grouped(s: pd.Series):
+        return s.groupby(by, observed=True, sort=True)
+
+    dx = x - grouped(x).transform('mean')
+    dy = y - grouped(y).transform('mean')
+    n = grouped(x).count()
+    r = grouped(dx * dy).sum() / np.sqrt(grouped(dx * dx).sum() * grouped(dy * dy).sum())
+    r = r.clip(-1, 1)
+
+    dof = n - 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = r * np.sqrt(dof / (1 - r ** 2))
+    p = pd.Series(2 * stats.t.sf(np.abs(t), dof), index=r.index)
+    p[dof == 0] = 1.0  # two points are always on a line
+    r[n < 2] = np.nan
+    p[n < 2] = np.nan
+    return pd.DataFrame({'n': n, 'r': r, 'p': p})
+
+
+@traced
+@cached_stage
 def evaluate_correlation(df: pd.DataFrame, output_path: PathLike = None) -> pd.DataFrame:
     """
     Evaluate the correlation between smoking rates and CVD mortality before and after FCTC ratification for each country.
-    :param df: df
-    :return: df
-    """
-    results = {}
-    df['Year'] = df['Year'].astype(str)
-    df['Ratified Year'] = df['Ratification'].astype(str)
-
-    for country, country_data in df.groupby(['Country Name']):
-        # Find the year before and after FCTC ratification
-        before_year = df['Year'] < df['Ratified Year']
-        after_year = df['Year'] > df['Ratified Year']
-
-        # Calculate the correlation between smoking rates and CVD mortality before FCTC ratification
-        before_data = df[before_year]
-        before_corr_F, _ = pearsonr(before_data['Female_Total_Percentage_of_Cause_Specific_Deaths_Out_Of_Total_Deaths'],
-                                    before_data[
-                                        'Female_Estimate_of_Current_Tobacco_Use_Prevalence_age_standardized_rate'])
-        before_corr_M, _ = pearsonr(before_data['Male_Total_Percentage_of_Cause_Specific_Deaths_Out_Of_Total_Deaths'],
-                                    before_data[
-                                        'Male_Estimate_of_Current_Tobacco_Use_Prevalence_age_standardized_rate'])
-
-        # Calculate the correlation between smoking rates and CVD mortality after FCTC ratification
-        after_data = df[after_year]
-        after_corr_F, _ = pearsonr(after_data['Female_Total_Percentage_of_Cause_Specific_Deaths_Out_Of_Total_Deaths'],
-                                   after_data[
-                                       'Female_Estimate_of_Current_Tobacco_Use_Prevalence_age_standardized_rate'])
-        after_corr_M, _ = pearsonr(after_data['Male_Total_Percentage_of_Cause_Specific_Deaths_Out_Of_Total_Deaths'],
-                                   after_data['Male_Estimate_of_Current_Tobacco_Use_Prevalence_age_standardized_rate'])
-
-        # Store the results for the current country
-        results[country] = {'Female_before_FCTC': before_corr_F, 'Female_after_FCTC': after_corr_F,
-                            'Male_before_FCTC': before_corr_M, 'Male_after_FCTC': after_corr_M}
-
-        result_df = pd.DataFrame.from_dict(results, orient='index').reset_index()
-        result_df.rename(columns={'level_0': 'Country Name'}, inplace=True)
-        # show country name in df
-
-        if output_path is not None:
-            result_df.to_excel(output_path, index=False)
+    All countries, periods and sexes are computed in one grouped pass, so the runtime does not grow with a loop over
+    countries. The year of ratification itself is neither before nor after.
+    :param df: df, needs 'Country Name', 'Year', 'Ratification' and the columns in CORRELATION_PAIRS
+    :param output_path: output path
+    :return: df, one row per country: {Sex}_{before/after}_FCTC is the Pearson r, followed by _p (p-value),
+    _n (number of years), _spearman and _spearman_p
+    """
+    # float: nullable Int columns of the merge (Int16 Year) would give <NA> in the comparison
+    year = pd.to_numeric(df['Year'], errors='coerce').astype('float64')
+    ratified_year = pd.to_numeric(df['Ratification'], errors='coerce').astype('float64')  # 'NaN' strings --> NaN
+    period = pd.Series(np.select([year < ratified_year, year > ratified_year], ['before', 'after'], default=''),
+                       index=df.index)
+
+    # long format: one row per (country, year, sex) with x = CVD mortality, y = prevalence of tobacco use
+    long_df = pd.concat([pd.DataFrame({'Country Name': df['Country Name'].astype(str),
+                                       'Period': period,
+                                       'Sex': sex,
+                                       'x': pd.to_numeric(df[cvd], errors='coerce'),
+                                       'y': pd.to_numeric(df[tobacco], errors='coerce')})
+                         for sex, (cvd, tobacco) in CORRELATION_PAIRS.items()], ignore_index=True)
+    long_df = long_df[(long_df['Period'] != '') & long_df['x'].notna() & long_df['y'].notna()]
+
+    keys = [long_df['Country Name'], long_df['Sex'], long_df['Period']]
+    pearson = _grouped_pearson(long_df['x'], long_df['y'], keys)
+    ranks = [long_df[col].groupby(keys, observed=True).rank() for col in ('x', 'y')]
+    spearman = _grouped_pearson(ranks[0], ranks[1], keys)
+    spearman.loc[spearman['n'] == 2, 'p'] = np.nan  # as scipy.stats.spearmanr
+    corr = pd.concat({'': pearson, '_spearman': spearman[['r', 'p']]}, axis=1)
+
+    # layout: {Sex}_{Period}_FCTC{method}{_p, _n}
+    order = [f'{sex}_{when}_FCTC{name}' for name in ('', '_p', '_n', '_spearman', '_spearman_p')
+             for sex in CORRELATION_PAIRS for when in ('before', 'after')]
+    if corr.empty:
+        result_df = pd.DataFrame(columns=['Country Name'] + order)
+    else:
+        wide = corr.unstack(['Sex', 'Period'])
+        suffix = {'r': '', 'p': '_p', 'n': '_n'}
+        wide.columns = [f'{sex}_{when}_FCTC{method}{suffix[stat]}' for method, stat, sex, when in wide.columns]
+        result_df = wide.reindex(columns=order).rename_axis('Country Name').reset_index()  # show country name in df
+
+    if output_path is not None:
+        save_df(result_df, output_path)
     return result_df
 
+
+def _batched_ols(X: np.ndarray, y: np.ndarray, valid: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    least squares of every group at once
+
+    :param X: (groups, rows, coefficients), padded rows are 0
+    :param y: (groups, rows), padded rows are 0
+    :param valid: (groups, rows), False for padded rows
+    :return: {'beta', 'se', 'p': (groups, coefficients), 'n', 'rank', 'sse', 'sst', 'dw': (groups,)}
+    """
+    k = X.shape[2]
+    n = valid.sum(axis=1)
+    xtx = np.einsum('gni,gnj->gij', X, X)
+    xty = np.einsum('gni,gn->gi', X, y)
+    rank = np.linalg.matrix_rank(X) if len(X) else np.zeros(0, dtype=int)
+    xtx_inv = np.linalg.pinv(xtx)
+    beta = np.einsum('gij,gj->gi', xtx_inv, xty)
+
+    resid = np.where(valid, y - np.einsum('gni,gi->gn', X, beta), 0.0)
+    sse = (resid ** 2).sum(axis=1)
+    y_mean = y.sum(axis=1) / np.maximum(n, 1)
+    sst = np.where(valid, (y - y_mean[:, None]) ** 2, 0.0).sum(axis=1)
+
+    dof = n - k
+    with np.errstate(divide='ignore', invalid='ignore'):  # sse 0 (perfect fit), no valid row or dof 0
+        # Durbin-Watson of the residuals in Year order, ~2 if they are not autocorrelated
+        dw = (np.diff(resid, axis=1) ** 2 * (valid[:, 1:] & valid[:, :-1])).sum(axis=1) / sse
+        sigma2 = sse / dof
+        se = np.sqrt(sigma2[:, None] * np.diagonal(xtx_inv, axis1=1, axis2=2))
+        p = 2 * stats.t.sf(np.abs(beta / se), dof[:, None])
+    fitted = (rank == k) & (dof > 0)  # no post-ratification years (or too few years): the model can not be fitted
+    beta[~fitted], se[~fitted], p[~fitted] = np.nan, np.nan, np.nan
+    return {'beta': beta, 'se': se, 'p': p, 'n': n, 'rank': rank, 'sse': sse, 'sst': sst, 'dw': dw}
+
+
+@traced
+@cached_stage
+def segmented_regression(df: pd.DataFrame,
+                         outcomes: Optional[Dict[str, Dict[str, str]]] = None,
+                         output_path: PathLike = None) -> pd.DataFrame:
+    """
+    Interrupted time series: segmented regression of each outcome on the years before and after FCTC ratification,
+    for every country, sex and outcome at once (stacked design matrices and batched least squares, no loop over
+    countries)
+    :param df: output of merge_fctc_df, needs 'Country Name', 'Year', 'Ratification' and the outcome columns
+    :param outcomes: {outcome: {sex: column}}, default CVD mortality and prevalence of tobacco use of CORRELATION_PAIRS
+    :param output_path: output path
+    :return: df, one row per (Country Name, Sex, Outcome): Ratification, n, n_before, n_after,
+    ITS_COEFFICIENTS and their _se and _p, r2, rmse, durbin_watson. NaN coefficients if the model can not be fitted
+    """
+    if outcomes is None:
+        outcomes = {'CVD mortality': {sex: cvd for sex, (cvd, _) in CORRELATION_PAIRS.items()},
+                    'Tobacco use': {sex: tobacco for sex, (_, tobacco) in CORRELATION_PAIRS.items()}}
+    year = pd.to_numeric(df['Year'], errors='coerce').astype('float64')
+    ratified_year = pd.to_numeric(df['Ratification'], errors='coerce').astype('float64')
+
+    # long format: one row per (country, sex, outcome, year)
+    long_df = pd.concat([pd.DataFrame({'Country Name': df['Country Name'].astype(str),
+                                       'Sex': sex,
+                                       'Outcome': outcome,
+                                       'Ratification': ratified_year,
+                                       'Year': year,
+                                       'y': pd.to_numeric(df[column], errors='coerce').astype('float64')})
+                         for outcome, columns in outcomes.items() for sex, column in columns.items()],
+                        ignore_index=True)
+    long_df = long_df.dropna(subset=['Ratification', 'Year', 'y'])
+    long_df = long_df.sort_values(['Country Name', 'Sex', 'Outcome', 'Year'], kind='stable')
+
+    # stacked design matrices: (groups, rows, coefficients), each group padded with 0 rows to the longest one
+    keys = ['Country Name', 'Sex', 'Outcome']
+    group = long_df.groupby(keys, sort=False).ngroup().to_numpy()
+    row = long_df.groupby(keys, sort=False).cumcount().to_numpy()
+    n_groups = group.max() + 1 if len(group) else 0
+    n_rows = row.max() + 1 if len(row) else 0
+    t = (long_df['Year'] - long_df['Ratification']).to_numpy()
+    after = (t > 0).astype('float64')
+    X = np.zeros((n_groups, n_rows, len(ITS_COEFFICIENTS)))
+    X[group, row] = np.column_stack([np.ones_like(t), t, after, t * after])
+    y = np.zeros((n_groups, n_rows))
+    y[group, row] = long_df['y'].to_numpy()
+    valid = np.zeros((n_groups, n_rows), dtype=bool)
+    valid[group, row] = True
+
+    fit = _batched_ols(X, y, valid)
+    result_df = long_df.groupby(keys, sort=False)[['Ratification']].first().reset_index()
+    result_df['n'] = fit['n']
+    result_df['n_before'] = (valid & (X[:, :, 2] == 0)).sum(axis=1)
+    result_df['n_after'] = result_df['n'] - result_df['n_before']
+    for i, name in enumerate(ITS_COEFFICIENTS):
+        result_df[name] = fit['beta'][:, i]
+    for i, name in enumerate(ITS_COEFFICIENTS):
+        result_df[f'{name}_se'] = fit['se'][:, i]
+        result_df[f'{name}_p'] = fit['p'][:, i]
+    fitted = result_df['intercept'].notna().to_numpy()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result_df['r2'] = np.where(fitted, 1 - fit['sse'] / fit['sst'], np.nan)
+        result_df['rmse'] = np.where(fitted, np.sqrt(fit['sse'] / fit['n']), np.nan)
+        result_df['durbin_watson'] = np.where(fitted, fit['dw'], np.nan)
+
+    if output_path is not None:
+        save_df(result_df, output_path)
+    return result_df
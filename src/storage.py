@@ -0,0 +1,184 @@
+"""
+intermediate storage of the pipeline stages
+
+- columnar formats (.parquet, .feather) keep the dtypes, are compressed and can be read back column by column,
+  so they are used to hand a df from one stage to the next
+- .pkl keeps any df as it is (e.g. object columns mixing str and float, which parquet refuses) without pyarrow
+- .arrow (Arrow IPC file, uncompressed) can be memory-mapped: several readers (notebook kernels, plot workers) open
+  the same file without copying it and read only the columns they need, see export_panel and open_panel
+- .xlsx is export only: save_df can write it for people opening the result in Excel, but load_df does not read it back
+  as an intermediate (use pd.read_excel for the raw UN treaty sheet)
+- other formats can be plugged in by register_backend
+"""
+from pathlib import Path
+from typing import Optional, List, Union, Callable, Dict, Sequence
+import pandas as pd
+
+PathLike = Union[Path, str]
+Writer = Callable[[pd.DataFrame, Path, bool], None]
+Reader = Callable[[Path, Optional[List[str]]], pd.DataFrame]
+
+__all__ = ['save_df', 'load_df', 'register_backend', 'export_panel', 'open_panel']
+
+
+def _write_parquet(df: pd.DataFrame, path: Path, index: bool) -> None:
+    df.to_parquet(path, index=index, compression='zstd')  # statistics of each column chunk are written by default
+
+
+def _read_parquet(path: Path, columns: Optional[List[str]]) -> pd.DataFrame:
+    return pd.read_parquet(path, columns=columns)
+
+
+def _write_feather(df: pd.DataFrame, path: Path, index: bool) -> None:
+    if index:
+        df = df.reset_index()
+    else:
+        df = df.reset_index(drop=True)  # feather only stores the default index
+    df.to_feather(path, compression='zstd')
+
+
+def _read_feather(path: Path, columns: Optional[List[str]]) -> pd.DataFrame:
+    return pd.read_feather(path, columns=columns)
+
+
+def _write_pickle(df: pd.DataFrame, path: Path, index: bool) -> None:
+    df.to_pickle(path)  # exact dtypes (including mixed object columns), no extra dependency
+
+
+def _read_pickle(path: Path, columns: Optional[List[str]]) -> pd.DataFrame:
+    df = pd.read_pickle(path)
+    return df if columns is None else df[columns]
+
+
+def _write_arrow(df: pd.DataFrame, path: Path, index: bool) -> None:
+    import pyarrow as pa
+    _write_arrow_table(pa.Table.from_pandas(df, preserve_index=index), path)
+
+
+def _write_arrow_table(table, path: Path) -> None:
+    import pyarrow as pa
+    with pa.OSFile(str(path), 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)  # no compression: the record batches are used in place when memory-mapped
+
+
+def _read_arrow(path: Path, columns: Optional[List[str]]) -> pd.DataFrame:
+    return open_panel(path, columns)
+
+
+def _write_excel(df: pd.DataFrame, path: Path, index: bool) -> None:
+    df.to_excel(path, index=index)
+
+
+def _write_csv(df: pd.DataFrame, path: Path, index: bool) -> None:
+    df.to_csv(path, index=index)
+
+
+_WRITERS: Dict[str, Writer] = {'.parquet': _write_parquet,
+                               '.feather': _write_feather,
+                               '.pkl': _write_pickle,
+                               '.arrow': _write_arrow,
+                               '.xlsx': _write_excel,
+                               '.csv': _write_csv}
+
+_READERS: Dict[str, Reader] = {'.parquet': _read_parquet,
+                               '.feather': _read_feather,
+                               '.pkl': _read_pickle,
+                               '.arrow': _read_arrow}
+
+
+def register_backend(suffix: str, writer: Writer, reader: Optional[Reader] = None) -> None:
+    """
+    add (or replace) the storage backend of a file suffix
+
+    :param suffix: file suffix, e.g. '.orc'
+    :param writer: writer(df, path, index)
+    :param reader: reader(path, columns), None if the format is export only
+    """
+    _WRITERS[suffix.lower()] = writer
+    if reader is not None:
+        _READERS[suffix.lower()] = reader
+    else:
+        _READERS.pop(suffix.lower(), None)
+
+
+def save_df(df: pd.DataFrame, path: PathLike, index: bool = False) -> None:
+    """
+    save df, the format is decided by the file suffix
+
+    :param df: df
+    :param path: output path, e.g. 'all_df.parquet', 'all_df.feather' or 'all_df.xlsx' (export only)
+    :param index: save the index
+    """
+    path = Path(path)
+    try:
+        writer = _WRITERS[path.suffix.lower()]
+    except KeyError:
+        raise ValueError(f'unsupported file type {path.suffix!r}, should be one of the {list(_WRITERS)}')
+    writer(df, path, index)
+
+
+def load_df(path: PathLike, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    load df saved by save_df, only the `columns` are read from the file
+
+    :param path: .parquet, .feather, .pkl or .arrow file
+    :param columns: columns to be read, None means all
+    :return: df
+    """
+    path = Path(path)
+    try:
+        reader = _READERS[path.suffix.lower()]
+    except KeyError:
+        raise ValueError(f'{path.suffix!r} can not be loaded as intermediate, should be one of the {list(_READERS)}')
+    return reader(path, columns)
+
+
+def export_panel(df: pd.DataFrame, path: PathLike, companions: Sequence[str] = ('.parquet', '.csv')) -> List[Path]:
+    """
+    export the final panel (e.g. merge_fctc_df or select_ratified_country output) as a memory-mappable Arrow IPC file.
+    the companion files (e.g. for Power BI) are written from the same Arrow table, the df is converted only once
+
+    :param df: df
+    :param path: .arrow file
+    :param companions: suffixes of the companion files next to `path`: '.parquet' and/or '.csv'
+    :return: written files
+    """
+    import pyarrow as pa
+    import pyarrow.csv
+    import pyarrow.parquet
+
+    path = Path(path)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    _write_arrow_table(table, path)
+    written = [path]
+    for suffix in companions:
+        companion = path.with_suffix(suffix)
+        if suffix == '.parquet':
+            pyarrow.parquet.write_table(table, companion, compression='zstd')
+        elif suffix == '.csv':
+            pyarrow.csv.write_csv(table, companion)
+        else:
+            raise ValueError(f'unsupported companion {suffix!r}, should be .parquet or .csv')
+        written.append(companion)
+    return written
+
+
+def open_panel(path: PathLike, columns: Optional[List[str]] = None, as_table: bool = False):
+    """
+    open an Arrow IPC file by memory-mapping: only the pages of the `columns` are read from the disk, and they are
+    shared by every process opening the same file
+
+    :param path: .arrow file written by export_panel or save_df
+    :param columns: columns to be read, None means all
+    :param as_table: return the pyarrow.Table (zero-copy) instead of a df
+    :return: df (numeric columns without missing values are not copied) or pyarrow.Table
+    """
+    import pyarrow as pa
+
+    source = pa.memory_map(str(Path(path)), 'r')
+    table = pa.ipc.open_file(source).read_all()
+    if columns is not None:
+        table = table.select(columns)
+    if as_table:
+        return table
+    return table.to_pandas(split_blocks=True, self_destruct=True)
@@ -17,6 +17,9 @@ Step 3 preprocess the WHO CVD mortality data:
     (All/Females/Males in each year and country; no age-specific)
 - Grouping age
 - change layout
+- a multi-cause input (a 'Cause' column, e.g. from loader.load_causes) is aggregated in the same groupby, one row
+  per country, year and cause
+- or age-standardized death rate (WHO standard population) from the age-specific death rates: age_standardized_rate
 
 Step 4 preprocess the Tobacco data:
 - raname column name
@@ -24,27 +27,106 @@ Step 4 preprocess the Tobacco data:
 - change layout
 
 Step 5 merge CVD df and tobacco df:
-- merge them based on Country Name and Year,show NaN if some values are empty
+- merge them based on Country Name and Year,show NaN if some values are empty (numeric columns stay numeric)
+- or on ISO3 and Year: the ISO3 code of the country names is added by create_age_grouping and tobacco_layout_modified,
+  so different spellings of a country are merged (see country.py)
 """
 
+import re
 from pathlib import Path  # pathlib: module, Path: class. Checking if a path exist
-from typing import Optional, List, Dict, Tuple  # typing: support for type hint
+from typing import Optional, List, Dict, Tuple, Union  # typing: support for type hint
 import pandas as pd
 import numpy as np
-import collections  # This module contains different datatype to process the data: dict, list, set, and tuple.
 from pprint import pprint  # pprint.pprint() can use when you need to examine the structure of a large or complex
 # data structure. this output reveals more readable and structured way.
 from who_member_states import WHO_MEMBER_STATES
+from storage import save_df
+from merge import merge_on_keys
+from country import add_country_code
+from schema import read_mortality
+from cache import cached_stage
+from instrument import traced
+
+PathLike = Union[Path, str]
 
 __all__ = ['select_df',
            'preprocess_cvd',
            'create_age_grouping',
+           'stream_age_grouping',
+           'age_standardized_rate',
            'tobacco_layout_modified',
-           'merge_df']
-
+           'merge_df',
+           'TOBACCO_INDICATORS',
+           'WHO_STANDARD_POPULATION']
+
+TOBACCO_INDICATORS = ('Estimate of current tobacco use prevalence (%) (age-standardized rate)',
+                      'Estimate of current tobacco smoking prevalence (%) (age-standardized rate)',
+                      'Estimate of current cigarette smoking prevalence (%) (age-standardized rate)')
+
+# column label of the indicators, the one not listed here is derived from the indicator name (see _indicator_label)
+TOBACCO_INDICATOR_LABELS = {
+    'Estimate of current tobacco use prevalence (%) (age-standardized rate)':
+        'Estimate_of_Current_Tobacco_Use_Prevalence_age_standardized_rate',
+    'Estimate of current tobacco smoking prevalence (%) (age-standardized rate)':
+        'Estimate_of_Current_Tobacco_Smoking_Prevalence_age_standardized_rate',
+}
+
+TOBACCO_SEX_LABELS = {'Both sexes': 'All', 'Male': 'Male', 'Female': 'Female'}
+
+MORTALITY_KEYS = ('Region Code', 'Region Name', 'Country Code', 'Country Name', 'Year')
+MORTALITY_CAUSE = 'Cause'  # optional key: several causes of death in one df
+MORTALITY_SEX_VALUES = ('All', 'Female', 'Male')
+MORTALITY_MEASURE_LABELS = {
+    'Number': 'Number_of_Cause_Specific_Deaths',
+    'Total Number of Deaths': 'Total_Number_of_Deaths',
+    'Total Percentage of Cause-Specific Deaths Out Of Total Deaths':
+        'Total_Percentage_of_Cause_Specific_Deaths_Out_Of_Total_Deaths',
+}
+
+# WHO World Standard Population 2000-2025 (Ahmad et al. 2001) per 100 000, by the 'Age Group' of the WHO Mortality
+# Database: the 0-4 weight is split into [0] and [1-4] by the number of years, [85+] is the sum of 85-89 ... 100+
+WHO_STANDARD_POPULATION = {
+    '[0]': 1772, '[1-4]': 7088, '[5-9]': 8690, '[10-14]': 8600, '[15-19]': 8470, '[20-24]': 8220, '[25-29]': 7930,
+    '[30-34]': 7610, '[35-39]': 7150, '[40-44]': 6590, '[45-49]': 6040, '[50-54]': 5370, '[55-59]': 4550,
+    '[60-64]': 3720, '[65-69]': 2960, '[70-74]': 2210, '[75-79]': 1520, '[80-84]': 910, '[85+]': 635,
+}
 
 # test data should <10 MB
 
+def _indicator_label(indicator: str) -> str:
+    """
+    column label of an indicator, e.g.
+    'Estimate of current cigarette smoking prevalence (%) (age-standardized rate)' -->
+    'Estimate_of_current_cigarette_smoking_prevalence_age_standardized_rate'
+    """
+    if indicator in TOBACCO_INDICATOR_LABELS:
+        return TOBACCO_INDICATOR_LABELS[indicator]
+    return re.sub(r'[^0-9a-zA-Z]+', '_', indicator).strip('_')
+
+
+def _wide_layout(df: pd.DataFrame,
+                 index: List[str],
+                 columns: List[str],
+                 values: Union[str, List[str]],
+                 agg: str = 'mean') -> pd.DataFrame:
+    """
+    aggregate `values` by index + columns and unstack `columns` in one vectorized groupby
+
+    :param df: long format df
+    :param index: row keys, e.g. ['Country Name', 'Year']
+    :param columns: keys moved to the columns, e.g. ['Indicator', 'Sex']
+    :param values: column(s) to be aggregated
+    :param agg: aggregation, e.g. 'mean' or 'sum'
+    :return: wide df indexed by `index`, columns are the unstacked `columns` keys (led by the value name if `values`
+    is a list)
+    """
+    aggregated = df.groupby(index + columns, sort=True, observed=True)[values].agg(agg)  # observed: only the
+    # combinations of categories existing in df
+    return aggregated.unstack(columns)
+
+
+@traced
+@cached_stage
 def select_df(df: pd.DataFrame,
               rename_mapping: Dict[str, str] = None,
               column_drop: Optional[List[str]] = None,  # column_drop (param) is an optional list of string. Optional
@@ -91,11 +173,13 @@ def select_df(df: pd.DataFrame,
             raise ValueError(f'{e} not in the dataframe, should be one of the {modified_df.columns.tolist()}')  # If
             # typed wrong, show the list which should be dropped.
     if save_path is not None:
-        modified_df.to_excel(save_path, index=False)
+        save_df(modified_df, save_path)
 
     return modified_df
 
 
+@traced
+@cached_stage
 def preprocess_cvd(df: pd.DataFrame,
                    drop_na: Optional[List[str]] = None,
                    save_path: Optional[Path] = None) -> pd.DataFrame:
@@ -127,168 +211,291 @@ def preprocess_cvd(df: pd.DataFrame,
         int)  # astype can cast/change multiple types (
     # change type to int)
     if drop_na is not None:  # drop rows with missing values ('NaN') from df
-        df = df.mask(df['Age Group'].isin(['[0]', '[1-4]', '[5-9]', '[10-14]', '[All]']), np.nan)
-        df.dropna(subset=['Age Group'], inplace=True)
+        # row filter instead of masking the whole frame with NaN, so the dtypes (e.g. int Year) are kept
+        age_mask = df['Age Group'].isin(['[0]', '[1-4]', '[5-9]', '[10-14]', '[All]']) | df['Age Group'].isna()
+        df = df[~age_mask]
 
     if save_path is not None:
-        df.to_excel(save_path, index=False)
+        save_df(df, save_path)
     return df
 
 
+def _cause_key(columns: pd.Index) -> List[str]:
+    """['Cause'] for a multi-cause df, [] for the export of a single cause"""
+    return [MORTALITY_CAUSE] if MORTALITY_CAUSE in columns else []
+
+
+def _age_band(age_group: pd.Series, age_bands: Dict[str, Tuple[int, Optional[int]]]) -> pd.Series:
+    """
+    map 'Age Group' labels ('[15-19]', '[85+]', ...) to the age band they belong to, vectorized.
+    '[All]', '[Unknown]' and age groups not covered by any band are NaN
+
+    :param age_group: 'Age Group' column
+    :param age_bands: {band name: (lower age, upper age)}, upper age None means no upper limit.
+    e.g. {'15-44': (15, 44), '45-64': (45, 64), '65+': (65, None)}
+    :return: age band of each row
+    """
+    bounds = age_group.astype(str).str.extract(r'^\[(\d+)(?:-(\d+)|(\+))?\]$')
+    lower = pd.to_numeric(bounds[0])
+    upper = pd.to_numeric(bounds[1]).fillna(lower)  # '[0]' --> 0 to 0
+    upper[bounds[2].notna()] = np.inf  # '[85+]' --> 85 to inf
+
+    conditions = [(lower >= band_lower) & (upper <= (np.inf if band_upper is None else band_upper))
+                  for band_lower, band_upper in age_bands.values()]
+    return pd.Series(np.select(conditions, list(age_bands), default=None), index=age_group.index, name='Age Band')
+
+
+def _age_grouping_sums(df: pd.DataFrame,
+                       age_bands: Optional[Dict[str, Tuple[int, Optional[int]]]] = None) -> pd.DataFrame:
+    """
+    sum of 'Number' and 'Total Number of Deaths' in each (region, country, year[, cause], sex[, age band])
+
+    :param df: df after select_df and preprocess_cvd
+    :param age_bands: see _age_band
+    :return: df indexed by the group keys
+    """
+    keys = list(MORTALITY_KEYS) + _cause_key(df.columns) + ['Sex']
+    if age_bands is not None:
+        df = df.assign(**{'Age Band': _age_band(df['Age Group'], age_bands)})
+        keys.append('Age Band')
+    return df.groupby(keys, sort=True, observed=True)[['Number', 'Total Number of Deaths']].sum()
+
+
+def _age_grouping_layout(sums: pd.DataFrame,
+                         age_bands: Optional[Dict[str, Tuple[int, Optional[int]]]] = None) -> pd.DataFrame:
+    """
+    change the layout of _age_grouping_sums output: one row per country and year (and cause),
+    {Sex}_{measure}[_{age band}] in columns, percentage is calculated after unstacking
+
+    :param sums: output of _age_grouping_sums (or the sum of several of them)
+    :param age_bands: the one passed to _age_grouping_sums
+    :return: df
+    """
+    columns = ['Sex'] if age_bands is None else ['Sex', 'Age Band']
+    wide = sums.unstack(columns)
+    # every sex (and band) column, also on empty sums (e.g. the removed keys of an incremental update)
+    wide = wide.reindex(columns=pd.MultiIndex.from_product([['Number', 'Total Number of Deaths'], MORTALITY_SEX_VALUES]
+                                                           + ([] if age_bands is None else [list(age_bands)])))
+    percentage = wide['Number'] / wide['Total Number of Deaths'] * 100
+    wide = pd.concat({'Number': wide['Number'],
+                      'Total Number of Deaths': wide['Total Number of Deaths'],
+                      'Total Percentage of Cause-Specific Deaths Out Of Total Deaths': percentage}, axis=1)
+
+    bands = [None] if age_bands is None else list(age_bands)
+    order = [(measure, sex) + (() if band is None else (band,))
+             for measure in MORTALITY_MEASURE_LABELS for sex in MORTALITY_SEX_VALUES for band in bands]
+    wide = wide.reindex(columns=pd.MultiIndex.from_tuples(order))
+    wide.columns = ['_'.join([sex, MORTALITY_MEASURE_LABELS[measure]] + list(band))
+                    for measure, sex, *band in wide.columns]
+
+    lead = ['Country Name', 'Year'] + _cause_key(wide.index.names)
+    new_df = wide.reset_index()
+    new_df = new_df[lead + [c for c in new_df.columns if c not in lead]]
+    new_df = new_df.sort_values(lead, kind='stable').reset_index(drop=True)
+    return add_country_code(new_df)  # not a group key: the rows of an unresolved name (NaN code) would be dropped
+
+
+def _union_level_categories(df1: pd.DataFrame, df2: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    give the categorical index levels of both df (e.g. Country Name of two chunks) the same categories, so adding them
+    keeps the categorical dtype
+
+    :param df1: df with a MultiIndex
+    :param df2: df with the same index names
+    :return: df1, df2
+    """
+    for i in range(df1.index.nlevels):
+        level1, level2 = df1.index.levels[i], df2.index.levels[i]
+        categorical = isinstance(level1.dtype, pd.CategoricalDtype) and isinstance(level2.dtype, pd.CategoricalDtype)
+        if categorical and level1.dtype != level2.dtype:
+            dtype = pd.CategoricalDtype(level1.dtype.categories.union(level2.dtype.categories))
+            df1 = df1.set_axis(df1.index.set_levels(level1.astype(dtype), level=i))
+            df2 = df2.set_axis(df2.index.set_levels(level2.astype(dtype), level=i))
+    return df1, df2
+
+
+@traced
+@cached_stage
 def create_age_grouping(df: pd.DataFrame,
-                        save_path: Optional[Path] = None) -> pd.DataFrame:
+                        save_path: Optional[Path] = None,
+                        age_bands: Optional[Dict[str, Tuple[int, Optional[int]]]] = None) -> pd.DataFrame:
     """
     1. Calculate: Total percentage of CVD of total deaths = Sum of CVD death number/ Sum of Total number of deaths
     * 100 (Male/ Female/ All in each year and country)
-    2. grouping_age: Age groups --> one age group (greater 15 y/o)
+    2. grouping_age: Age groups --> one age group (greater 15 y/o), or the age bands if `age_bands` is set
     3. change layout
     4. create a new df and save it to excel
 
-    :param df: df after select_df and preprocess_cvd
-    :param save: save modified dataframe to another excel
-    :return: new df
+    all of them are done in one groupby-sum-unstack
+
+    :param df: df after select_df and preprocess_cvd, with a 'Cause' column if several causes are in it
+    :param save_path: save modified dataframe to another excel
+    :param age_bands: {band name: (lower age, upper age)}, upper age None means no upper limit.
+    e.g. {'15-44': (15, 44), '45-64': (45, 64), '65+': (65, None)}; columns are suffixed by the band name.
+    run preprocess_cvd without drop_na if the bands cover age <15
+    :return: new df, one row per Country Name, Year (and Cause)
     """
 
     if 'Total Number of Deaths' not in df.columns:
         raise RuntimeError('call preprocess_cvd in advance')
 
-    dy: dict = collections.defaultdict(list)  # defaultdict object in collections. datatype will be dict. Using list
-    # as the default_factory to group a sequence of key-value pairs into a dictionary of lists
-    group = df.groupby(['Region Code', 'Region Name', 'Country Code', 'Country Name', 'Year', 'Sex'])
-    info: List[Tuple] = list(group.groups.keys())  # List[Tuple]: value is a list of tuple[()].looking for the keys in a
-    # dict. The 'groups' attribute of the 'groupby' object is always dic type
-
-    for i, it in enumerate(info):  # i = index ( starting from 0) , it = item (Entity, Year, Sex). enumerate can pair
-        # index and item
-        dy['Region Code'].append(it[0])
-        dy['Region Name'].append(it[1])
-        dy['Country Code'].append(it[2])
-        dy['Country Name'].append(it[3])
-        dy['Year'].append(it[4])  # Year in [4]
-        dy['Sex'].append(it[5])  # Sex in [5]
-
-    numbers = group['Number']
-    total_number_of_death = group['Total Number of Deaths']
-    # noinspection PyTypeChecker todo: wt is it?
-    dy['Number'] = np.array(numbers.sum())
-    dy['Total Number of Deaths'] = np.array(total_number_of_death.sum())
-    dy['Total Percentage of Cause-Specific Deaths Out Of Total Deaths'] = np.array(
-        numbers.sum() / total_number_of_death.sum() * 100)
-
-    _df = pd.DataFrame.from_dict(dy)  # creates a new_df from the dy dictionary.
-
-    # change layout
-    sex_values = ['All', 'Female', 'Male']
-    new_df = _df.assign(
-        All_Number_of_Cause_Specific_Deaths=_df.query("Sex == 'All'")['Number'],
-        Female_Number_of_Cause_Specific_Deaths=_df.query("Sex == 'Female'")['Number'],
-        Male_Number_of_Cause_Specific_Deaths=_df.query("Sex == 'Male'")['Number'],
-        All_Total_Number_of_Deaths=_df.query("Sex == 'All'")['Total Number of Deaths'],
-        Female_Total_Number_of_Deaths=_df.query("Sex == 'Female'")[
-            'Total Number of Deaths'],
-        Male_Total_Number_of_Deaths=_df.query("Sex == 'Male'")['Total Number of Deaths'],
-        All_Total_Percentage_of_Cause_Specific_Deaths_Out_Of_Total_Deaths=_df.query("Sex == 'All'")[
-            'Total Percentage of Cause-Specific Deaths Out Of Total Deaths'],
-        Female_Total_Percentage_of_Cause_Specific_Deaths_Out_Of_Total_Deaths=_df.query("Sex == 'Female'")[
-            'Total Percentage of Cause-Specific Deaths Out Of Total Deaths'],
-        Male_Total_Percentage_of_Cause_Specific_Deaths_Out_Of_Total_Deaths=_df.query("Sex == 'Male'")[
-            'Total Percentage of Cause-Specific Deaths Out Of Total Deaths'])
-    new_df.reset_index(drop=True, inplace=True)
-
-    new_df = new_df.drop(['Sex', 'Number', 'Total Number of Deaths',
-                          'Total Percentage of Cause-Specific Deaths Out Of Total Deaths'],
-                         axis=1)  # axis = 1: specifies to drop columns
-
-    new_df = new_df.groupby(['Country Name', 'Year']).first().reset_index()  # The first method is then applied to
-    # the grouped dataframe, which returns the first row of each group
+    new_df = _age_grouping_layout(_age_grouping_sums(df, age_bands), age_bands)
     if save_path:
-        new_df.to_excel(save_path, index=False)
+        save_df(new_df, save_path)
     return new_df
 
 
+@traced
+@cached_stage
+def stream_age_grouping(file: PathLike,
+                        rename_mapping: Dict[str, str] = None,
+                        column_drop: Optional[List[str]] = None,
+                        year: int = 2000,
+                        drop_na: Optional[List[str]] = None,
+                        drop_age: bool = True,
+                        age_bands: Optional[Dict[str, Tuple[int, Optional[int]]]] = None,
+                        chunksize: int = 500_000,
+                        save_path: Optional[Path] = None) -> pd.DataFrame:
+    """
+    streaming version of select_df --> preprocess_cvd --> create_age_grouping for a mortality csv file
+    (WHOMortalityDatabase_Deaths.csv format) that does not fit in memory.
+    The file is read in chunks, each chunk is filtered/derived and summed per (country, year, sex), and the partial
+    sums are folded into the running sums, so memory is bounded by `chunksize` instead of the file size.
+
+    :param file: mortality csv file
+    :param rename_mapping: see select_df
+    :param column_drop: see select_df
+    :param year: see select_df
+    :param drop_na: see select_df
+    :param drop_age: drop age group <15 (drop_na in preprocess_cvd)
+    :param age_bands: see create_age_grouping
+    :param chunksize: number of rows read at once
+    :param save_path: save the result to excel
+    :return: same df as create_age_grouping
+    """
+    sums: Optional[pd.DataFrame] = None
+    for chunk in read_mortality(file, chunksize=chunksize):
+        chunk = select_df(chunk, rename_mapping=rename_mapping, column_drop=column_drop, year=year, drop_na=drop_na)
+        chunk = preprocess_cvd(chunk, drop_na=True if drop_age else None)
+        chunk_sums = _age_grouping_sums(chunk, age_bands)
+        if sums is not None:
+            sums, chunk_sums = _union_level_categories(sums, chunk_sums)  # add() turns differing levels into object
+        sums = chunk_sums if sums is None else sums.add(chunk_sums, fill_value=0)
+
+    if sums is None:
+        raise ValueError(f'{file} is empty')
+
+    new_df = _age_grouping_layout(sums, age_bands)
+    if save_path:
+        save_df(new_df, save_path)
+    return new_df
+
+
+@traced
+@cached_stage
+def age_standardized_rate(df: pd.DataFrame,
+                          standard_population: Optional[Dict[str, float]] = None,
+                          min_age: int = 15,
+                          min_coverage: float = 0.8,
+                          save_path: Optional[Path] = None) -> pd.DataFrame:
+    """
+    age-standardized death rate (direct method) of each country, year (cause) and sex:
+    sum(Death rate per 100 000 population of the age group * weight) / sum(weight)
+
+    the age-specific rates are unstacked to a (country/year/sex x age group) matrix and standardized by one matrix
+    product with the weights. The age range is the age groups from `min_age` on, a missing age group is left out and
+    the weights are re-normalized over the others: 'Standard_Population_Coverage' is the share of the weight of the
+    age range covered by the rate (1 means no age group missing). Below `min_coverage` the rate is NaN, the weights
+    re-normalized over a few age groups give no meaningful rate
+
+    :param df: df after select_df and preprocess_cvd, one row per country, year, sex and age group
+    :param standard_population: {Age Group: weight}, default WHO_STANDARD_POPULATION
+    :param min_age: lower age of the age range, preprocess_cvd(drop_na=True) drops the age groups <15
+    :param min_coverage: lowest Standard_Population_Coverage with a rate, 1 means every age group is needed
+    :param save_path: save modified dataframe to another excel
+    :return: df, one row per country and year (and cause), columns e.g. 'All_Age_Standardized_Death_Rate',
+    'Female_Standard_Population_Coverage'
+    """
+    if standard_population is None:
+        standard_population = WHO_STANDARD_POPULATION
+    age_groups = [age_group for age_group in standard_population
+                  if int(re.match(r'^\[(\d+)', age_group).group(1)) >= min_age]
+    df = df[df['Age Group'].isin(age_groups)]
+
+    rates = _wide_layout(df, index=['Country Name', 'Year'] + _cause_key(df.columns) + ['Sex'], columns=['Age Group'],
+                         values='Death rate per 100 000 population')
+    rates = rates.reindex(columns=age_groups)  # the whole age range, also the age groups no row has
+    matrix = rates.to_numpy(dtype=np.float64)
+    weights = np.array([standard_population[age_group] for age_group in age_groups], dtype=np.float64)
+    covered = ~np.isnan(matrix) @ weights
+    coverage = covered / weights.sum()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        standardized = np.nan_to_num(matrix) @ weights / covered
+    standardized[coverage < min_coverage] = np.nan
+    measures = pd.DataFrame({'Age_Standardized_Death_Rate': standardized,
+                             'Standard_Population_Coverage': coverage}, index=rates.index)
+
+    new_df = measures.unstack('Sex')
+    new_df = new_df.reindex(columns=pd.MultiIndex.from_product([list(measures.columns), MORTALITY_SEX_VALUES]))
+    new_df.columns = [f'{sex}_{measure}' for measure, sex in new_df.columns]
+    new_df = add_country_code(new_df.reset_index())
+    if save_path:
+        save_df(new_df, save_path)
+    return new_df
+
+
+@traced
+@cached_stage
 def tobacco_layout_modified(df: pd.DataFrame,
                             column_drop: Optional[Path] = None,
-                            save_path: Optional[Path] = None) -> pd.DataFrame:
+                            save_path: Optional[Path] = None,
+                            indicators: Optional[List[str]] = None,
+                            sex_values: Optional[List[str]] = None) -> pd.DataFrame:
     """
     run select_df first and then use this function to modify layout
     :param df:  Prevalence of Tobacco data
     :param column_drop: drop col
     :param save_path: path
+    :param indicators: indicators to be shown as columns, default is TOBACCO_INDICATORS
+    :param sex_values: sex values to be shown as columns, default is ['Both sexes', 'Male', 'Female']
     :return: df
     """
     df = df.copy()
     df = df.rename(columns={'Location': 'Country Name', 'Period': 'Year', 'Dim1': 'Sex', 'First Tooltip': 'Prevalence'})
     if column_drop is not None:
         df = df.drop(columns=column_drop)
-    dy: dict = collections.defaultdict(list)
-    group = df.groupby(['Country Name', 'Year', 'Indicator', 'Sex'])
-    info: List[Tuple] = list(group.groups.keys())
-
-    for i, it in enumerate(info):
-        dy['Country Name'].append(it[0])
-        dy['Year'].append(it[1])
-        dy['Indicator'].append(it[2])
-        dy['Sex'].append(it[3])
-        dy['Prevalence'].append(group.get_group(it).Prevalence.mean())
-
-    _df = pd.DataFrame.from_dict(dy)
-    sex_values = ['Both sexes', 'Male', 'Female']
-    indicator_values = ['Estimate of current tobacco use prevalence (%) (age-standardized rate)',
-                        'Estimate of current tobacco smoking prevalence (%) (age-standardized rate)',
-                        'Estimate of current cigarette smoking prevalence (%) (age-standardized rate)']
-
-    changed_df = _df.assign(
-        All_Estimate_of_Current_Tobacco_Use_Prevalence_age_standardized_rate=_df.query(
-            "Sex == 'Both sexes'& Indicator =='Estimate of current tobacco use prevalence (%) (age-standardized rate)'")[
-            'Prevalence'],
-        Male_Estimate_of_Current_Tobacco_Use_Prevalence_age_standardized_rate=_df.query(
-            "Sex == 'Male'& Indicator =='Estimate of current tobacco use prevalence (%) (age-standardized rate)'")[
-            'Prevalence'],
-        Female_Estimate_of_Current_Tobacco_Use_Prevalence_age_standardized_rate=_df.query(
-            "Sex == 'Female'& Indicator =='Estimate of current tobacco use prevalence (%) (age-standardized rate)'")[
-            'Prevalence'],
-
-        All_Estimate_of_Current_Tobacco_Smoking_Prevalence_age_standardized_rate=_df.query(
-            "Sex == 'Both sexes'& Indicator =='Estimate of current tobacco smoking prevalence (%) (age-standardized "
-            "rate)'")['Prevalence'],
-        Male_Estimate_of_Current_Tobacco_Smoking_Prevalence_age_standardized_rate=_df.query(
-            "Sex == 'Male'& Indicator =='Estimate of current tobacco smoking prevalence (%) (age-standardized rate)'")[
-            'Prevalence'],
-        Female_Estimate_of_Current_Tobacco_Smoking_Prevalence_age_standardized_rate=_df.query(
-            "Sex == 'Female'& Indicator =='Estimate of current tobacco smoking prevalence (%) (age-standardized rate)'")[
-            'Prevalence'],
-        All_Estimate_of_current_cigarette_smoking_prevalence_age_standardized_rate=_df.query(
-            "Sex == 'Both sexes'& Indicator =='Estimate of current cigarette smoking prevalence (%) (age-standardized rate)'")[
-            'Prevalence'],
-        Male_Estimate_of_current_cigarette_smoking_prevalence_age_standardized_rate=_df.query(
-            "Sex == 'Male'& Indicator =='Estimate of current cigarette smoking prevalence (%) (age-standardized rate)'")[
-            'Prevalence'],
-        Female_Estimate_of_current_cigarette_smoking_prevalence_age_standardized_rate=_df.query(
-            "Sex == 'Female'& Indicator =='Estimate of current cigarette smoking prevalence (%) (age-standardized rate)'")[
-            'Prevalence'])
-
-    changed_df.reset_index(drop=True, inplace=True)
-
-    changed_df = changed_df.drop(['Sex', 'Prevalence', 'Indicator'], axis=1)
-    changed_df = changed_df.groupby(['Country Name', 'Year']).first().reset_index()
+    if indicators is None:
+        indicators = list(TOBACCO_INDICATORS)
+    if sex_values is None:
+        sex_values = list(TOBACCO_SEX_LABELS)
+
+    # one pass: mean Prevalence per (Country Name, Year, Indicator, Sex), then Indicator/Sex are unstacked to columns
+    changed_df = _wide_layout(df, index=['Country Name', 'Year'], columns=['Indicator', 'Sex'],
+                              values='Prevalence', agg='mean')
+    changed_df = changed_df.reindex(columns=pd.MultiIndex.from_product([indicators, sex_values]))
+    changed_df.columns = [f'{TOBACCO_SEX_LABELS.get(sex, sex)}_{_indicator_label(indicator)}'
+                          for indicator, sex in changed_df.columns]
+    changed_df = add_country_code(changed_df.reset_index())
+
     if save_path is not None:
-        changed_df.to_excel(save_path, index=False)
+        save_df(changed_df, save_path)
     return changed_df
 
 
+@traced
+@cached_stage
 def merge_df(cvd_df: pd.DataFrame, tobacco_df: pd.DataFrame, column_name=Optional[List[str]],
              all_df_out: Optional[Path] = None) -> pd.DataFrame:
     """
-    merge CVD df and tobacco df based on Country Name and Year
+    merge CVD df and tobacco df based on Country Name and Year, show NaN if some values are empty
+    (real missing values, the numeric columns stay numeric; see merge.merge_on_keys)
     :param cvd_df: cvd df
     :param tobacco_df: tobacco df
     :param column_name: country name and year
     :param all_df_out: output path
-    :return: df
+    :return: df, number of matched/unmatched keys in df.attrs['merge_report']
     """
-    all_df = pd.merge(cvd_df, tobacco_df, on=column_name, how='outer')
-    all_df.fillna(value='NaN', inplace=True)  # inplace = True means that 'value = 'NaN'' will inplace original value
-    # in df. 'Nan' can be changed what you want to instead of.
+    all_df = merge_on_keys(cvd_df, tobacco_df, keys=column_name, how='outer')
 
     # drop no need indicators in Tobacco dataset
     columns_to_drop = [
@@ -301,6 +508,6 @@ def merge_df(cvd_df: pd.DataFrame, tobacco_df: pd.DataFrame, column_name=Optiona
     ]
     all_df = all_df.drop(columns=columns_to_drop)
     if all_df_out is not None:
-        all_df.to_excel(all_df_out, index=False)
+        save_df(all_df, all_df_out)
 
     return all_df
@@ -0,0 +1,27 @@
+import sys
+from pathlib import Path
+import pytest
+
+SRC = Path(__file__).resolve().parents[1] / 'src'
+TEST_FILE = Path(__file__).resolve().parents[1] / 'test_file'
+sys.path.insert(0, str(SRC))  # the modules of src import each other as top-level modules
+
+
+@pytest.fixture
+def mortality_file() -> Path:
+    return TEST_FILE / 'WHOMortalityDatabase_Deaths.csv'
+
+
+@pytest.fixture
+def tobacco_file() -> Path:
+    return TEST_FILE / 'Estimate of current tobacco smoking prevalence(%)(age-standardized rate)_17 Jan 2022.csv'
+
+
+@pytest.fixture
+def treaty_file() -> Path:
+    return TEST_FILE / 'Signatures and Ratifications- UN Treaty Section_08 Feb_2023.xlsx'
+
+
+@pytest.fixture
+def ratified_file() -> Path:
+    return TEST_FILE / '19_ratified_country.xlsx'
@@ -0,0 +1,13 @@
+import pandas as pd
+from WHOFCTC_parties_date import parse_treaty_date
+
+
+def test_parse_treaty_date_formats():
+    s = pd.Series(['29 06 2004', ' 3 Jun 2004', '29 June 2004 a', '29/06/2004', '29.06.2004 AA', '2507 2006',
+                   '2004-06-29 00:00:00', pd.Timestamp('2004-06-29'), None, '29 Junk 2004'])
+    parsed = parse_treaty_date(s)
+    expected = pd.to_datetime(['2004-06-29', '2004-06-03', '2004-06-29', '2004-06-29', '2004-06-29', '2006-07-25',
+                               '2004-06-29', '2004-06-29', None, None])
+    pd.testing.assert_series_equal(parsed['date'], pd.Series(expected, name='date'))
+    assert parsed['type'].tolist()[:5] == ['Ratification', 'Ratification', 'Accession', 'Ratification', 'Approval']
+    assert parsed['type'].isna().tolist()[-2:] == [True, True]
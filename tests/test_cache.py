@@ -0,0 +1,60 @@
+import importlib
+import inspect
+import sys
+import pandas as pd
+import pytest
+import storage
+import utility
+from cache import code_source, enable_cache, disable_cache
+
+STAGE = '''from cache import cached_stage
+from stage_helper import helper
+
+CALLS = []
+
+
+@cached_stage
+def stage(df):
+    CALLS.append(len(df))
+    return helper(df)
+'''
+
+
+@pytest.fixture
+def stage_modules(tmp_path, monkeypatch):
+    """stage_main.stage, a cached stage whose helper is in another module (stage_helper)"""
+    (tmp_path / 'stage_helper.py').write_text('def helper(df):\n    return df + 1\n')
+    (tmp_path / 'stage_main.py').write_text(STAGE)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    enable_cache(tmp_path / 'cache')
+    yield tmp_path
+    disable_cache()
+    for name in ('stage_main', 'stage_helper'):
+        sys.modules.pop(name, None)
+
+
+def _reload():
+    importlib.reload(importlib.import_module('stage_helper'))
+    return importlib.reload(importlib.import_module('stage_main'))
+
+
+def test_code_source_covers_helper_modules():
+    assert inspect.getsource(storage) in code_source(utility.select_df)  # select_df --> storage.save_df
+
+
+def test_cache_hit_and_helper_change(stage_modules):
+    df = pd.DataFrame({'x': [1, 2, 3]})
+    stage_main = _reload()
+    pd.testing.assert_frame_equal(stage_main.stage(df), df + 1)
+    pd.testing.assert_frame_equal(stage_main.stage(df), df + 1)
+    assert stage_main.CALLS == [3]  # the second call is a hit
+
+    stage_main = _reload()  # same code: the result on disk is used
+    pd.testing.assert_frame_equal(stage_main.stage(df), df + 1)
+    assert stage_main.CALLS == []
+
+    # another size than before, so the source is not taken from linecache even if the mtime did not change
+    (stage_modules / 'stage_helper.py').write_text('def helper(df):\n    return df + 10\n')
+    stage_main = _reload()
+    pd.testing.assert_frame_equal(stage_main.stage(df), df + 10)
+    assert stage_main.CALLS == [3]
@@ -0,0 +1,23 @@
+import numpy as np
+import pandas as pd
+import pytest
+from country import add_country_code
+from cube import CUBE_TABLES, build_cube
+
+
+@pytest.fixture
+def cube(ratified_file):
+    df = add_country_code(pd.read_excel(ratified_file))
+    return build_cube(df.assign(**{'Ratification Type': pd.NA}))
+
+
+@pytest.mark.parametrize('rollup', ['rollup_region', 'rollup_cohort', 'rollup_sex'])
+def test_rollups_add_up_to_the_fact_table(cube, rollup):
+    assert set(cube) == set(CUBE_TABLES)
+    fact = cube['fact']
+    keys = ['Year', 'Sex', 'Indicator']
+    expected = fact.groupby(keys, observed=True)['value'].agg(['sum', 'count'])
+    table = cube[rollup].groupby(keys, observed=True)[['sum', 'n']].sum()
+    np.testing.assert_allclose(table['sum'], expected['sum'])
+    np.testing.assert_array_equal(table['n'], expected['count'])
+    assert table['n'].sum() == len(fact)
@@ -0,0 +1,27 @@
+import pandas as pd
+import pytest
+from delta import affected_keys, patch_rows
+
+KEYS = ['Country Name', 'Year']
+
+
+@pytest.fixture
+def old() -> pd.DataFrame:
+    return pd.DataFrame({'Country Name': pd.Categorical(['Austria', 'Austria', 'Belarus']), 'Year': [2000, 2001, 2000],
+                         'Number': [1.0, 2.0, 3.0], 'Signature': pd.array([2003, 2003, pd.NA], dtype='Int64')})
+
+
+@pytest.mark.filterwarnings('error::FutureWarning')  # concat of empty or all-NA entries
+def test_patch_rows_all_na_and_empty(old):
+    recomputed = pd.DataFrame({'Country Name': pd.Categorical(['Belarus']), 'Year': [2000], 'Number': [4.0],
+                               'Signature': [None]})  # all-NA, object
+    patched = patch_rows(old, recomputed, KEYS, affected_keys(recomputed, KEYS))
+    assert patched['Number'].tolist() == [1.0, 2.0, 4.0]
+    assert str(patched['Signature'].dtype) == 'Int64'
+
+    removed = affected_keys(pd.DataFrame({'Country Name': ['Austria'], 'Year': [2001]}), KEYS)
+    patched = patch_rows(old, old.iloc[:0], KEYS, removed)
+    pd.testing.assert_frame_equal(patched, old.drop(index=1).reset_index(drop=True))
+
+    everything = affected_keys(old, KEYS)
+    pd.testing.assert_frame_equal(patch_rows(old, old, KEYS, everything), old)
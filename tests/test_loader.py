@@ -0,0 +1,31 @@
+import shutil
+import pandas as pd
+from loader import MORTALITY_COLUMNS, TOBACCO_COLUMNS, TREATY_COLUMNS, load_raw, load_causes, read_treaty
+from schema import read_mortality, read_tobacco
+from utility import create_age_grouping, preprocess_cvd, select_df
+
+
+def test_load_raw_equals_the_serial_readers(mortality_file, tobacco_file, treaty_file):
+    raw = load_raw(mortality_file, tobacco_file, treaty_file)
+    pd.testing.assert_frame_equal(raw['mortality_raw'], read_mortality(mortality_file, usecols=MORTALITY_COLUMNS))
+    pd.testing.assert_frame_equal(raw['tobacco_raw'], read_tobacco(tobacco_file, usecols=TOBACCO_COLUMNS))
+    pd.testing.assert_frame_equal(raw['treaty_raw'], read_treaty(treaty_file, usecols=TREATY_COLUMNS))
+
+
+def _age_grouping(df: pd.DataFrame) -> pd.DataFrame:
+    return create_age_grouping(preprocess_cvd(select_df(df, year=2000), drop_na=True))
+
+
+def test_several_causes_equal_each_cause_alone(tmp_path, mortality_file):
+    # a second cause: the same rows with other death counts
+    stroke = pd.read_csv(mortality_file)
+    stroke['Number'] = stroke['Number'] * 2
+    stroke.to_csv(tmp_path / 'stroke.csv', index=False)
+    files = {'Ischaemic heart disease': shutil.copy(mortality_file, tmp_path / 'ihd.csv'),
+             'Stroke': tmp_path / 'stroke.csv'}
+
+    grouped = _age_grouping(load_causes(files))
+    for cause, file in files.items():
+        alone = _age_grouping(read_mortality(file, usecols=MORTALITY_COLUMNS))
+        part = grouped[grouped['Cause'] == cause].drop(columns='Cause').reset_index(drop=True)
+        pd.testing.assert_frame_equal(part, alone, check_categorical=False, obj=cause)
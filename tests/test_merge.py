@@ -0,0 +1,40 @@
+import pandas as pd
+import pytest
+from merge import merge_on_keys
+
+ISO3 = pd.CategoricalDtype(['DEU', 'NLD'])
+
+
+@pytest.fixture
+def left() -> pd.DataFrame:
+    # 'Atlantis' and 'Utopia' are not resolved to an ISO3 code
+    return pd.DataFrame({'ISO3': pd.Categorical(['NLD', None, 'DEU', None], dtype=ISO3),
+                         'Country Name': ['Netherlands', 'Atlantis', 'Germany', 'Utopia'],
+                         'Year': pd.array([2000, 2000, 2001, 2001], dtype='int16'),
+                         'x': [1.0, 2.0, 3.0, 4.0]})
+
+
+@pytest.fixture
+def right() -> pd.DataFrame:
+    return pd.DataFrame({'ISO3': pd.Categorical(['NLD', None], dtype=ISO3),
+                         'Country Name': ['Netherlands', 'European Union'],
+                         'Signature': [2003, 2004]})
+
+
+def test_merge_on_keys_keeps_unresolved_rows_apart(left, right):
+    merged = merge_on_keys(left, right, keys=['ISO3'], how='outer')
+    assert merged.attrs['merge_report'] == {'matched': 1, 'left_only': 3, 'right_only': 1}
+    unresolved = merged[merged['ISO3'].isna()].set_index('Country Name')
+    assert sorted(unresolved.index) == ['Atlantis', 'European Union', 'Utopia']
+    assert unresolved.loc[['Atlantis', 'Utopia'], 'Signature'].isna().all()  # no value of the European Union row
+    assert pd.isna(unresolved.loc['European Union', 'x'])
+    assert merged.loc[merged['ISO3'] == 'NLD', 'Signature'].tolist() == [2003]
+    assert merged['ISO3'].isna().tolist() == [True] * 3 + [False] * 2  # missing keys first
+    assert str(merged['Signature'].dtype) == 'Int64' and isinstance(merged['ISO3'].dtype, pd.CategoricalDtype)
+
+
+@pytest.mark.parametrize('how, names', [('inner', ['Netherlands']),
+                                        ('left', ['Atlantis', 'Utopia', 'Germany', 'Netherlands']),
+                                        ('right', ['European Union', 'Netherlands'])])
+def test_merge_on_keys_how(left, right, how, names):
+    assert merge_on_keys(left, right, keys=['ISO3'], how=how)['Country Name'].tolist() == names
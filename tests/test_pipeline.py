@@ -0,0 +1,63 @@
+import shutil
+import pandas as pd
+import pytest
+from pipeline import build_stages, run_pipeline, run_incremental
+
+
+@pytest.fixture
+def raw_files(tmp_path, mortality_file, tobacco_file, treaty_file):
+    # copies: a test rewrites them as a new release
+    files = {'mortality': mortality_file, 'tobacco': tobacco_file, 'treaty': treaty_file}
+    return {name: shutil.copy(file, tmp_path / file.name) for name, file in files.items()}
+
+
+def _downstream(stages, name):
+    names = {name}
+    for stage in stages:  # build_stages lists a stage after its inputs
+        if any(dep in names for dep in stages[stage].inputs):
+            names.add(stage)
+    return names
+
+
+def test_rerun_only_executes_downstream_of_a_change(tmp_path, raw_files):
+    stages = build_stages(**raw_files)
+    _, report = run_pipeline(stages, tmp_path / 'work')
+    assert (report['status'] == 'run').all()
+
+    tobacco = pd.read_csv(raw_files['tobacco'])
+    tobacco.loc[0, 'First Tooltip'] = tobacco.loc[0, 'First Tooltip'] + 1
+    tobacco.to_csv(raw_files['tobacco'], index=False)
+    _, report = run_pipeline(build_stages(**raw_files), tmp_path / 'work')
+    executed = set(report.index[report['status'] == 'run'])
+    assert executed == _downstream(stages, 'tobacco_raw')
+
+
+# the tables run_incremental patches, the intermediate mortality stages are not
+PATCHED = ['cvd', 'asr', 'tobacco', 'all_df', 'fctc', 'ratified', 'correlation', 'its']
+
+
+def _remove_key(mortality: pd.DataFrame) -> pd.DataFrame:
+    # all rows of a (country, year) of the panel: the key is gone from cvd, asr and all_df
+    country, year = mortality.loc[mortality['Year'] >= 2000, ['Country Name', 'Year']].iloc[0]
+    return mortality[(mortality['Country Name'] != country) | (mortality['Year'] != year)]
+
+
+def _change_before_2000(mortality: pd.DataFrame) -> pd.DataFrame:
+    # a row select_df(year=2000) filters out: nothing is recomputed
+    row = mortality.index[mortality['Year'] < 2000][0]
+    return mortality.assign(Number=mortality['Number'].where(mortality.index != row, mortality['Number'] + 1))
+
+
+@pytest.mark.parametrize('release', [_remove_key, _change_before_2000])
+def test_incremental_update_equals_full_run(tmp_path, raw_files, release):
+    run_pipeline(build_stages(**raw_files), tmp_path / 'work')
+    mortality = pd.read_csv(raw_files['mortality'])
+    release(mortality).to_csv(raw_files['mortality'], index=False)
+
+    stages = build_stages(**raw_files)
+    updated, delta = run_incremental(stages, tmp_path / 'work')
+    assert (delta['source'] == 'mortality').any()  # patched, not a fallback to a full run
+    full, _ = run_pipeline(stages, tmp_path / 'full', targets=PATCHED)
+    for name in PATCHED:
+        # the patched tables keep the categories of the removed rows
+        pd.testing.assert_frame_equal(updated[name], full[name], check_categorical=False, obj=name)
@@ -0,0 +1,38 @@
+import re
+import pandas as pd
+import pytest
+from plot import plot_line_chart_pages, relationship_cvd_tobacco_report
+
+MALE_CVD = 'Male_Total_Percentage_of_Cause_Specific_Deaths_Out_Of_Total_Deaths'
+FEMALE_CVD = 'Female_Total_Percentage_of_Cause_Specific_Deaths_Out_Of_Total_Deaths'
+
+
+@pytest.fixture
+def ratified(ratified_file) -> pd.DataFrame:
+    return pd.read_excel(ratified_file)
+
+
+def _pdf_pages(path) -> int:
+    return len(re.findall(rb'/Type\s*/Page\b', path.read_bytes()))
+
+
+def test_line_chart_pages(tmp_path, ratified):
+    countries = ratified['Country Name'].nunique()
+    pngs = plot_line_chart_pages(ratified, MALE_CVD, FEMALE_CVD, tmp_path / 'png', workers=2)
+    assert len(pngs) == countries and all(png.stat().st_size > 0 for png in pngs)
+    assert sorted(png.name for png in (tmp_path / 'png').iterdir()) == sorted(png.name for png in pngs)
+
+    [pdf] = plot_line_chart_pages(ratified, MALE_CVD, FEMALE_CVD, tmp_path / 'charts.pdf', countries_per_page=5,
+                                  workers=2)
+    assert _pdf_pages(pdf) == -(-countries // 5)
+
+
+def test_relationship_report(tmp_path, ratified):
+    countries = ['Netherlands', 'France', 'Japan']
+    pngs = relationship_cvd_tobacco_report(ratified, tmp_path / 'png', select_country=countries, workers=2)
+    assert [png.name for png in pngs] == ['Netherlands.png', 'France.png', 'Japan.png']
+    assert all(png.exists() for png in pngs)
+
+    [pdf] = relationship_cvd_tobacco_report(ratified, tmp_path / 'report.pdf', workers=2)
+    assert _pdf_pages(pdf) == ratified['Country Name'].nunique()
+    assert b'/Subtype /Image' not in pdf.read_bytes()  # vector pages, no bitmap
@@ -0,0 +1,65 @@
+import json
+import threading
+from urllib.error import HTTPError
+from urllib.request import urlopen
+import pytest
+from server import PanelService, load_panel, make_server
+
+
+@pytest.fixture
+def service(ratified_file):
+    return PanelService(load_panel(ratified_file))
+
+
+@pytest.fixture
+def get(service):
+    server = make_server(service, port=0, quiet=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def get(url: str):
+        try:
+            with urlopen(f'http://127.0.0.1:{server.server_address[1]}{url}') as response:
+                return response.status, json.loads(response.read()), response.headers['X-Cache']
+        except HTTPError as e:
+            return e.code, json.loads(e.read()), e.headers['X-Cache']
+
+    yield get
+    server.shutdown()
+    server.server_close()
+
+
+def test_panel_query_and_cache(get):
+    status, body, cache = get('/panel?country=Netherlands&sex=Female&year_from=2005')
+    assert status == 200 and cache == 'miss'
+    assert body['n'] == len(body['rows']) > 0
+    assert {row['ISO3'] for row in body['rows']} == {'NLD'} and {row['Sex'] for row in body['rows']} == {'Female'}
+    assert min(row['Year'] for row in body['rows']) >= 2005
+    assert get('/panel?year_from=2005&sex=Female&country=NLD')[2] == 'miss'  # ISO3 is another key
+    assert get('/panel?year_from=2005&sex=Female&country=Netherlands')[1:] == (body, 'hit')  # any order
+
+
+def test_errors(get, service, monkeypatch):
+    assert get('/nothing')[0] == 404
+    status, body, cache = get('/panel?country=Atlantis')
+    assert status == 400 and 'Atlantis' in body['error'] and cache == '-'
+    assert get('/panel?year_from=soon')[0] == 400
+
+    def fail(path, params):
+        raise KeyError('Region Code')
+
+    monkeypatch.setattr(service, 'query', fail)
+    misses = service.cache.misses
+    status, body, cache = get('/rollup?table=sex')
+    assert status == 500 and 'KeyError' in body['error'] and cache == '-'
+    assert service.cache.misses == misses  # a failed query is no cache miss
+
+    metrics = get('/metrics')[1]
+    assert metrics['endpoints']['/rollup']['errors'] == 1
+    assert metrics['cache']['misses'] == misses
+
+
+def test_dimensions(get):
+    status, body, _ = get('/dimensions')
+    assert status == 200
+    assert ['NLD', 'Netherlands'] in body['countries']
+    assert body['sexes'] == ['All', 'Female', 'Male']
@@ -0,0 +1,17 @@
+import pytest
+import pandas as pd
+from loader import MORTALITY_COLUMNS
+from schema import read_mortality
+from shard import SELECT_KWARGS, shard_mortality, sharded_age_grouping
+from utility import create_age_grouping, preprocess_cvd, select_df
+
+
+@pytest.mark.parametrize('by', ['country', 'region'])
+def test_sharded_equals_serial(mortality_file, by):
+    df = read_mortality(mortality_file, usecols=MORTALITY_COLUMNS)
+    shards = shard_mortality(df, by, n_shards=3)
+    assert sum(len(shard) for shard in shards) == len(df)
+
+    serial = select_df(df, **SELECT_KWARGS)
+    serial = create_age_grouping(preprocess_cvd(serial, drop_na=True))
+    pd.testing.assert_frame_equal(sharded_age_grouping(df, by=by, workers=2), serial)
@@ -0,0 +1,15 @@
+import warnings
+import numpy as np
+from statistical_analysis import _batched_ols
+
+
+def test_batched_ols_perfect_fit_and_empty_group():
+    years = np.arange(6, dtype=np.float64)
+    X = np.stack([np.stack([np.ones(6), years], axis=1), np.zeros((6, 2))])  # a line and a group without rows
+    y = np.stack([2 + 3 * years, np.zeros(6)])
+    valid = np.array([[True] * 6, [False] * 6])
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')  # no RuntimeWarning of sse == 0 or n == 0
+        fit = _batched_ols(X, y, valid)
+    np.testing.assert_allclose(fit['beta'][0], [2, 3])
+    assert np.isnan(fit['beta'][1]).all()
@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+import pytest
+from schema import read_mortality
+from utility import (select_df, preprocess_cvd, create_age_grouping, stream_age_grouping, age_standardized_rate,
+                     WHO_STANDARD_POPULATION)
+
+
+@pytest.mark.parametrize('age_bands', [None, {'15-44': (15, 44), '45-64': (45, 64), '65+': (65, None)}])
+def test_stream_age_grouping_matches_in_memory(mortality_file, age_bands):
+    df = preprocess_cvd(select_df(read_mortality(mortality_file), year=2000), drop_na=True)
+    expected = create_age_grouping(df, age_bands=age_bands)
+    streamed = stream_age_grouping(mortality_file, year=2000, age_bands=age_bands, chunksize=40)  # several chunks
+    pd.testing.assert_frame_equal(streamed, expected)
+
+
+@pytest.mark.parametrize('stage', [create_age_grouping, age_standardized_rate])
+def test_empty_input_keeps_the_columns(mortality_file, stage):
+    # e.g. the rows of a removed key in an incremental update
+    df = preprocess_cvd(select_df(read_mortality(mortality_file), year=2000), drop_na=True)
+    empty, full = stage(df.iloc[:0]), stage(df)
+    assert empty.empty
+    pd.testing.assert_series_equal(empty.dtypes, full.dtypes)
+
+
+def test_age_standardized_rate_needs_coverage():
+    age_groups = [age_group for age_group in WHO_STANDARD_POPULATION
+                  if age_group not in ('[0]', '[1-4]', '[5-9]', '[10-14]')]  # min_age 15
+    rows = [('Netherlands', age_group, 100.0) for age_group in age_groups] + [('Germany', '[85+]', 5000.0)]
+    df = pd.DataFrame([(country, 2005, 'All', age_group, rate) for country, age_group, rate in rows],
+                      columns=['Country Name', 'Year', 'Sex', 'Age Group', 'Death rate per 100 000 population'])
+    asr = age_standardized_rate(df).set_index('Country Name')
+    assert asr.loc['Netherlands', 'All_Age_Standardized_Death_Rate'] == pytest.approx(100)
+    assert asr.loc['Netherlands', 'All_Standard_Population_Coverage'] == pytest.approx(1)
+    # one age group of the oldest: no rate, not 5000 re-weighted to the whole population
+    assert np.isnan(asr.loc['Germany', 'All_Age_Standardized_Death_Rate'])
+    assert asr.loc['Germany', 'All_Standard_Population_Coverage'] < 0.02